@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Stores the JSON of events stored before the `raw` column existed, so REQ replays send it as is.
+Safe to run repeatedly, events that already have their JSON are skipped.
+"""
+
+import argparse
+import asyncio
+
+from tortoise import Tortoise
+
+from ekiden import database
+
+
+async def backfill(db_url: str, batch_size: int):
+    await Tortoise.init(db_url=db_url, modules={"models": ["ekiden.database"]})
+    await Tortoise.generate_schemas()
+    await database.migrate()
+    try:
+        backfilled = await database.backfill_raw(batch_size=batch_size)
+        print(f"stored the JSON of {backfilled} events")
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", default="sqlite://ekiden.sqlite3")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(backfill(args.db_url, args.batch_size))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Measures the per-subscriber cost of building EVENT frames during a broadcast.
+
+`before` serializes the event for every subscriber, the way `Subscription.send` used to.
+`after` runs `SubscriptionPool.broadcast`, which serializes the event once and only prefixes the subscription id.
+"""
+
+import argparse
+import asyncio
+import time
+from uuid import uuid4
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, ETag, Event, Filters, Kind, PTag, dump_json
+from ekiden.subscriptions import Subscription, SubscriptionPool
+
+
+class NullConnection:
+    """Stands in for a websocket connection, discards every frame"""
+
+    closed = False
+
+    def __init__(self):
+        self.subscriptions = {}
+
+    def push(self, frame: str) -> bool:
+        return True
+
+    async def send(self, frame: str):
+        pass
+
+
+def make_event(tag_count: int) -> Event:
+    private_key = PrivateKey()
+    event = Event(
+        pubkey=private_key.public_key_hex(),
+        kind=Kind.text_note,
+        tags=tuple(ETag(id=uuid4().hex * 2) if i % 2 else PTag(pubkey=uuid4().hex * 2) for i in range(tag_count)),
+        content="hello, world " * 10,
+    )
+    event.sign(private_key.hex())
+    return event
+
+
+def before(event: CompactEvent, subscriptions) -> float:
+    start = time.perf_counter()
+    for subscription in subscriptions:
+        dump_json(["EVENT", subscription.subscription_id, event.dict()])
+    return time.perf_counter() - start
+
+
+async def after(event: CompactEvent, pool: SubscriptionPool) -> float:
+    start = time.perf_counter()
+    await pool.broadcast(event)
+    return time.perf_counter() - start
+
+
+async def main(subscribers: int, tags: int, rounds: int):
+    connection = NullConnection()
+    pool = SubscriptionPool()
+    subscriptions = [
+        Subscription(filters=[Filters()], connection=connection, subscription_id=uuid4().hex)
+        for _ in range(subscribers)
+    ]
+    for subscription in subscriptions:
+        pool.add_subscription(subscription)
+
+    event = CompactEvent.from_dict(make_event(tags).dict())
+    before_best = min(before(event, subscriptions) for _ in range(rounds))
+    after_best = min([await after(event, pool) for _ in range(rounds)])
+
+    print(f"subscribers={subscribers} tags={tags} rounds={rounds}")
+    print(f"before: {before_best / subscribers * 1e6:8.2f} us/subscriber {before_best * 1e3:8.2f} ms/broadcast")
+    print(f"after:  {after_best / subscribers * 1e6:8.2f} us/subscriber {after_best * 1e3:8.2f} ms/broadcast")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--tags", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.subscribers, args.tags, args.rounds))
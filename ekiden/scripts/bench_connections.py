@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Measures the memory of idle client connections, to size hosts for large numbers of parked clients.
+
+Opens --connections websocket connections on `Hoshi.endpoint` in process, through the ASGI interface, each sending
+its REQs and then staying idle. Every connection subscribes with:
+  - a shared feed filter, identical for every client, e.g a global timeline
+  - a filter on its own pubkey in `#p` tags, unique to the client
+  - a follow list of --follows authors drawn from --authors pubkeys
+
+The Python heap allocated per connection is measured with tracemalloc and reported with the allocation sites that
+hold most of it. The server's own socket and protocol objects are not included, `scripts/loadgen.py` measures the
+resident memory of a whole relay process.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import tempfile
+import tracemalloc
+from hashlib import sha256
+from typing import Dict, List
+
+import ekiden
+from ekiden.eventlog import LogStore
+from ekiden.hoshi import Hoshi
+from ekiden.nips import Kind, dump_json
+from ekiden.relay import AsyncRelay
+
+PACKAGE = os.path.dirname(os.path.abspath(ekiden.__file__))
+SCRIPT = os.path.abspath(__file__)
+
+
+def fixed_hex(seed: str) -> str:
+    return sha256(seed.encode("utf-8")).hexdigest()
+
+
+def make_requests(client: int, rng: random.Random, args: argparse.Namespace) -> List[str]:
+    authors = [fixed_hex(f"author {i}") for i in rng.sample(range(args.authors), args.follows)]
+    return [
+        dump_json(["REQ", "feed", {"kinds": [Kind.text_note], "limit": 20}]),
+        dump_json(["REQ", "mentions", {"#p": [fixed_hex(f"client {client}")], "limit": 20}]),
+        dump_json(["REQ", "follows", {"authors": authors, "kinds": [Kind.text_note], "limit": 20}]),
+    ]
+
+
+class IdleClient:
+    """The ASGI side of one websocket, sends its REQs and then idles until closed"""
+
+    def __init__(self, requests: List[str]):
+        self.requests = requests
+        self.eose = asyncio.Event()
+        self.closed = asyncio.Event()
+        self._pending = 0
+
+    async def receive(self):
+        if self.requests is None:
+            await self.closed.wait()
+            return {"type": "websocket.disconnect", "code": 1000}
+        if not self._pending and self.requests:
+            self._pending = len(self.requests)
+            return {"type": "websocket.connect"}
+
+        text = self.requests.pop(0)
+        if not self.requests:
+            self.requests = None
+        return {"type": "websocket.receive", "text": text}
+
+    async def send(self, message):
+        if message.get("text", "").startswith('["EOSE"'):
+            self._pending -= 1
+            if not self._pending:
+                self.eose.set()
+
+
+def scope() -> dict:
+    return {"type": "websocket", "path": "/", "headers": [], "query_string": b"", "subprotocols": []}
+
+
+async def main(args: argparse.Namespace):
+    hoshi = Hoshi()
+    with tempfile.TemporaryDirectory() as directory:
+        storage = LogStore(directory=directory, sync=False)
+        Hoshi.relay = AsyncRelay(sub_pool=Hoshi.sub_pool, storage=storage)
+        # nothing may be written outside the temporary directory, e.g to a database in the working directory
+        if Hoshi.relay.storage is not storage:
+            raise RuntimeError(f"The relay replaced the log store with {type(Hoshi.relay.storage).__name__}")
+        await Hoshi.relay.start()
+
+        rng = random.Random(0)
+        requests = [make_requests(client, rng, args) for client in range(args.connections)]
+        clients = []
+        tasks = []
+
+        gc.collect()
+        tracemalloc.start(args.frames)
+        before = tracemalloc.take_snapshot()
+        for client_requests in requests:
+            client = IdleClient(client_requests)
+            clients.append(client)
+            tasks.append(asyncio.create_task(hoshi(scope(), client.receive, client.send)))
+            await client.eose.wait()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        subscriptions = len(Hoshi.sub_pool)
+
+        for client in clients:
+            client.closed.set()
+        await asyncio.gather(*tasks)
+        await Hoshi.relay.close()
+
+    sites: Dict[str, int] = {}
+    for stat in after.compare_to(before, "traceback"):
+        # attributed to the innermost frame of the relay or of this script, the clients are the benchmark's own
+        frame = next(
+            (frame for frame in reversed(stat.traceback) if frame.filename.startswith((PACKAGE, SCRIPT))),
+            stat.traceback[-1],
+        )
+        if frame.filename == SCRIPT:
+            continue
+        site = f"{os.path.relpath(frame.filename, os.path.dirname(PACKAGE))}:{frame.lineno}"
+        sites[site] = sites.get(site, 0) + stat.size_diff
+
+    top = sorted(sites.items(), key=lambda site: site[1], reverse=True)[: args.top]
+    result = {
+        "connections": args.connections,
+        "storage": type(storage).__name__,
+        "subscriptions": subscriptions,
+        "bytes_per_connection": sum(sites.values()) // args.connections,
+        "top_sites": [{"site": site, "bytes_per_connection": size // args.connections} for site, size in top],
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--authors", type=int, default=2000, help="pubkeys the follow lists are drawn from")
+    parser.add_argument("--follows", type=int, default=50, help="authors followed by each client")
+    parser.add_argument("--top", type=int, default=10, help="allocation sites to report")
+    parser.add_argument("--frames", type=int, default=16, help="traceback depth used to attribute allocations")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the per-event hot paths in `ekiden.nips`, `ekiden.validation`, `ekiden.database` and
+`ekiden.subscriptions`.
+
+The corpora are fixed: events signed with constant keys at a constant timestamp with 0, 5 and 50 tags, and filters of
+several shapes, so results of different runs and revisions are comparable.
+
+Every benchmark reports the best per call time over --repeat rounds, each round runs enough calls to take ~0.2s.
+Save a run with `--save baseline.json` and pass it to a later run with `--compare baseline.json` to print the change
+of every benchmark, changes beyond --threshold are flagged as faster or slower. Benchmarks of functions a revision does
+not have yet are skipped, so a baseline can be saved on any earlier revision by running this copy of the script there.
+"""
+
+import argparse
+import json
+import sys
+import time
+import timeit
+from hashlib import sha256
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ekiden import database, nips, subscriptions
+from ekiden.keys import PrivateKey
+from ekiden.nips import ETag, Event, Filters, Kind, PTag, create_tag
+from ekiden.subscriptions import validate_filters
+
+try:
+    from ekiden.validation import prevalidate
+except ImportError:
+    prevalidate = None
+
+# None on revisions that do not have them yet
+CompactEvent = getattr(nips, "CompactEvent", None)
+FilterMatcher = getattr(subscriptions, "FilterMatcher", None)
+
+CREATED_AT = 1_700_000_000
+TAG_COUNTS = (0, 5, 50)
+
+
+def fixed_hex(seed: str) -> str:
+    return sha256(seed.encode("utf-8")).hexdigest()
+
+
+def make_event(tag_count: int) -> Event:
+    private_key = PrivateKey.load(fixed_hex(f"key {tag_count}"))
+    event = Event(
+        pubkey=private_key.public_key_hex(),
+        kind=Kind.text_note,
+        created_at=CREATED_AT,
+        tags=tuple(
+            ETag(id=fixed_hex(f"e {i}")) if i % 2 else PTag(pubkey=fixed_hex(f"p {i}")) for i in range(tag_count)
+        ),
+        content="hello, world " * 10,
+    )
+    event.sign(private_key.hex())
+    return event
+
+
+def make_record(event: Event) -> database.Event:
+    return database.Event(
+        id=event.id,
+        pubkey=event.pubkey,
+        created_at=event.created_at,
+        kind=event.kind,
+        sig=event.sig,
+        content=event.content,
+        tags=[tag.dict() for tag in event.tags],
+    )
+
+
+def make_filters(event: Event) -> Dict[str, Filters]:
+    """Filter shapes from the cheapest to the most involved, all of them match the 5 tag event"""
+    return {
+        "empty": Filters(),
+        "kinds": Filters(kinds=[Kind.set_metadata, Kind.text_note]),
+        "authors": Filters(authors=[fixed_hex(f"author {i}") for i in range(9)] + [event.pubkey]),
+        "author_prefix": Filters(authors=[event.pubkey[:8]]),
+        "ids_prefix": Filters(ids=[event.id[:6]]),
+        "since_until": Filters(since=CREATED_AT - 60, until=CREATED_AT + 60),
+        "p_tags": Filters(**{"#p": [fixed_hex(f"p {i}") for i in range(0, 10, 2)]}),
+        "combined": Filters(
+            authors=[event.pubkey],
+            kinds=[Kind.text_note],
+            since=CREATED_AT - 60,
+            **{"#e": [fixed_hex("e 1")], "#p": [fixed_hex("p 0")]},
+        ),
+    }
+
+
+def cold_id(event: Event) -> Callable[[], str]:
+    if not hasattr(event, "_id"):
+        # the id is not cached, every call is cold
+        return lambda: event.id
+
+    def run():
+        event._serialized = None
+        event._id = None
+        return event.id
+
+    return run
+
+
+def cold_serialize(event: Event) -> Callable[[], str]:
+    if not hasattr(event, "serialized"):
+        tags = [tag.json_array() for tag in event.tags]
+        return lambda: Event.serialize(event.pubkey, event.created_at, event.kind, tags, event.content)
+
+    def run():
+        event._serialized = None
+        return event.serialized()
+
+    return run
+
+
+def benchmarks() -> Dict[str, Callable[[], object]]:
+    suite = {}
+    for tag_count in TAG_COUNTS:
+        event = make_event(tag_count)
+        data = event.dict()
+        tags = [tag.json_array() for tag in event.tags]
+        records = [tag.dict() for tag in event.tags]
+        record = make_record(event)
+
+        suite[f"Event.id[{tag_count}]"] = cold_id(event)
+        suite[f"Event.id cached[{tag_count}]"] = lambda event=event: event.id
+        suite[f"Event.serialize[{tag_count}]"] = cold_serialize(event)
+        if prevalidate is not None:
+            suite[f"prevalidate[{tag_count}]"] = lambda data=data: prevalidate(data, now=CREATED_AT)
+        suite[f"Event.verify[{tag_count}]"] = lambda data=data: Event.verify(dict(data))
+        if CompactEvent is not None:
+            suite[f"CompactEvent.verify[{tag_count}]"] = lambda data=data: CompactEvent.verify(data)
+            suite[f"CompactEvent.json[{tag_count}]"] = lambda data=data: CompactEvent.from_dict(data).json()
+            suite[f"CompactEvent.load[{tag_count}]"] = lambda text=json.dumps(data): CompactEvent.load(text)
+        suite[f"create_tag[{tag_count}]"] = lambda tags=tags: [create_tag(tag) for tag in tags]
+        suite[f"database.create_tag[{tag_count}]"] = lambda records=records: [
+            database.create_tag(tag) for tag in records
+        ]
+        suite[f"Event.nipple[{tag_count}]"] = record.nipple
+
+    event = make_event(5)
+    for shape, filters in make_filters(event).items():
+        suite[f"validate_filters[{shape}]"] = lambda filters=filters: validate_filters(event, filters)
+        if FilterMatcher is not None:
+            matcher = FilterMatcher(filters)
+            suite[f"FilterMatcher.matches[{shape}]"] = lambda matcher=matcher: matcher.matches(event)
+
+    return suite
+
+
+def measure(run: Callable[[], object], repeat: int) -> float:
+    """Best seconds per call"""
+    timer = timeit.Timer(run)
+    number, elapsed = timer.autorange()
+    # autorange stops at 0.2s, keep the rounds about that long
+    number = max(1, int(number * 0.2 / elapsed)) if elapsed else number
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def format_time(seconds: float) -> str:
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:9.3f} ms"
+    if seconds >= 1e-6:
+        return f"{seconds * 1e6:9.3f} us"
+    return f"{seconds * 1e9:9.1f} ns"
+
+
+def compare(name: str, seconds: float, baseline: Dict[str, float], threshold: float) -> str:
+    before = baseline.get(name)
+    if before is None:
+        return "new"
+
+    change = (seconds - before) / before
+    if change <= -threshold:
+        verdict = "faster"
+    elif change >= threshold:
+        verdict = "SLOWER"
+    else:
+        verdict = ""
+    return f"{format_time(before)} {change * 100:+7.1f}% {verdict}"
+
+
+def main(args: argparse.Namespace) -> int:
+    baseline: Optional[Dict[str, float]] = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results: Dict[str, float] = {}
+    slower: List[Tuple[str, float]] = []
+    for name, run in benchmarks().items():
+        if args.select and not any(selected in name for selected in args.select):
+            continue
+
+        seconds = measure(run, args.repeat)
+        results[name] = seconds
+        line = f"{name:40} {format_time(seconds)}"
+        if baseline is not None:
+            line += f"  {compare(name, seconds, baseline, args.threshold)}"
+            if name in baseline and seconds >= baseline[name] * (1 + args.threshold):
+                slower.append((name, seconds))
+        print(line, flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"timestamp": int(time.time()), "python": sys.version, "results": results}, f, indent=2)
+
+    # a non zero exit lets CI fail on regressions
+    return 1 if slower and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("select", nargs="*", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.05, help="relative change reported as faster/slower")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with 1 when a benchmark got slower")
+    sys.exit(main(parser.parse_args()))
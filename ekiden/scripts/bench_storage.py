@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Compares the storage engines, `sqlite` (SQLiteStore) and `log` (LogStore), on the same corpus of events.
+
+For every engine it reports the write throughput of group commits of --batch-size events, the time to reopen the
+store, which for the log includes rebuilding its indexes, and the best time over --repeat runs of REQ replays of
+several filter shapes. The corpus is generated with fixed seeds so runs are comparable. Signatures are not verified by
+the stores, the events are left unsigned to keep the corpus quick to build.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from hashlib import sha256
+from typing import Dict, List
+
+from ekiden.nips import CompactEvent, Filters, Kind
+from ekiden.storage import EventStore
+
+CREATED_AT = 1_700_000_000
+
+
+def fixed_hex(seed: str) -> str:
+    return sha256(seed.encode("utf-8")).hexdigest()
+
+
+def make_corpus(count: int, authors: int) -> List[CompactEvent]:
+    rng = random.Random(0)
+    pubkeys = [fixed_hex(f"author {i}") for i in range(authors)]
+    events = []
+    for i in range(count):
+        tags = [("p", rng.choice(pubkeys))] if rng.random() < 0.3 else []
+        if rng.random() < 0.3:
+            tags.append(("e", fixed_hex(f"event {rng.randrange(count)}")))
+        if rng.random() < 0.1:
+            tags.append(("t", rng.choice(("nostr", "bitcoin", "relay"))))
+        events.append(
+            CompactEvent(
+                pubkey=rng.choice(pubkeys),
+                # mostly in order with some late arrivals
+                created_at=CREATED_AT + i - (rng.randrange(600) if rng.random() < 0.1 else 0),
+                kind=Kind.contact_list if rng.random() < 0.02 else Kind.text_note,
+                tags=tuple(tags),
+                content=f"note {i} " + "x" * rng.randrange(200),
+                sig="0" * 128,
+            )
+        )
+    return events
+
+
+def make_filters(events: List[CompactEvent]) -> Dict[str, Filters]:
+    middle = events[len(events) // 2]
+    return {
+        "newest": Filters(limit=100),
+        "kinds": Filters(kinds=[Kind.contact_list], limit=100),
+        "author": Filters(authors=[middle.pubkey], limit=100),
+        "author_prefix": Filters(authors=[middle.pubkey[:8]], limit=100),
+        "ids": Filters(ids=[event.id for event in events[:: max(1, len(events) // 20)]]),
+        "p_tag": Filters(**{"#p": [middle.pubkey]}, limit=100),
+        "window": Filters(since=middle.created_at - 300, until=middle.created_at, limit=100),
+        "deep_page": Filters(until=events[len(events) // 10].created_at, limit=500),
+    }
+
+
+def create(engine: str, directory: str) -> EventStore:
+    if engine == "log":
+        from ekiden.eventlog import LogStore
+
+        return LogStore(directory=os.path.join(directory, "log"))
+
+    from ekiden.settings import settings
+    from ekiden.storage import SQLiteStore
+
+    settings.database_path = os.path.join(directory, "ekiden.sqlite3")
+    return SQLiteStore()
+
+
+async def replay(store: EventStore, filters: Filters, chunk_size: int) -> int:
+    count = 0
+    async for events in store.stream(filters, filters.limit or 5000, chunk_size):
+        count += len(events)
+    return count
+
+
+async def bench(engine: str, events: List[CompactEvent], args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        store = create(engine, directory)
+        await store.start()
+        started = time.perf_counter()
+        for position in range(0, len(events), args.batch_size):
+            await store.commit(events[position : position + args.batch_size])
+        write_seconds = time.perf_counter() - started
+        await store.close()
+
+        store = create(engine, directory)
+        started = time.perf_counter()
+        await store.start()
+        start_seconds = time.perf_counter() - started
+
+        queries = {}
+        for name, filters in make_filters(events).items():
+            best = float("inf")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                count = await replay(store, filters, args.chunk_size)
+                best = min(best, time.perf_counter() - started)
+            queries[name] = {"seconds": best, "events": count}
+        await store.close()
+
+    return {
+        "write_events_per_second": len(events) / write_seconds,
+        "start_seconds": start_seconds,
+        "queries": queries,
+    }
+
+
+async def main(args: argparse.Namespace):
+    events = make_corpus(args.events, args.authors)
+    results = {engine: await bench(engine, events, args) for engine in args.engines}
+
+    for engine, result in results.items():
+        written = result["write_events_per_second"]
+        print(f"{engine}: {written:.0f} events/s written, started in {result['start_seconds'] * 1e3:.1f} ms")
+        for name, query in result["queries"].items():
+            print(f"  {name:15} {query['seconds'] * 1e3:9.3f} ms  {query['events']:5} events")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"events": args.events, "batch_size": args.batch_size, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("engines", nargs="*", help="engines to run, sqlite and log by default")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+    args.engines = args.engines or ["sqlite", "log"]
+    asyncio.run(main(args))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+End to end load test of the relay.
+
+Starts the relay in a child process on a fresh database, or targets an already running relay with --url, then opens
+M subscribers with a mix of filters and N publishers sending real signed events. Every subscriber waits for its EOSE
+before publishing starts.
+
+Reports as JSON:
+  - events/sec accepted by the relay and deliveries/sec to subscribers
+  - publish to OK and publish to delivery latency percentiles in milliseconds
+  - deliveries received against the deliveries the filters call for
+  - resident memory of the relay per open connection, when the relay process is known (spawned or --server-pid)
+
+The filter mix is a list of weights, e.g `all:1,kinds:1,authors:2,tags:2`:
+  - all      matches every event
+  - kinds    matches text notes
+  - authors  matches the events of one publisher
+  - tags     matches events with a `p` tag of one of --tag-targets pubkeys, every event tags one of them
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.metadata import PackageNotFoundError, version
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from websockets import connect
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import Event, Filters, Kind, PTag, dump_json
+from ekiden.subscriptions import FilterMatcher
+
+FILTER_KINDS = ("all", "kinds", "authors", "tags")
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition(":")
+        if name not in FILTER_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown filter {name!r}, expected one of {', '.join(FILTER_KINDS)}")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest rank percentiles of latencies in seconds, reported in milliseconds"""
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+
+    samples = sorted(samples)
+
+    def rank(p: float) -> float:
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1e3, 3)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99), "max": round(samples[-1] * 1e3, 3)}
+
+
+def rss(pid: Optional[int]) -> Optional[int]:
+    """Resident memory of a process in bytes, None when it can not be read"""
+    if pid is None:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def spawn_relay(database_path: str) -> Tuple[subprocess.Popen, str]:
+    """Run the relay app with uvicorn in a child process, so its memory is measured apart from the load generator"""
+    port = free_port()
+    env = dict(os.environ, EKIDEN_DATABASE_PATH=database_path)
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import uvicorn; from ekiden.main import create_app; "
+            f"uvicorn.run(create_app(), host='127.0.0.1', port={port}, log_level='warning')",
+        ],
+        env=env,
+    )
+
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError("relay exited during startup")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return process, f"ws://127.0.0.1:{port}"
+
+    process.terminate()
+    raise RuntimeError("relay did not start listening")
+
+
+class Publisher:
+    def __init__(self, index: int, events: int, tag_targets: List[str]):
+        self.index = index
+        self.private_key = PrivateKey()
+        self.pubkey = self.private_key.public_key_hex()
+        self.events: List[Event] = []
+        self.connected = asyncio.Event()
+        created_at = int(time.time())
+        for i in range(events):
+            event = Event(
+                pubkey=self.pubkey,
+                kind=Kind.text_note,
+                created_at=created_at,
+                tags=(PTag(pubkey=random.choice(tag_targets)),),
+                content=f"load {index} {i} {uuid4().hex}",
+            )
+            event.sign(self.private_key.hex())
+            self.events.append(event)
+
+
+class Subscriber:
+    def __init__(self, name: str, filters: Filters):
+        self.name = name
+        self.filters = filters
+        self.matcher = FilterMatcher(filters)
+        self.subscription_id = uuid4().hex
+        self.ready = asyncio.Event()
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        tag_targets = [PrivateKey().public_key_hex() for _ in range(args.tag_targets)]
+        self.publishers = [Publisher(i, args.events, tag_targets) for i in range(args.publishers)]
+        self.subscribers = self._subscribers(parse_mix(args.filters), tag_targets)
+
+        self.sent_at: Dict[str, float] = {}
+        self.ok_latencies: List[float] = []
+        self.delivery_latencies: List[float] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.delivered = 0
+        self.expected_deliveries = sum(
+            subscriber.matcher.matches(event)
+            for subscriber in self.subscribers
+            for publisher in self.publishers
+            for event in publisher.events
+        )
+        self.all_delivered = asyncio.Event()
+
+    def _subscribers(self, mix: Dict[str, int], tag_targets: List[str]) -> List[Subscriber]:
+        names = random.choices(list(mix), weights=list(mix.values()), k=self.args.subscribers)
+        subscribers = []
+        for name in names:
+            if name == "kinds":
+                filters = Filters(kinds=[Kind.text_note])
+            elif name == "authors":
+                filters = Filters(authors=[random.choice(self.publishers).pubkey])
+            elif name == "tags":
+                filters = Filters(**{"#p": [random.choice(tag_targets)]})
+            else:
+                filters = Filters()
+            subscribers.append(Subscriber(name, filters))
+        return subscribers
+
+    async def subscribe(self, url: str, subscriber: Subscriber):
+        async with connect(url, max_size=None) as websocket:
+            filters = subscriber.filters.dict(by_alias=True, exclude_defaults=True)
+            await websocket.send(dump_json(["REQ", subscriber.subscription_id, filters]))
+            async for message in websocket:
+                received_at = time.perf_counter()
+                frame = json.loads(message)
+                if frame[0] == "EOSE":
+                    subscriber.ready.set()
+                elif frame[0] == "EVENT":
+                    sent_at = self.sent_at.get(frame[2]["id"])
+                    if sent_at is None:
+                        continue
+                    self.delivery_latencies.append(received_at - sent_at)
+                    self.delivered += 1
+                    if self.delivered >= self.expected_deliveries:
+                        self.all_delivered.set()
+
+    async def publish(self, url: str, publisher: Publisher, start: asyncio.Event):
+        in_flight = asyncio.Semaphore(self.args.in_flight)
+        interval = 1 / self.args.rate if self.args.rate else 0
+        pending = len(publisher.events)
+        done = asyncio.Event()
+
+        async with connect(url, max_size=None) as websocket:
+
+            async def read_results():
+                nonlocal pending
+                async for message in websocket:
+                    received_at = time.perf_counter()
+                    frame = json.loads(message)
+                    if frame[0] != "OK":
+                        continue
+                    self.ok_latencies.append(received_at - self.sent_at[frame[1]])
+                    if frame[2]:
+                        self.accepted += 1
+                    else:
+                        self.rejected += 1
+                    in_flight.release()
+                    pending -= 1
+                    if not pending:
+                        done.set()
+
+            reader = asyncio.create_task(read_results())
+            publisher.connected.set()
+            await start.wait()
+            for event in publisher.events:
+                await in_flight.acquire()
+                payload = dump_json(["EVENT", event.dict()])
+                self.sent_at[event.id] = time.perf_counter()
+                await websocket.send(payload)
+                if interval:
+                    await asyncio.sleep(interval)
+
+            await done.wait()
+            reader.cancel()
+
+    async def run(self, url: str, server_pid: Optional[int]) -> dict:
+        rss_before = rss(server_pid)
+
+        subscriber_tasks = [asyncio.create_task(self.subscribe(url, subscriber)) for subscriber in self.subscribers]
+        await asyncio.gather(*(subscriber.ready.wait() for subscriber in self.subscribers))
+
+        start = asyncio.Event()
+        publisher_tasks = [asyncio.create_task(self.publish(url, publisher, start)) for publisher in self.publishers]
+        # let the publishers connect before the clock starts
+        await asyncio.gather(*(publisher.connected.wait() for publisher in self.publishers))
+        rss_connected = rss(server_pid)
+
+        started = time.perf_counter()
+        start.set()
+        await asyncio.gather(*publisher_tasks)
+        published_in = time.perf_counter() - started
+
+        if self.expected_deliveries and self.delivered < self.expected_deliveries:
+            try:
+                await asyncio.wait_for(self.all_delivered.wait(), self.args.drain)
+            except asyncio.TimeoutError:
+                pass
+        delivered_in = time.perf_counter() - started
+        rss_after = rss(server_pid)
+
+        for task in subscriber_tasks:
+            task.cancel()
+        await asyncio.gather(*subscriber_tasks, return_exceptions=True)
+
+        connections = len(self.subscribers) + len(self.publishers)
+        return {
+            "ekiden": package_version(),
+            "timestamp": int(time.time()),
+            "config": {
+                "publishers": self.args.publishers,
+                "subscribers": self.args.subscribers,
+                "events_per_publisher": self.args.events,
+                "filters": parse_mix(self.args.filters),
+                "in_flight": self.args.in_flight,
+                "rate": self.args.rate,
+                "target": "spawned" if self.args.url is None else self.args.url,
+            },
+            "published": sum(len(publisher.events) for publisher in self.publishers),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "publish_seconds": round(published_in, 3),
+            "events_per_second": round(self.accepted / published_in, 1) if published_in else None,
+            "deliveries": self.delivered,
+            "expected_deliveries": self.expected_deliveries,
+            "deliveries_per_second": round(self.delivered / delivered_in, 1) if delivered_in else None,
+            "ok_latency_ms": percentiles(self.ok_latencies),
+            "delivery_latency_ms": percentiles(self.delivery_latencies),
+            "memory": {
+                "rss_before": rss_before,
+                "rss_connected": rss_connected,
+                "rss_after": rss_after,
+                "bytes_per_connection": (
+                    (rss_connected - rss_before) // connections
+                    if rss_before is not None and rss_connected is not None
+                    else None
+                ),
+            },
+        }
+
+
+def package_version() -> Optional[str]:
+    try:
+        return version("ekiden")
+    except PackageNotFoundError:
+        return None
+
+
+async def main(args: argparse.Namespace):
+    test = LoadTest(args)
+
+    process = None
+    server_pid = args.server_pid
+    with tempfile.TemporaryDirectory() as directory:
+        if args.url is None:
+            process, url = await spawn_relay(os.path.join(directory, "loadgen.sqlite3"))
+            server_pid = process.pid
+        else:
+            url = args.url
+
+        try:
+            result = await test.run(url, server_pid)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="relay to load, e.g ws://127.0.0.1:8000. Spawns a relay when omitted")
+    parser.add_argument("--server-pid", type=int, help="pid of the relay behind --url, to measure its memory")
+    parser.add_argument("--publishers", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=100)
+    parser.add_argument("--events", type=int, default=100, help="events sent by each publisher")
+    parser.add_argument("--filters", default="all:1,kinds:1,authors:2,tags:2", help="weighted filter mix")
+    parser.add_argument("--tag-targets", type=int, default=10, help="pubkeys the events tag")
+    parser.add_argument("--in-flight", type=int, default=1, help="events a publisher sends before waiting for OKs")
+    parser.add_argument("--rate", type=float, default=0, help="events/sec per publisher, 0 sends as fast as acked")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds to wait for outstanding deliveries")
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    parse_mix(args.filters)
+    random.seed(args.seed)
+    asyncio.run(main(args))
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import struct
+from abc import abstractmethod
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from ekiden.nips import CompactEvent
+from ekiden.settings import BusKind, settings
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[CompactEvent], Awaitable[None]]
+
+# frames on the unix socket bus are prefixed with their length as a big endian unsigned int
+FRAME_HEADER = struct.Struct(">I")
+
+
+class BroadcastBus:
+    """
+    A bus delivers every accepted event to the subscriptions of every relay worker, the publishing one included.
+    """
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        """Start receiving events
+
+        Args:
+            deliver (Deliver): Called with every event published on the bus
+        """
+        self._deliver = deliver
+
+    @abstractmethod
+    async def publish(self, event: CompactEvent):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LocalBus(BroadcastBus):
+    """Delivers events within the current process, for a single worker"""
+
+    async def publish(self, event: CompactEvent):
+        await self._deliver(event)
+
+
+class UnixSocketBus(BroadcastBus):
+    """Fans events out to every worker on the host over unix sockets.
+
+    Each worker listens on `<directory>/<pid>.sock` and forwards the events it accepts to every other socket in the
+    directory. The peer list is rescanned whenever the directory changes, peers that are gone or stop reading are
+    dropped.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_buffer: Optional[int] = None):
+        super().__init__()
+        self.directory = directory or settings.bus_directory
+        self.max_buffer = max_buffer or settings.bus_max_buffer
+        self.path = os.path.join(self.directory, f"{os.getpid()}.sock")
+
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[str, asyncio.StreamWriter] = {}
+        self._incoming: Set[asyncio.StreamWriter] = set()
+        self._scanned_at: Optional[int] = None
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._receive, path=self.path)
+
+    async def _receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._incoming.add(writer)
+        try:
+            while True:
+                (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                event = CompactEvent.load((await reader.readexactly(length)).decode("utf-8"))
+                await self._deliver(event)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logger.error(f"Broadcast bus peer failed: {e!r}")
+        finally:
+            self._incoming.discard(writer)
+            writer.close()
+
+    async def _connect(self, path: str):
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except ConnectionRefusedError:
+            # nothing listens on it anymore, the worker that bound it is gone
+            logger.info(f"Removing stale broadcast bus socket {path}")
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return
+        except OSError as e:
+            logger.error(f"Could not connect to broadcast bus peer {path}: {e!r}")
+            return
+        self._peers[path] = writer
+
+    async def _refresh_peers(self):
+        try:
+            scanned_at = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if scanned_at == self._scanned_at:
+            return
+        self._scanned_at = scanned_at
+
+        paths = {
+            entry.path
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(".sock") and entry.path != self.path
+        }
+        for path in set(self._peers) - paths:
+            self._drop(path)
+        for path in paths - set(self._peers):
+            await self._connect(path)
+
+    def _drop(self, path: str):
+        writer = self._peers.pop(path, None)
+        if writer is not None:
+            writer.close()
+
+    async def publish(self, event: CompactEvent):
+        await self._refresh_peers()
+        if self._peers:
+            payload = event.json().encode("utf-8")
+            frame = FRAME_HEADER.pack(len(payload)) + payload
+            for path, writer in list(self._peers.items()):
+                if writer.is_closing() or writer.transport.get_write_buffer_size() > self.max_buffer:
+                    logger.error(f"Dropping broadcast bus peer {path}")
+                    self._drop(path)
+                    # reconnect on the next publish if the peer is still around
+                    self._scanned_at = None
+                    continue
+                writer.write(frame)
+
+        await self._deliver(event)
+
+    async def close(self):
+        for path in list(self._peers):
+            self._drop(path)
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in list(self._incoming):
+            writer.close()
+        # let the receivers see the end of their streams
+        await asyncio.sleep(0)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def create_bus() -> BroadcastBus:
+    if settings.broadcast_bus == BusKind.unix:
+        return UnixSocketBus()
+    return LocalBus()
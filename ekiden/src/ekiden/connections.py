@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, Optional
+
+from starlette.websockets import WebSocket
+
+from ekiden import metrics
+from ekiden.limits import ConnectionLimits
+from ekiden.settings import SlowConsumerPolicy, settings
+
+if TYPE_CHECKING:
+    from ekiden.subscriptions import Subscription
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    """A client websocket with its own bounded outbound queue.
+
+    Frames are written to the socket by a writer task so producers never wait on the network. The queue and the task
+    only exist while frames are waiting, an idle connection holds neither.
+    """
+
+    __slots__ = (
+        "websocket",
+        "policy",
+        "timeout",
+        "closed",
+        "dropped",
+        "limits",
+        "subscriptions",
+        "queue_size",
+        "_frames",
+        "_writer",
+        "_room",
+        "_full_since",
+        "_closing",
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        queue_size: Optional[int] = None,
+        policy: Optional[SlowConsumerPolicy] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.websocket = websocket
+        self.policy = policy or settings.slow_consumer_policy
+        self.timeout = timeout if timeout is not None else settings.slow_consumer_timeout
+        self.closed = False
+        self.dropped = 0
+        self.limits = ConnectionLimits()
+        # open subscriptions by id, see `SubscriptionPool`
+        self.subscriptions: Dict[str, "Subscription"] = {}
+        self.queue_size = queue_size or settings.outbound_queue_size
+
+        self._frames: Optional[Deque[str]] = None
+        self._writer: Optional[asyncio.Task] = None
+        # set when the writer makes room in the full queue, only created while a sender waits for it
+        self._room: Optional[asyncio.Event] = None
+        self._full_since: Optional[float] = None
+        # the close of a slow consumer started by `push`, which can not wait for it
+        self._closing: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Frames waiting to be written"""
+        return len(self._frames) if self._frames else 0
+
+    def _full(self) -> bool:
+        return self._frames is not None and 0 < self.queue_size <= len(self._frames)
+
+    def _enqueue(self, frame: str):
+        if self._frames is None:
+            self._frames = deque()
+        self._frames.append(frame)
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    def _wake(self):
+        if self._room is not None:
+            self._room.set()
+            self._room = None
+
+    async def _write(self):
+        try:
+            while self._frames:
+                frame = self._frames.popleft()
+                self._full_since = None
+                self._wake()
+                await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Connection writer stopped: {e!r}")
+            self.closed = True
+            self._frames = None
+            self._wake()
+        finally:
+            self._writer = None
+            if not self._frames:
+                self._frames = None
+
+    async def send(self, frame: str):
+        """Queue a frame, waiting for room if the queue is full.
+
+        Used for responses to the client's own requests, which should be delivered in full. A client that does not
+        read for `timeout` seconds is disconnected, whatever the slow consumer policy.
+
+        Args:
+            frame (str): The serialized frame to send
+        """
+        while not self.closed and self._full():
+            if self._room is None:
+                self._room = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._room.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                logger.info(f"Disconnecting slow consumer after waiting {self.timeout:.1f}s for room")
+                await self.close()
+        if self.closed:
+            return
+        self._enqueue(frame)
+
+    def push(self, frame: str) -> bool:
+        """Queue a frame without waiting, applying the slow consumer policy if the queue is full.
+
+        Args:
+            frame (str): The serialized frame to send
+
+        Returns:
+            bool: True if the frame was queued, else False.
+        """
+        if self.closed:
+            return False
+
+        if not self._full():
+            self._enqueue(frame)
+            return True
+
+        if self.policy == SlowConsumerPolicy.drop_oldest:
+            self._frames.popleft()
+            self._enqueue(frame)
+            self.dropped += 1
+            metrics.frames_dropped.inc()
+            return True
+
+        self.dropped += 1
+        metrics.frames_dropped.inc()
+        now = time.monotonic()
+        if self._full_since is None:
+            self._full_since = now
+        elif now - self._full_since > self.timeout:
+            logger.info(f"Disconnecting slow consumer after {now - self._full_since:.1f}s")
+            self.closed = True
+            self._closing = asyncio.create_task(self.close())
+        return False
+
+    async def close(self):
+        """Stop the writer task and close the websocket"""
+        self.closed = True
+        self._frames = None
+        self._wake()
+        if self._writer and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass
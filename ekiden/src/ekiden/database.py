@@ -1,5 +1,9 @@
-from tortoise import fields
+import json
+from typing import Tuple
+
+from tortoise import Tortoise, fields
 from tortoise.models import Model
+from tortoise.transactions import in_transaction
 
 from ekiden import nips
 
@@ -22,6 +26,67 @@ def create_tag(tag_dict) -> nips.Tag:
     raise UnknownTagError(f"Could not parse tag {tag_dict}")
 
 
+def tag_record(tag: Tuple[str, ...]) -> dict:
+    """Converts a compact tag into the dict stored in `Event.tags`.
+
+    `e` and `p` tags keep the shape `nips.Tag.dict()` produces, elements past the relay url go to `extra`. Other tags
+    are stored as their name and values. The record converts back to the exact tag, which the event id depends on.
+    """
+    if tag[0] in ("e", "p") and len(tag) > 1:
+        record = {"id" if tag[0] == "e" else "pubkey": tag[1]}
+        if len(tag) > 2:
+            record["recommended_relay_url"] = tag[2]
+        if len(tag) > 3:
+            record["extra"] = list(tag[3:])
+        return record
+
+    return {"name": tag[0], "values": list(tag[1:])}
+
+
+def is_indexed(tag: Tuple[str, ...]) -> bool:
+    # only single letter tags are queryable (NIP-12), e.g `#e` and `#p`
+    return len(tag) > 1 and len(tag[0]) == 1
+
+
+def tag_from_record(record: dict) -> Tuple[str, ...]:
+    """Converts a dict stored in `Event.tags` back into a compact tag, the inverse of `tag_record`"""
+    if "name" in record:
+        return (record["name"], *record["values"])
+
+    if "id" in record:
+        tag = ("e", record["id"])
+    elif "pubkey" in record:
+        tag = ("p", record["pubkey"])
+    else:
+        raise UnknownTagError(f"Could not parse tag {record}")
+
+    if "recommended_relay_url" in record:
+        tag += (record["recommended_relay_url"],)
+    return tag + tuple(record.get("extra", ()))
+
+
+def row_to_event(row: dict) -> nips.CompactEvent:
+    """Converts a raw `event` row into a compact event without building a model"""
+    if row["raw"] is not None:
+        return nips.CompactEvent.load(row["raw"])
+
+    tags = row["tags"]
+    if isinstance(tags, str):
+        tags = json.loads(tags)
+
+    event = nips.CompactEvent(
+        pubkey=row["pubkey"],
+        created_at=row["created_at"],
+        kind=row["kind"],
+        tags=tuple(tag_from_record(record) for record in tags),
+        content=row["content"],
+        sig=row["sig"],
+    )
+    # checked when the event was accepted
+    event._id = row["id"]
+    return event
+
+
 class Identity(Model):
     pubkey: str = fields.CharField(max_length=64, pk=True, index=True)
     name: str = fields.TextField(null=True)
@@ -38,13 +103,16 @@ class Identity(Model):
 class Event(Model):
     table_id = fields.IntField(pk=True)
 
-    id: str = fields.TextField()
+    # unique, see the `uid_event_id` index in MIGRATIONS
+    id: str = fields.CharField(max_length=64)
     kind = fields.IntField()
     content: str = fields.TextField()
     created_at = fields.IntField()
     tags = fields.JSONField()
     pubkey: str = fields.TextField()
     sig: str = fields.TextField()
+    # the event's JSON as sent to clients, `nips.CompactEvent.json`. Added by MIGRATIONS and written with SQL, rows
+    # stored before it have none until `backfill_raw` runs
 
     class Meta:
         table = "event"
@@ -52,6 +120,16 @@ class Event(Model):
     def __str__(self) -> str:
         return f"{self.id} {self.kind} {self.content} {self.tags} {self.pubkey} {self.sig}"
 
+    async def save_tags(self, tags):
+        """Index the tags of this event in `event_tag`, call inside the transaction creating the event
+
+        Args:
+            tags: The compact tags of the event
+        """
+        tag_rows = [EventTag(event_id=self.table_id, name=tag[0], value=tag[1]) for tag in tags if is_indexed(tag)]
+        if tag_rows:
+            await EventTag.bulk_create(tag_rows)
+
     def nipple(self) -> nips.Event:
         """Converts the database record into a NIPS defined event
 
@@ -60,9 +138,208 @@ class Event(Model):
         """
         return nips.Event(
             pubkey=self.pubkey,
-            create_at=self.created_at,
+            created_at=self.created_at,
             kind=self.kind,
             sig=self.sig,
             tags=[create_tag(tag_dict) for tag_dict in self.tags],
             content=self.content,
         )
+
+
+class EventTag(Model):
+    """One (name, value) pair of an event tag, so `#e` and `#p` filters can be answered from an index"""
+
+    id = fields.IntField(pk=True)
+    event = fields.ForeignKeyField("models.Event", related_name="tag_refs", on_delete=fields.CASCADE, index=True)
+    name: str = fields.CharField(max_length=16)
+    value: str = fields.CharField(max_length=255)
+
+    class Meta:
+        table = "event_tag"
+        indexes = (("name", "value"),)
+
+
+# rows of replaceable kinds, see `nips.is_replaceable`, at most one per (pubkey, kind)
+REPLACEABLE = '("kind" IN (0, 3) OR ("kind" >= 10000 AND "kind" < 20000))'
+
+
+async def insert_event(event: nips.CompactEvent) -> int:
+    """Insert an event that is not replaceable. Call inside a transaction.
+
+    Args:
+        event (nips.CompactEvent): The verified event
+
+    Returns:
+        int: The `table_id` of the new row
+    """
+    _, rows = await Tortoise.get_connection("default").execute_query(
+        'INSERT INTO "event" ("id", "kind", "content", "created_at", "tags", "pubkey", "sig", "raw") '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING "table_id"',
+        [
+            event.id,
+            event.kind,
+            event.content,
+            event.created_at,
+            json.dumps([tag_record(tag) for tag in event.tags]),
+            event.pubkey,
+            event.sig,
+            event.json(),
+        ],
+    )
+    return rows[0]["table_id"]
+
+
+async def replace_event(event: nips.CompactEvent) -> bool:
+    """Insert a replaceable event or replace the stored event with the same pubkey and kind if it is older.
+    Call inside a transaction.
+
+    Args:
+        event (nips.CompactEvent): The verified event
+
+    Returns:
+        bool: True if the event was stored, False if a newer event is stored already.
+    """
+    connection = Tortoise.get_connection("default")
+    _, rows = await connection.execute_query(
+        'INSERT INTO "event" ("id", "kind", "content", "created_at", "tags", "pubkey", "sig", "raw") '
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+        f'ON CONFLICT ("pubkey", "kind") WHERE {REPLACEABLE} DO UPDATE SET '
+        '"id" = excluded."id", "content" = excluded."content", "created_at" = excluded."created_at", '
+        '"tags" = excluded."tags", "sig" = excluded."sig", "raw" = excluded."raw" '
+        'WHERE excluded."created_at" > "event"."created_at" '
+        'OR (excluded."created_at" = "event"."created_at" AND excluded."id" < "event"."id") '
+        'RETURNING "table_id"',
+        [
+            event.id,
+            event.kind,
+            event.content,
+            event.created_at,
+            json.dumps([tag_record(tag) for tag in event.tags]),
+            event.pubkey,
+            event.sig,
+            event.json(),
+        ],
+    )
+    if not rows:
+        return False
+
+    table_id = rows[0]["table_id"]
+    await connection.execute_query('DELETE FROM "event_tag" WHERE "event_id" = ?', [table_id])
+    await Event(table_id=table_id).save_tags(event.tags)
+    return True
+
+
+async def upsert_identity(pubkey: str, name=None, about=None, picture=None):
+    """Create or update an identity in one statement, fields passed as None keep their stored value"""
+    await Tortoise.get_connection("default").execute_query(
+        'INSERT INTO "identity" ("pubkey", "name", "about", "picture") VALUES (?, ?, ?, ?) '
+        'ON CONFLICT ("pubkey") DO UPDATE SET "name" = COALESCE(excluded."name", "identity"."name"), '
+        '"about" = COALESCE(excluded."about", "identity"."about"), '
+        '"picture" = COALESCE(excluded."picture", "identity"."picture")',
+        [pubkey, name, about, picture],
+    )
+
+
+# Steps bringing databases created by earlier versions up to the current schema, applied in order.
+# `generate_schemas` only creates missing tables, so indexes added to existing tables have to be created here.
+# `PRAGMA user_version` records how many steps a database has applied.
+MIGRATIONS = [
+    [
+        # keep the first copy of every event before the id becomes unique
+        'DELETE FROM "event" WHERE "table_id" NOT IN (SELECT MIN("table_id") FROM "event" GROUP BY "id")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "uid_event_id" ON "event" ("id")',
+    ],
+    [
+        # REQ filters, see `ekiden.queries`. Replay pages on (created_at, id), which replaced the (created_at) indexes
+        'DROP INDEX IF EXISTS "idx_event_created_at"',
+        'DROP INDEX IF EXISTS "idx_event_pubkey_created_at"',
+        'DROP INDEX IF EXISTS "idx_event_kind_created_at"',
+        'CREATE INDEX IF NOT EXISTS "idx_event_created_at_id" ON "event" ("created_at", "id")',
+        'CREATE INDEX IF NOT EXISTS "idx_event_pubkey_created_at_id" ON "event" ("pubkey", "created_at", "id")',
+        'CREATE INDEX IF NOT EXISTS "idx_event_kind_created_at_id" ON "event" ("kind", "created_at", "id")',
+    ],
+    [
+        # keep only the latest replaceable event per (pubkey, kind) before making the pair unique
+        f'DELETE FROM "event" WHERE {REPLACEABLE} AND "table_id" NOT IN ('
+        'SELECT "table_id" FROM (SELECT "table_id", ROW_NUMBER() OVER ('
+        'PARTITION BY "pubkey", "kind" ORDER BY "created_at" DESC, "id" ASC) AS "position" '
+        f'FROM "event" WHERE {REPLACEABLE}) WHERE "position" = 1)',
+        f'CREATE UNIQUE INDEX IF NOT EXISTS "uid_event_replaceable" ON "event" ("pubkey", "kind") WHERE {REPLACEABLE}',
+    ],
+    [
+        # REQ replay sends the stored JSON as is, see `backfill_raw` for older rows
+        'ALTER TABLE "event" ADD COLUMN "raw" TEXT',
+    ],
+]
+
+
+async def migrate():
+    """Apply the migration steps the database has not applied yet, each step in its own transaction"""
+    connection = Tortoise.get_connection("default")
+    _, rows = await connection.execute_query("PRAGMA user_version")
+    version = rows[0][0]
+
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        async with in_transaction() as transaction:
+            for statement in statements:
+                await transaction.execute_script(statement)
+            await transaction.execute_script(f"PRAGMA user_version = {number}")
+
+
+async def backfill_tags(batch_size: int = 1000) -> int:
+    """Index the tags of stored events that have no `event_tag` rows yet, e.g events stored before the table existed.
+
+    Args:
+        batch_size (int): Number of events converted per transaction
+
+    Returns:
+        int: The number of events whose tags were indexed
+    """
+    connection = Tortoise.get_connection("default")
+    backfilled = 0
+    last_id = 0
+    while True:
+        rows = await connection.execute_query_dict(
+            'SELECT "table_id", "tags" FROM "event" WHERE "table_id" > ? AND json_array_length("tags") > 0 '
+            'AND "table_id" NOT IN (SELECT "event_id" FROM "event_tag") ORDER BY "table_id" LIMIT ?',
+            [last_id, batch_size],
+        )
+        if not rows:
+            return backfilled
+
+        async with in_transaction():
+            for row in rows:
+                tags = [tag_from_record(record) for record in json.loads(row["tags"])]
+                await Event(table_id=row["table_id"]).save_tags(tags)
+
+        backfilled += len(rows)
+        last_id = rows[-1]["table_id"]
+
+
+async def backfill_raw(batch_size: int = 1000) -> int:
+    """Store the JSON of events stored before the `raw` column existed, so their replay skips rebuilding it.
+
+    Args:
+        batch_size (int): Number of events converted per transaction
+
+    Returns:
+        int: The number of events whose JSON was stored
+    """
+    connection = Tortoise.get_connection("default")
+    backfilled = 0
+    while True:
+        rows = await connection.execute_query_dict(
+            'SELECT "table_id", "id", "pubkey", "created_at", "kind", "tags", "content", "sig", "raw" FROM "event" '
+            'WHERE "raw" IS NULL LIMIT ?',
+            [batch_size],
+        )
+        if not rows:
+            return backfilled
+
+        async with in_transaction() as transaction:
+            for row in rows:
+                await transaction.execute_query(
+                    'UPDATE "event" SET "raw" = ? WHERE "table_id" = ?', [row_to_event(row).json(), row["table_id"]]
+                )
+
+        backfilled += len(rows)
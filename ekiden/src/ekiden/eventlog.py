@@ -0,0 +1,395 @@
+import asyncio
+import fcntl
+import heapq
+import logging
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, insort
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ekiden.nips import (
+    HEX_KEY_LENGTH,
+    CompactEvent,
+    Filters,
+    is_replaceable,
+    supersedes,
+)
+from ekiden.settings import settings
+from ekiden.storage import EventStore
+from ekiden.subscriptions import FilterMatcher
+
+logger = logging.getLogger(__name__)
+
+# a record is the length and crc32 of its payload followed by the payload, the event as JSON
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".log"
+# held by the process that owns the log, see `LogStore.start`
+LOCK_NAME = ".lock"
+ID_SIZE = HEX_KEY_LENGTH // 2
+
+# (created_at, raw id), REQ results are returned in descending key order
+Key = Tuple[int, bytes]
+
+
+class Segment:
+    """One file of the log, named after the sequence number of its first record and read through a memory map"""
+
+    def __init__(self, path: str, base: int):
+        self.path = path
+        self.base = base
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._map: Optional[mmap.mmap] = None
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self._map is None or offset + length > len(self._map):
+            # the active segment grew since it was mapped
+            self.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset : offset + length]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def segment_name(base: int) -> str:
+    return f"{base:020d}{SEGMENT_SUFFIX}"
+
+
+def raw_key(value: str) -> Optional[bytes]:
+    """The bytes of a hex id or pubkey, None when it is not hex"""
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return None
+
+
+def decode(payload: bytes) -> CompactEvent:
+    # the payload is the event's JSON, `CompactEvent.json`
+    return CompactEvent.load(payload.decode("utf-8"))
+
+
+class LogStore(EventStore):
+    """Events appended to segmented log files and indexed in memory.
+
+    Events are numbered by their position in the log. The indexes only hold these sequence numbers in flat arrays:
+    by id, in (created_at, id) order and in posting lists per author, kind and single letter tag, all sorted in the
+    order REQs are answered in. The indexes are rebuilt by replaying the segments at startup.
+
+    Replaced versions of replaceable events stay in the log, they are only dropped from the indexes.
+
+    The indexes are private to the process, so a log is only ever opened by a single worker.
+    """
+
+    def __init__(
+        self, directory: Optional[str] = None, segment_size: Optional[int] = None, sync: Optional[bool] = None
+    ):
+        self.directory = directory or settings.log_directory
+        self.segment_size = segment_size or settings.log_segment_size
+        self.sync = settings.log_sync if sync is None else sync
+
+        self._segments: List[Segment] = []
+        self._file = None
+        self._lock = None
+
+        # location and key of every record, indexed by sequence number
+        self._segment = array("I")
+        self._offset = array("Q")
+        self._length = array("I")
+        self._created_at = array("q")
+        self._ids = bytearray()
+        self._deleted = set()
+
+        self._by_id: Dict[bytes, int] = {}
+        # raw ids in sorted order for id prefixes, ids of new events wait in `_unsorted_ids` until a prefix lookup
+        self._sorted_ids: List[bytes] = []
+        self._unsorted_ids: List[bytes] = []
+        self._order = array("Q")
+        self._by_author: Dict[bytes, array] = {}
+        self._by_kind: Dict[int, array] = {}
+        self._by_tag: Dict[Tuple[str, str], array] = {}
+        self._replaceable: Dict[Tuple[bytes, int], int] = {}
+
+    def __len__(self) -> int:
+        return len(self._segment) - len(self._deleted)
+
+    def _key(self, seq: int) -> Key:
+        return self._created_at[seq], bytes(self._ids[seq * ID_SIZE : (seq + 1) * ID_SIZE])
+
+    async def start(self):
+        """Lock the directory and index the segments. Fails if another process has the log open, its appends would
+        interleave with ours and neither would see the other's events."""
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = open(os.path.join(self.directory, LOCK_NAME), "a")
+        try:
+            fcntl.flock(self._lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock.close()
+            self._lock = None
+            raise RuntimeError(
+                f"The event log in {self.directory} is in use by another process, the log store runs in a single worker"
+            )
+
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for position, name in enumerate(names):
+            self._segments.append(Segment(os.path.join(self.directory, name), int(name[: -len(SEGMENT_SUFFIX)])))
+            self._recover(len(self._segments) - 1, last=position == len(names) - 1)
+
+        if not self._segments:
+            self._segments.append(Segment(os.path.join(self.directory, segment_name(0)), 0))
+        self._file = open(self._segments[-1].path, "ab")
+        logger.info(f"Loaded {len(self)} events from {len(self._segments)} log segments")
+
+    def _recover(self, number: int, last: bool):
+        """Index the records of a segment. A record torn by a crash can only be at the end of the last segment, it is
+        truncated."""
+        segment = self._segments[number]
+        with open(segment.path, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, checksum = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            payload = data[start : start + length]
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            self._index(decode(payload), number, start, length)
+            offset = start + length
+
+        if offset == len(data):
+            return
+        if last:
+            logger.warning(f"Truncating {len(data) - offset} bytes of torn records at the end of {segment.path}")
+            with open(segment.path, "r+b") as f:
+                f.truncate(offset)
+            segment.size = offset
+        else:
+            logger.error(f"Skipping {len(data) - offset} corrupt bytes at the end of {segment.path}")
+
+    async def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        for segment in self._segments:
+            segment.close()
+        if self._lock is not None:
+            # closing the file releases the lock
+            self._lock.close()
+            self._lock = None
+
+    def _insert(self, postings: array, seq: int):
+        # events mostly arrive in created_at order, then the insert is an append
+        if not postings or self._key(postings[-1]) < self._key(seq):
+            postings.append(seq)
+        else:
+            insort(postings, seq, key=self._key)
+
+    def _index(self, event: CompactEvent, segment: int, offset: int, length: int):
+        seq = len(self._segment)
+        raw_id = bytes.fromhex(event.id)
+        pubkey = bytes.fromhex(event.pubkey)
+        self._segment.append(segment)
+        self._offset.append(offset)
+        self._length.append(length)
+        self._created_at.append(event.created_at)
+        self._ids += raw_id
+
+        self._by_id[raw_id] = seq
+        self._unsorted_ids.append(raw_id)
+        self._insert(self._order, seq)
+        self._insert(self._by_author.setdefault(pubkey, array("Q")), seq)
+        self._insert(self._by_kind.setdefault(event.kind, array("Q")), seq)
+        for tag in event.tags:
+            # only single letter tags are queryable (NIP-12)
+            if len(tag) > 1 and len(tag[0]) == 1:
+                self._insert(self._by_tag.setdefault((tag[0], tag[1]), array("Q")), seq)
+
+        if is_replaceable(event.kind):
+            replaced = self._replaceable.get((pubkey, event.kind))
+            if replaced is not None:
+                self._delete(replaced)
+            self._replaceable[(pubkey, event.kind)] = seq
+
+    def _delete(self, seq: int):
+        # the postings keep the sequence number, readers skip deleted ones
+        self._deleted.add(seq)
+        del self._by_id[self._key(seq)[1]]
+
+    def _supersedes(self, event: CompactEvent, seq: int) -> bool:
+        """`nips.supersedes` against a stored event without reading it"""
+        if event.created_at != self._created_at[seq]:
+            return event.created_at > self._created_at[seq]
+        return bytes.fromhex(event.id) < self._key(seq)[1]
+
+    def read(self, seq: int) -> CompactEvent:
+        return decode(self._segments[self._segment[seq]].read(self._offset[seq], self._length[seq]))
+
+    async def _flush(self):
+        self._file.flush()
+        if self.sync:
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, self._file.fileno())
+
+    async def _roll(self, base: int):
+        """Start a new segment, `base` is the sequence number of its first record"""
+        await self._flush()
+        self._file.close()
+        self._segments.append(Segment(os.path.join(self.directory, segment_name(base)), base))
+        self._file = open(self._segments[-1].path, "ab")
+
+    async def commit(self, events: List[CompactEvent]) -> List[bool]:
+        """Appends the batch with one flush, the events are indexed, and visible to REQs, once they are durable"""
+        results = []
+        staged: List[Tuple[CompactEvent, int, int, int]] = []
+        staged_ids = set()
+        # the newest replaceable event of the batch per (pubkey, kind)
+        newest: Dict[Tuple[str, int], CompactEvent] = {}
+
+        for event in events:
+            raw_id = bytes.fromhex(event.id)
+            if raw_id in self._by_id or raw_id in staged_ids:
+                results.append(False)
+                continue
+
+            if is_replaceable(event.kind):
+                other = newest.get((event.pubkey, event.kind))
+                if other is not None:
+                    stored = supersedes(event, other)
+                else:
+                    seq = self._replaceable.get((bytes.fromhex(event.pubkey), event.kind))
+                    stored = seq is None or self._supersedes(event, seq)
+                if not stored:
+                    results.append(False)
+                    continue
+                newest[(event.pubkey, event.kind)] = event
+
+            payload = event.json().encode("utf-8")
+            segment = self._segments[-1]
+            if segment.size and segment.size + RECORD_HEADER.size + len(payload) > self.segment_size:
+                # the staged events are numbered after the indexed ones
+                await self._roll(len(self._segment) + len(staged))
+                segment = self._segments[-1]
+
+            self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            staged.append((event, len(self._segments) - 1, segment.size + RECORD_HEADER.size, len(payload)))
+            segment.size += RECORD_HEADER.size + len(payload)
+            staged_ids.add(raw_id)
+            results.append(True)
+
+        if staged:
+            await self._flush()
+            for event, segment, offset, length in staged:
+                self._index(event, segment, offset, length)
+        return results
+
+    def _id_prefix(self, prefix: str) -> Iterator[int]:
+        """The sequence numbers of the stored events whose id starts with the hex prefix, found by bisecting the
+        sorted ids like `queries.prefix_upper_bound` bounds the SQL range"""
+        # the unsorted ids are merged in once they are a fair share of the index, until then they are scanned
+        if len(self._unsorted_ids) > max(1024, len(self._sorted_ids) // 16):
+            self._sorted_ids += self._unsorted_ids
+            self._sorted_ids.sort()
+            self._unsorted_ids.clear()
+
+        # an odd length prefix covers a range of its last byte
+        low = raw_key(prefix.ljust(len(prefix) + len(prefix) % 2, "0"))
+        high = raw_key(prefix.ljust(len(prefix) + len(prefix) % 2, "f"))
+        if low is None or high is None:
+            return
+
+        position = bisect_left(self._sorted_ids, low)
+        while position < len(self._sorted_ids) and self._sorted_ids[position][: len(high)] <= high:
+            seq = self._by_id.get(self._sorted_ids[position])
+            if seq is not None:
+                yield seq
+            position += 1
+        for raw_id in self._unsorted_ids:
+            if low <= raw_id[: len(low)] <= high and raw_id in self._by_id:
+                yield self._by_id[raw_id]
+
+    def _sources(self, matcher: FilterMatcher) -> Optional[List[array]]:
+        """The posting lists of the most selective indexed filter, None when every event has to be scanned"""
+        if matcher.ids:
+            seqs = {self._by_id[raw_id] for raw_id in map(raw_key, matcher.ids.exact) if raw_id in self._by_id}
+            for prefix in matcher.ids.prefixes:
+                seqs.update(self._id_prefix(prefix))
+            return [array("Q", sorted(seqs, key=self._key))]
+
+        empty = array("Q")
+        candidates = []
+        if matcher.authors.prefixes:
+            # one pass over the authors is still far cheaper than a pass over the events
+            candidates.append(
+                [postings for pubkey, postings in self._by_author.items() if pubkey.hex() in matcher.authors]
+            )
+        elif matcher.authors:
+            candidates.append([self._by_author.get(raw_key(value), empty) for value in matcher.authors.exact])
+        if matcher.event_ids:
+            candidates.append([self._by_tag.get(("e", value), empty) for value in matcher.event_ids])
+        if matcher.pubkeys:
+            candidates.append([self._by_tag.get(("p", value), empty) for value in matcher.pubkeys])
+        if matcher.kinds:
+            candidates.append([self._by_kind.get(kind, empty) for kind in matcher.kinds])
+        if not candidates:
+            return None
+        return min(candidates, key=lambda postings: sum(map(len, postings)))
+
+    def _descending(self, postings: array, low: Key, high: Key) -> Iterator[int]:
+        """The sequence numbers in `postings` with low <= key < high, newest first"""
+        position = bisect_left(postings, high, key=self._key)
+        while position > 0:
+            position -= 1
+            seq = postings[position]
+            if self._key(seq) < low:
+                return
+            yield seq
+
+    def _page(self, matcher: FilterMatcher, size: int, after: Optional[Key]) -> List[CompactEvent]:
+        # since and until are exclusive
+        low: Key = (-(2**63), b"") if matcher.since is None else (matcher.since + 1, b"")
+        high: Key = (2**63, b"") if matcher.until is None else (matcher.until, b"")
+        if after is not None:
+            high = min(high, after)
+
+        sources = self._sources(matcher)
+        if sources is None:
+            sources = [self._order]
+        seqs: Iterable[int] = heapq.merge(
+            *(self._descending(postings, low, high) for postings in sources), key=self._key, reverse=True
+        )
+
+        events = []
+        previous = None
+        for seq in seqs:
+            # an event can be in several of the merged posting lists
+            if seq == previous or seq in self._deleted:
+                continue
+            previous = seq
+            event = self.read(seq)
+            if matcher.matches(event):
+                events.append(event)
+                if len(events) == size:
+                    break
+        return events
+
+    async def stream(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[CompactEvent]]:
+        """Pages through the indexes like `queries.stream`, each page continues below the key of the last event sent"""
+        matcher = FilterMatcher(filters)
+        after: Optional[Key] = None
+        while limit > 0:
+            events = self._page(matcher, min(chunk_size, limit), after)
+            if not events:
+                return
+
+            yield events
+
+            limit -= len(events)
+            if len(events) < chunk_size:
+                return
+            after = (events[-1].created_at, bytes.fromhex(events[-1].id))
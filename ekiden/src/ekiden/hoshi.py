@@ -1,19 +1,57 @@
+import asyncio
+import json
 import logging
+import time
+from typing import List, Optional, Set
 
+from pydantic import ValidationError
 from starlette.websockets import WebSocket, WebSocketDisconnect
 from tortoise.transactions import atomic
 
-from ekiden import database
-from ekiden.nips import Filters
-from ekiden.relay import AsyncRelay
+from ekiden import metrics
+from ekiden.connections import Connection
+from ekiden.nips import HEX_KEY_LENGTH, Filters
+from ekiden.pipeline import FramePipeline
+from ekiden.relay import AsyncRelay, notice, ok
+from ekiden.settings import settings
 from ekiden.subscriptions import Subscription, SubscriptionPool
 
 logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def longest_list(filters: Filters) -> int:
+    """The number of values in the longest list of the filters, each value is bound as a parameter of its query"""
+    return max(
+        len(values or ())
+        for values in (filters.ids, filters.authors, filters.kinds, filters.event_ids, filters.pubkeys)
+    )
+
+
+# `CompactEvent.json` starts with the id of the event
+ID_PREFIX = '{"id":"'
+
+
+def json_event_id(event_json: str) -> str:
+    """The id of an event from its JSON, the JSON written by `CompactEvent.json` is not decoded for it"""
+    if event_json.startswith(ID_PREFIX):
+        return event_json[len(ID_PREFIX) : len(ID_PREFIX) + HEX_KEY_LENGTH]
+    return json.loads(event_json)["id"]
+
+
+def replay_limit(filters: Filters) -> int:
+    """The number of stored events replayed for a filter: the default without a limit, else its limit within bounds"""
+    if filters.limit is None:
+        return settings.request_default_limit
+    return max(0, min(filters.limit, settings.request_max_limit))
 
 
 class Hoshi:
     sub_pool = SubscriptionPool()
     relay = AsyncRelay(sub_pool=sub_pool)
+    connections: Set[Connection] = set()
+    # storage pages being fetched for REQ replays across the relay
+    query_slots = asyncio.Semaphore(settings.max_concurrent_queries)
 
     async def __call__(self, scope, receive, send):
         websocket = WebSocket(scope=scope, receive=receive, send=send)
@@ -21,50 +59,177 @@ class Hoshi:
 
     async def endpoint(self, websocket: WebSocket):
         await websocket.accept()
+        connection = Connection(websocket)
+        self.connections.add(connection)
+        pipeline = FramePipeline()
         try:
             while True:
-                match await websocket.receive_json():
-                    case ["EVENT", message]:
-                        await self.handle_event(websocket=websocket, message=message)
-                    case ["REQ", subscription_id, filters_dict]:
-                        await self.handle_request(
-                            websocket=websocket, subscription_id=subscription_id, filters_dict=filters_dict
-                        )
-                    case ["CLOSE", subscription_id]:
-                        await self.handle_close(websocket)
-
+                # the frame is only referenced by `handle_frame`, a connection idling after it does not keep it
+                await self.handle_frame(connection, pipeline, await websocket.receive_text())
         except WebSocketDisconnect:
-            await self.handle_disconnect(websocket)
+            pass
+        finally:
+            await pipeline.close()
+            await self.handle_disconnect(connection)
+            self.connections.discard(connection)
+            await connection.close()
 
-    async def handle_event(self, websocket: WebSocket, message: dict):
+    async def handle_frame(self, connection: Connection, pipeline: FramePipeline, text: str):
+        if settings.max_message_size and len(text) > settings.max_message_size:
+            metrics.frames_oversized.inc()
+            await connection.send(notice("invalid: message is too large"))
+            return
+
+        try:
+            message = self.decode(text)
+        except ValueError:
+            await connection.send(notice("invalid: message is not valid JSON"))
+            return
+
+        # frames are handled concurrently, only the OKs keep the order of their EVENTs
+        match message:
+            case ["EVENT", message]:
+                await pipeline.ordered(self.handle_event(connection=connection, message=message), connection.send)
+            case ["REQ", str() as subscription_id, *filters_dicts]:
+                await pipeline.replay(
+                    subscription_id,
+                    self.handle_request(
+                        connection=connection, subscription_id=subscription_id, filters_dicts=filters_dicts
+                    ),
+                )
+            case ["CLOSE", str() as subscription_id]:
+                # handled before the next frame is read, a REQ after it is not affected
+                await pipeline.cancel(subscription_id)
+                await self.handle_close(connection, subscription_id)
+
+    @staticmethod
+    def decode(text: str):
+        started = time.perf_counter()
+        try:
+            return json.loads(text)
+        except ValueError:
+            metrics.decode_errors.inc()
+            raise
+        finally:
+            metrics.decode_seconds.observe(time.perf_counter() - started)
+
+    async def handle_event(self, connection: Connection, message: dict) -> str:
         #     """
-        #     used to publish events
+        #     used to publish events, returns the OK frame
         #     """
-        response = await self.relay.event(message)
-        await websocket.send_text(response)
+        if not connection.limits.events.take():
+            metrics.rate_limited.inc()
+            event_id = message.get("id", "") if isinstance(message, dict) else ""
+            return ok(event_id, False, "rate-limited: slow down")
+
+        return await self.relay.event(message)
 
-    async def handle_request(self, websocket: WebSocket, subscription_id: str, filters_dict: dict):
+    async def handle_request(self, connection: Connection, subscription_id: str, filters_dicts: List[dict]):
         """
-        used to request events and subscribe to new updates
+        used to request events and subscribe to new updates, an event matching any of the filters is sent
         """
-        sub = Subscription(
-            filters=Filters.parse_obj(filters_dict),
-            websocket=websocket,
-            subscription_id=subscription_id,
-        )
-        await self.sub_pool.add_subscription(subscription=sub)
-        # set sane cap
-        limit = sub.filters.limit if sub.filters.limit else 100
-        for event in await database.Event.all().limit(limit):
-            await sub.send(event.nipple())
-
-    async def handle_close(self, websocket: WebSocket):
+        if not connection.limits.requests.take():
+            metrics.rate_limited.inc()
+            await connection.send(notice(f"rate-limited: slow down, REQ {subscription_id} was ignored"))
+            return
+        if not 0 < len(filters_dicts) <= settings.max_filters:
+            await connection.send(notice(f"invalid: REQ {subscription_id} needs 1 to {settings.max_filters} filters"))
+            return
+
+        # the parsed filters are only kept for the replay, the subscription keeps their compiled matchers
+        try:
+            filters = [Filters.parse_obj(filters_dict) for filters_dict in filters_dicts]
+        except ValidationError:
+            await connection.send(notice(f"invalid: REQ {subscription_id} has malformed filters"))
+            return
+        if any(longest_list(f) > settings.max_filter_values for f in filters):
+            await connection.send(
+                notice(f"invalid: REQ {subscription_id} has more than {settings.max_filter_values} values in a filter")
+            )
+            return
+        sub = Subscription(filters=filters, connection=connection, subscription_id=subscription_id)
+        if not self.sub_pool.add_subscription(subscription=sub, limit=settings.max_subscriptions):
+            metrics.rate_limited.inc()
+            await connection.send(notice(f"rate-limited: too many subscriptions, REQ {subscription_id} was ignored"))
+            return
+
+        # every filter is replayed up to its own limit, a limit of 0 only subscribes to new events
+        limits = [replay_limit(f) for f in filters]
+        recents = [self.relay.query(matcher, limit) if limit else [] for matcher, limit in zip(sub.matchers, limits)]
+        from_storage = any(recent is None for recent in recents)
+        if from_storage and self.query_slots.locked():
+            metrics.rate_limited.inc()
+            self.sub_pool.remove_subscription(connection, subscription_id)
+            await connection.send(notice(f"rate-limited: relay is busy, REQ {subscription_id} was ignored"))
+            return
+
+        started = time.perf_counter()
+        replayed = 0
+        # an event matching several filters is only sent once, a single filter never returns an event twice
+        sent: Optional[Set[str]] = set() if len(filters) > 1 else None
+
+        async def send(event_json: str, event_id: Optional[str] = None):
+            nonlocal replayed
+            if sent is not None:
+                event_id = event_id or json_event_id(event_json)
+                if event_id in sent:
+                    return
+                sent.add(event_id)
+            replayed += 1
+            await sub.send_json(event_json)
+
+        if from_storage:
+            metrics.request_storage.inc()
+        else:
+            metrics.request_recent.inc()
+        for f, limit, recent in zip(filters, limits, recents):
+            if recent is not None:
+                for event in recent:
+                    await send(event.json(), event.id)
+                continue
+
+            # the stored JSON goes into the frames as is. A slot is only held while a page is fetched, a client
+            # slow to read its events holds up its own REQ and not the replays of others
+            chunks = self.relay.storage.stream_json(f, limit, chunk_size=settings.request_chunk_size)
+            try:
+                while not connection.closed:
+                    async with self.query_slots:
+                        chunk = await anext(chunks, None)
+                    if chunk is None:
+                        break
+                    for event_json in chunk:
+                        await send(event_json)
+            except Exception as e:
+                logger.error(f"Replay of REQ {subscription_id} failed: {e!r}")
+                self.sub_pool.remove_subscription(connection, subscription_id)
+                await connection.send(notice(f"error: could not replay REQ {subscription_id}, it was closed"))
+                return
+            finally:
+                await chunks.aclose()
+
+        metrics.request_seconds.observe(time.perf_counter() - started)
+        metrics.request_events.observe(replayed)
+        await sub.end_of_stored_events()
+
+    async def handle_close(self, connection: Connection, subscription_id: str):
         #     """
         #     used to stop previous subscriptions
         #     """
-        await self.handle_disconnect(websocket)
+        self.sub_pool.remove_subscription(connection, subscription_id)
+
+    async def handle_disconnect(self, connection: Connection):
+        self.sub_pool.remove_connection(connection)
+
 
-    async def handle_disconnect(self, websocket: WebSocket):
-        subscription = await self.sub_pool.get_subscription(websocket=websocket)
-        if subscription:
-            await self.sub_pool.remove_subscription(subscription)
+metrics.registry.gauge("ekiden_connections", "Open websocket connections", lambda: len(Hoshi.connections))
+metrics.registry.gauge("ekiden_subscriptions", "Open subscriptions", lambda: len(Hoshi.sub_pool))
+metrics.registry.gauge(
+    "ekiden_outbound_queue_depth",
+    "Frames waiting in the outbound queues of every connection",
+    lambda: sum(connection.queue_depth for connection in Hoshi.connections),
+)
+metrics.registry.gauge(
+    "ekiden_outbound_queue_depth_max",
+    "Frames waiting in the fullest outbound queue",
+    lambda: max((connection.queue_depth for connection in Hoshi.connections), default=0),
+)
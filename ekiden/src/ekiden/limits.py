@@ -0,0 +1,76 @@
+import time
+from typing import Hashable, Optional
+
+from ekiden.cache import LRUCache
+from ekiden.settings import settings
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average and bursts of up to `burst`. A rate of 0 or less never limits."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        """Take a token if one is available.
+
+        Returns:
+            bool: True if the operation is allowed, else False.
+        """
+        if self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class KeyedBuckets:
+    """A token bucket per key, e.g per pubkey, for the `maxsize` most recently limited keys"""
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: LRUCache[Hashable, TokenBucket] = LRUCache(maxsize=maxsize)
+
+    def take(self, key: Hashable) -> bool:
+        if self.rate <= 0:
+            return True
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.put(key, bucket)
+        return bucket.take()
+
+
+class ConnectionLimits:
+    """The EVENT and REQ budgets of a single connection"""
+
+    __slots__ = ("events", "requests")
+
+    def __init__(
+        self,
+        event_rate: Optional[float] = None,
+        event_burst: Optional[int] = None,
+        request_rate: Optional[float] = None,
+        request_burst: Optional[int] = None,
+    ):
+        self.events = TokenBucket(
+            event_rate if event_rate is not None else settings.event_rate,
+            event_burst or settings.event_burst,
+        )
+        self.requests = TokenBucket(
+            request_rate if request_rate is not None else settings.request_rate,
+            request_burst or settings.request_burst,
+        )
@@ -2,31 +2,39 @@ import asyncio
 import logging
 
 from starlette.applications import Starlette
-from starlette.routing import WebSocketRoute
-from tortoise import Tortoise
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route, WebSocketRoute
 from tortoise.functions import Count
 from tortoise.transactions import atomic
 
 from ekiden import database as db
+from ekiden import metrics
 from ekiden.hoshi import Hoshi
+from ekiden.settings import settings
 
 logging.basicConfig(level=logging.INFO)
 
 
 async def startup():
-    await Tortoise.init(db_url="sqlite://ekiden.sqlite3", modules={"models": ["ekiden.database"]})
-    await Tortoise.generate_schemas()
+    await Hoshi.relay.start()
 
 
 async def shutdown():
-    await Tortoise.close_connections()
+    await Hoshi.relay.close()
+
+
+async def metrics_endpoint(request: Request):
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 
 def create_app():
+    routes = [WebSocketRoute(path="/", endpoint=Hoshi())]
+    if settings.metrics_path:
+        routes.append(Route(path=settings.metrics_path, endpoint=metrics_endpoint))
+
     return Starlette(
-        routes=[
-            WebSocketRoute(path="/", endpoint=Hoshi()),
-        ],
+        routes=routes,
         on_startup=[startup],
         on_shutdown=[shutdown],
     )
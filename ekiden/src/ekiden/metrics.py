@@ -0,0 +1,159 @@
+from bisect import bisect_left
+from typing import Callable, List, Optional, Sequence
+
+# seconds, from a dict lookup to a slow disk
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# events or frames handled by one operation
+SIZE_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    """A monotonically increasing count"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {format_value(self.value)}"]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, read from `function` at scrape time when one is given"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help)
+        self.value = 0
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def samples(self) -> List[str]:
+        value = self.function() if self.function else self.value
+        return [f"{self.name} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    """Observations counted in fixed buckets.
+
+    An observation is one bisect and two additions, the cumulative bucket counts are only summed at scrape time.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        # the last slot counts observations above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self) -> List[str]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            cumulative += count
+            samples.append(f'{self.name}_bucket{{le="{format_value(float(bound))}"}} {cumulative}')
+        samples.append(f"{self.name}_sum {format_value(self.sum)}")
+        samples.append(f"{self.name}_count {cumulative}")
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.register(Counter(name, help))
+
+    def gauge(self, name: str, help: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry = Registry()
+
+# ingest
+decode_seconds = registry.histogram("ekiden_decode_seconds", "Time to decode a client frame from JSON")
+decode_errors = registry.counter("ekiden_decode_errors_total", "Client frames that were not valid JSON")
+frames_oversized = registry.counter(
+    "ekiden_frames_oversized_total", "Client frames dropped for exceeding the size limit"
+)
+events_received = registry.counter("ekiden_events_received_total", "EVENT messages received")
+events_accepted = registry.counter("ekiden_events_accepted_total", "Events stored and broadcast")
+events_duplicate = registry.counter("ekiden_events_duplicate_total", "Events answered as duplicates")
+events_rejected = registry.counter("ekiden_events_rejected_total", "Events refused as invalid or not stored")
+verify_seconds = registry.histogram("ekiden_verify_seconds", "Time from submitting an event to its verification result")
+write_seconds = registry.histogram("ekiden_write_seconds", "Time from queueing an event for storage to its commit")
+commit_seconds = registry.histogram("ekiden_commit_seconds", "Duration of a group commit transaction")
+commit_events = registry.histogram("ekiden_commit_events", "Events written by a group commit", SIZE_BUCKETS)
+
+# fan out
+broadcast_seconds = registry.histogram("ekiden_broadcast_seconds", "Duration of a broadcast to the subscriptions")
+broadcast_fanout = registry.histogram("ekiden_broadcast_fanout", "Frames queued by a broadcast", SIZE_BUCKETS)
+frames_dropped = registry.counter("ekiden_frames_dropped_total", "Frames dropped or refused by full outbound queues")
+
+# requests
+request_seconds = registry.histogram("ekiden_request_seconds", "Time to replay the stored events of a REQ")
+request_events = registry.histogram("ekiden_request_events", "Stored events replayed for a REQ", SIZE_BUCKETS)
+request_recent = registry.counter("ekiden_request_recent_total", "REQs answered from memory without querying storage")
+request_storage = registry.counter("ekiden_request_storage_total", "REQs answered from storage")
+recent_hits = registry.counter("ekiden_recent_hits_total", "Filters answered from the recent events window")
+recent_misses = registry.counter("ekiden_recent_misses_total", "Filters the recent events window left to storage")
+replaceable_hits = registry.counter(
+    "ekiden_replaceable_hits_total", "Filters for the replaceable events of given authors answered from their cache"
+)
+read_wait_seconds = registry.histogram("ekiden_read_wait_seconds", "Time a REQ query waited for a SQLite reader")
+
+# admission control
+rate_limited = registry.counter("ekiden_rate_limited_total", "EVENTs and REQs refused by the rate limits")
@@ -4,12 +4,15 @@ import json
 import time
 from enum import IntEnum
 from hashlib import sha256
-from typing import List, Optional, Tuple
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 from ekiden.keys import PrivateKey, PublicKey, VerificationError
 
+# length of a full hex encoded id or pubkey, shorter filter values are prefixes
+HEX_KEY_LENGTH = 64
+
 
 def dump_json(obj) -> str:
     return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
@@ -22,6 +25,21 @@ class Kind(IntEnum):
     contact_list = 3
 
 
+def is_replaceable(kind: int) -> bool:
+    """
+    Only the latest event per pubkey and kind is kept for replaceable kinds:
+    metadata (NIP-1), contact lists (NIP-2) and the NIP-16 replaceable range.
+    """
+    return kind == Kind.set_metadata or kind == Kind.contact_list or 10000 <= kind < 20000
+
+
+def supersedes(event, other) -> bool:
+    """Whether `event` replaces `other`, the newer one wins and ties go to the lowest id"""
+    if event.created_at != other.created_at:
+        return event.created_at > other.created_at
+    return event.id < other.id
+
+
 class Tag(BaseModel):
     def json_array(self):
         raise NotImplemented("json_array is not implemented!")
@@ -52,14 +70,22 @@ class PTag(Tag):
 
 
 def create_tag(tag_info) -> Tag:
+    # the relay url is optional, e.g `["p", <pubkey>]`
+    if len(tag_info) < 2:
+        raise UnknownTagError(f"Could not parse tag {tag_info}")
+    relay_url = tag_info[2] if len(tag_info) > 2 else ""
     if tag_info[0] == "e":
-        return ETag(id=tag_info[1], recommended_relay_url=tag_info[2])
+        return ETag(id=tag_info[1], recommended_relay_url=relay_url)
     elif tag_info[0] == "p":
-        return PTag(pubkey=tag_info[1], recommended_relay_url=tag_info[2])
+        return PTag(pubkey=tag_info[1], recommended_relay_url=relay_url)
 
     raise UnknownTagError(f"Could not parse tag {tag_info}")
 
 
+# fields covered by the event id, changing any of them invalidates the cached serialization
+SERIALIZED_FIELDS = frozenset(["pubkey", "created_at", "kind", "tags", "content"])
+
+
 class Event(BaseModel):
     # NIP-1
 
@@ -71,6 +97,35 @@ class Event(BaseModel):
 
     sig: Optional[str] = None
 
+    _serialized: Optional[str] = PrivateAttr(default=None)
+    _id: Optional[str] = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in SERIALIZED_FIELDS:
+            self._serialized = None
+            self._id = None
+
+    def serialized(self) -> str:
+        """The canonical serialization of the event, computed once and cached until a serialized field is reassigned."""
+        if self._serialized is None:
+            self._serialized = Event.serialize(
+                pubkey=self.pubkey,
+                created_at=self.created_at,
+                kind=self.kind,
+                tags=[tag.json_array() for tag in self.tags],
+                content=self.content,
+            )
+        return self._serialized
+
+    def tag_values(self, name: str) -> FrozenSet[str]:
+        """The values of every `name` tag, e.g the referenced event ids for `e`"""
+        if name == "e":
+            return frozenset(tag.id for tag in self.tags if isinstance(tag, ETag))
+        if name == "p":
+            return frozenset(tag.pubkey for tag in self.tags if isinstance(tag, PTag))
+        return frozenset()
+
     @property
     def id(self) -> str:
         """
@@ -86,16 +141,11 @@ class Event(BaseModel):
         <content, as a string>
         ]`
 
+        The id is computed once and cached alongside the serialization.
         """
-        return sha256(
-            Event.serialize(
-                pubkey=self.pubkey,
-                created_at=self.created_at,
-                kind=self.kind,
-                tags=[tag.json_array() for tag in self.tags],
-                content=self.content,
-            ).encode("utf-8")
-        ).hexdigest()
+        if self._id is None:
+            self._id = sha256(self.serialized().encode("utf-8")).hexdigest()
+        return self._id
 
     def sign(self, private_key: str) -> str:
         """Signs the messge (Event.id) and sets the sig field
@@ -154,6 +204,149 @@ class Event(BaseModel):
         }
 
 
+class CompactEvent:
+    """
+    Read-only event used on the relay's hot path.
+
+    Unlike `Event` it carries no pydantic machinery, tags are kept as tuples of strings and the serialization and id
+    are computed at most once per instance.
+    """
+
+    __slots__ = (
+        "pubkey",
+        "created_at",
+        "kind",
+        "tags",
+        "content",
+        "sig",
+        "_serialized",
+        "_id",
+        "_tag_values",
+        "_json",
+    )
+
+    def __init__(
+        self,
+        pubkey: str,
+        created_at: int,
+        kind: int,
+        tags: Tuple[Tuple[str, ...], ...],
+        content: str,
+        sig: Optional[str] = None,
+    ):
+        self.pubkey = pubkey
+        self.created_at = created_at
+        self.kind = kind
+        self.tags = tags
+        self.content = content
+        self.sig = sig
+        self._serialized: Optional[str] = None
+        self._id: Optional[str] = None
+        self._tag_values: Optional[Dict[str, FrozenSet[str]]] = None
+        self._json: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, event: Dict[str, Any]) -> CompactEvent:
+        return cls(
+            pubkey=event["pubkey"],
+            created_at=event["created_at"],
+            kind=event["kind"],
+            tags=tuple(compact_tag(tag_info) for tag_info in event["tags"]),
+            content=event["content"],
+            sig=event.get("sig"),
+        )
+
+    @classmethod
+    def load(cls, text: str) -> CompactEvent:
+        """
+        Rebuild an event the relay stored or relayed from its JSON.
+
+        The id is trusted, it was checked when the event was accepted, and the text is kept as the event's JSON.
+        """
+        data = json.loads(text)
+        event = cls.from_dict(data)
+        event._id = data["id"]
+        event._json = text
+        return event
+
+    @classmethod
+    def verify(cls, event: Dict[str, Any]) -> CompactEvent:
+        """
+        Verify the contents of the event with the signature and fields given.
+
+        The id is recomputed from the event fields and must match the claimed id before the signature is checked.
+        Returns a new instance with the provided information if successful else raises a VerificationError
+        """
+        compact = cls.from_dict(event)
+        if compact.id != event["id"]:
+            raise VerificationError("id does not match the contents of the event")
+
+        ret = PublicKey(compact.pubkey).verify(msg=bytes.fromhex(compact.id), signature=compact.sig)
+        if not ret:
+            raise VerificationError("contents of the message could not be verified with the signature provided")
+        return compact
+
+    def serialized(self) -> str:
+        if self._serialized is None:
+            self._serialized = Event.serialize(
+                pubkey=self.pubkey,
+                created_at=self.created_at,
+                kind=self.kind,
+                tags=self.tags,
+                content=self.content,
+            )
+        return self._serialized
+
+    @property
+    def id(self) -> str:
+        if self._id is None:
+            self._id = sha256(self.serialized().encode("utf-8")).hexdigest()
+        return self._id
+
+    def tag_values(self, name: str) -> FrozenSet[str]:
+        """The values of every `name` tag, the tags are grouped by name once on first use"""
+        if self._tag_values is None:
+            grouped: Dict[str, set] = {}
+            for tag in self.tags:
+                if len(tag) > 1:
+                    grouped.setdefault(tag[0], set()).add(tag[1])
+            self._tag_values = {name: frozenset(values) for name, values in grouped.items()}
+        return self._tag_values.get(name, frozenset())
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "pubkey": self.pubkey,
+            "created_at": self.created_at,
+            "kind": self.kind,
+            "tags": [list(tag) for tag in self.tags],
+            "content": self.content,
+            "sig": self.sig,
+        }
+
+    def json(self) -> str:
+        """The signed event as compact JSON, the text stored and sent in EVENT frames, serialized at most once"""
+        if self._json is None:
+            self._json = dump_json(self.dict())
+        return self._json
+
+
+def compact_tag(tag_info) -> Tuple[str, ...]:
+    """Keeps the tag exactly as it was sent, its elements are part of the event id.
+
+    Any tag name is accepted, `e` and `p` tags need a value.
+    """
+    if not tag_info or not all(isinstance(element, str) for element in tag_info):
+        raise UnknownTagError(f"Could not parse tag {tag_info}")
+    if tag_info[0] in ("e", "p") and len(tag_info) < 2:
+        raise UnknownTagError(f"Could not parse tag {tag_info}")
+
+    return tuple(tag_info)
+
+
+AnyEvent = Union[Event, CompactEvent]
+
+
 class Filters(BaseModel):
     # NIP-1
     # each field is considered a `filter`. multiple filters are or conditions (e.g only one has to pass for the event to be valid)
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Optional, Set
+
+from ekiden.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FramePipeline:
+    """Handles the frames of one connection concurrently.
+
+    Every frame runs in its own task, so a long REQ replay does not hold up the EVENTs and CLOSEs sent after it. At
+    most `max_in_flight` frames are handled at once, reading the next frame waits for a free slot, which pushes back
+    on a client sending faster than the relay handles its frames.
+
+    Responses that have to keep the order of their frames, the OKs of EVENTs, go through `ordered`. Replays are kept
+    by subscription id, so a CLOSE or a new REQ with the same id can cancel them.
+    """
+
+    __slots__ = ("_slots", "_tasks", "_replays", "_previous")
+
+    def __init__(self, max_in_flight: Optional[int] = None):
+        self._slots = asyncio.Semaphore(max_in_flight or settings.max_frames_in_flight)
+        self._tasks: Set[asyncio.Task] = set()
+        self._replays: Dict[str, asyncio.Task] = {}
+        # set once the previous ordered response was sent
+        self._previous: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def spawn(self, coroutine: Coroutine) -> asyncio.Task:
+        """Run the handler of a frame, waiting for a free slot first"""
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Frame handler failed: {task.exception()!r}")
+
+    async def ordered(self, response: Coroutine[Any, Any, str], send: Callable[[str], Awaitable[None]]):
+        """Spawn a handler whose response is only sent after the responses of the ordered frames read before it.
+
+        Args:
+            response (Coroutine[Any, Any, str]): Handles the frame and returns the response
+            send (Callable[[str], Awaitable[None]]): Sends the response
+        """
+        previous = self._previous
+        sent = self._previous = asyncio.Event()
+
+        async def respond():
+            frame = await response
+            if previous is not None:
+                await previous.wait()
+            await send(frame)
+
+        try:
+            task = await self.spawn(respond())
+        except BaseException:
+            response.close()
+            raise
+        # a failed or cancelled handler must not hold up the responses after it
+        task.add_done_callback(lambda _: sent.set())
+
+    async def replay(self, subscription_id: str, handler: Coroutine):
+        """Spawn the handler of a REQ, cancelling the replay of an earlier REQ with the same subscription id"""
+        try:
+            await self.cancel(subscription_id)
+        except BaseException:
+            handler.close()
+            raise
+        task = await self.spawn(handler)
+        self._replays[subscription_id] = task
+        task.add_done_callback(lambda _: self._forget(subscription_id, task))
+
+    def _forget(self, subscription_id: str, task: asyncio.Task):
+        # a later REQ with the same id may have replaced the task already
+        if self._replays.get(subscription_id) is task:
+            del self._replays[subscription_id]
+
+    async def cancel(self, subscription_id: str):
+        """Cancel the replay of a subscription and wait until it stopped, nothing is sent for it afterwards"""
+        task = self._replays.pop(subscription_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def close(self):
+        """Cancel the replays and wait for the other handlers to finish.
+
+        The client is gone, so nothing is replayed to it anymore, but the EVENTs it sent are still stored and
+        broadcast: cancelling a handler mid-write would leave an event committed that no subscriber ever sees.
+        """
+        for task in self._replays.values():
+            task.cancel()
+        self._replays.clear()
+        tasks = list(self._tasks)
+        if tasks:
+            await asyncio.wait(tasks)
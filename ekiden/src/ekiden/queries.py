@@ -0,0 +1,156 @@
+from sqlite3 import Row
+from typing import Any, AsyncIterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from ekiden import database
+from ekiden.nips import HEX_KEY_LENGTH, CompactEvent, Filters
+from ekiden.readers import ReaderPool
+
+EVENT_COLUMNS = '"id", "pubkey", "created_at", "kind", "tags", "content", "sig", "raw"'
+
+
+class Query(NamedTuple):
+    sql: str
+    params: List[Any]
+
+
+def prefix_upper_bound(prefix: str) -> str:
+    """The smallest string greater than every string starting with `prefix`"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def placeholders(count: int) -> str:
+    return ", ".join("?" * count)
+
+
+# conditions joined by one flat OR, SQLite limits the depth of an expression tree to 1000
+MAX_FLAT_CONDITIONS = 64
+
+
+def any_of(conditions: Sequence[str]) -> str:
+    """Join the conditions with OR, nesting long lists as a balanced tree to keep the expression shallow"""
+    if len(conditions) <= MAX_FLAT_CONDITIONS:
+        return f"({' OR '.join(conditions)})"
+    middle = len(conditions) // 2
+    return f"({any_of(conditions[:middle])} OR {any_of(conditions[middle:])})"
+
+
+def prefix_clause(column: str, values: Sequence[str], params: List[Any]) -> str:
+    """Match full values with an IN list and prefixes with index friendly range comparisons"""
+    exact = [value for value in values if len(value) >= HEX_KEY_LENGTH]
+    prefixes = [value for value in values if 0 < len(value) < HEX_KEY_LENGTH]
+
+    conditions = []
+    if exact:
+        conditions.append(f'"{column}" IN ({placeholders(len(exact))})')
+        params.extend(exact)
+    for prefix in prefixes:
+        conditions.append(f'("{column}" >= ? AND "{column}" < ?)')
+        params.extend([prefix, prefix_upper_bound(prefix)])
+
+    return any_of(conditions) if conditions else "1"
+
+
+def tag_clause(name: str, values: Sequence[str], params: List[Any]) -> str:
+    """Match events with at least one `name` tag whose value is one of the values, using the `event_tag` index"""
+    params.append(name)
+    params.extend(values)
+    return (
+        f'"table_id" IN (SELECT "event_id" FROM "event_tag" '
+        f'WHERE "name" = ? AND "value" IN ({placeholders(len(values))}))'
+    )
+
+
+# (created_at, id) of the last event of a page, the next page starts right after it
+Cursor = Tuple[int, str]
+
+
+def plan(filters: Filters, limit: int, after: Optional[Cursor] = None) -> Query:
+    """Translate the filters into a query returning the newest `limit` matching events.
+
+    Events are ordered by (created_at, id) descending, so a page can be continued from the key of its last event.
+
+    Args:
+        filters (Filters): The filters of the request
+        limit (int): The maximum number of events to return
+        after (Optional[Cursor]): Only return events ordered after this key
+
+    Returns:
+        Query: The SQL and its parameters
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+
+    if filters.ids:
+        clauses.append(prefix_clause("id", filters.ids, params))
+    if filters.authors:
+        clauses.append(prefix_clause("pubkey", filters.authors, params))
+    if filters.kinds:
+        clauses.append(f'"kind" IN ({placeholders(len(filters.kinds))})')
+        params.extend(filters.kinds)
+    if filters.since is not None:
+        clauses.append('"created_at" > ?')
+        params.append(filters.since)
+    if filters.until is not None:
+        clauses.append('"created_at" < ?')
+        params.append(filters.until)
+    if filters.event_ids:
+        clauses.append(tag_clause("e", filters.event_ids, params))
+    if filters.pubkeys:
+        clauses.append(tag_clause("p", filters.pubkeys, params))
+    if after is not None:
+        clauses.append('("created_at" < ? OR ("created_at" = ? AND "id" < ?))')
+        params.extend([after[0], after[0], after[1]])
+
+    where = " AND ".join(clauses) if clauses else "1"
+    params.append(limit)
+    return Query(
+        sql=f'SELECT {EVENT_COLUMNS} FROM "event" WHERE {where} ORDER BY "created_at" DESC, "id" DESC LIMIT ?',
+        params=params,
+    )
+
+
+async def pages(readers: ReaderPool, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[Row]]:
+    """Fetch the newest rows matching the filters in pages, paging with the key of the last row.
+
+    Only one page is held in memory at a time and a reader connection is only held while a page is fetched, so a
+    client consuming its replay slowly does not keep a connection from other requests.
+
+    Args:
+        readers (ReaderPool): The connections to query
+        filters (Filters): The filters of the request
+        limit (int): The maximum number of rows to return
+        chunk_size (int): The maximum number of rows fetched per query
+
+    Yields:
+        List[Row]: The next page of `event` rows, newest first
+    """
+    after: Optional[Cursor] = None
+    while limit > 0:
+        query = plan(filters, min(chunk_size, limit), after=after)
+        rows = await readers.fetch(query.sql, query.params)
+        if not rows:
+            return
+
+        yield rows
+
+        limit -= len(rows)
+        if len(rows) < chunk_size:
+            return
+        after = (rows[-1]["created_at"], rows[-1]["id"])
+
+
+async def stream(
+    readers: ReaderPool, filters: Filters, limit: int, chunk_size: int
+) -> AsyncIterator[List[CompactEvent]]:
+    """Stream the newest stored events matching the filters in chunks, see `pages`"""
+    async for rows in pages(readers, filters, limit, chunk_size):
+        yield [database.row_to_event(row) for row in rows]
+
+
+async def stream_json(readers: ReaderPool, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[str]]:
+    """Stream the JSON of the newest stored events matching the filters in chunks, see `pages`.
+
+    The stored JSON is returned as is, only rows stored before the `raw` column are converted to an event first.
+    """
+    async for rows in pages(readers, filters, limit, chunk_size):
+        yield [row["raw"] if row["raw"] is not None else database.row_to_event(row).json() for row in rows]
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, List, Optional
+from urllib.parse import quote
+
+import aiosqlite
+
+from ekiden import metrics
+from ekiden.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ReaderPool:
+    """Read-only SQLite connections serving REQ queries.
+
+    The Tortoise connection is left to the single writer. In WAL mode a reader on its own connection reads the last
+    committed snapshot, it neither waits for a write transaction nor holds one up. Every connection runs on its own
+    aiosqlite thread, so up to `size` queries run at once and further queries wait for a free connection.
+    """
+
+    def __init__(self, path: Optional[str] = None, size: Optional[int] = None):
+        self.path = path or settings.database_path
+        self.size = size or settings.sqlite_readers
+
+        self._connections: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    async def start(self):
+        """Open the connections, the database has to exist already"""
+        uri = f"file:{quote(os.path.abspath(self.path))}?mode=ro"
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            connection = await aiosqlite.connect(uri, uri=True)
+            connection.row_factory = sqlite3.Row
+            await connection.execute(f"PRAGMA busy_timeout = {settings.sqlite_busy_timeout}")
+            self._connections.append(connection)
+            self._idle.put_nowait(connection)
+        logger.info(f"Opened {self.size} read-only connections to {self.path}")
+
+    async def fetch(self, sql: str, params: List[Any]) -> List[sqlite3.Row]:
+        """Run a query on the next free connection.
+
+        Args:
+            sql (str): The query
+            params (List[Any]): Its parameters
+
+        Returns:
+            List[sqlite3.Row]: The rows, accessible by column name
+        """
+        started = time.perf_counter()
+        connection = await self._idle.get()
+        metrics.read_wait_seconds.observe(time.perf_counter() - started)
+        try:
+            return await connection.execute_fetchall(sql, params)
+        finally:
+            self._idle.put_nowait(connection)
+
+    async def close(self):
+        for connection in self._connections:
+            await connection.close()
+        self._connections.clear()
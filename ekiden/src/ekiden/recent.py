@@ -0,0 +1,176 @@
+import heapq
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ekiden import metrics
+from ekiden.nips import CompactEvent, Filters, supersedes
+from ekiden.settings import settings
+from ekiden.storage import EventStore
+from ekiden.subscriptions import FilterMatcher
+
+# (created_at, id), the order REQ results are returned in
+Key = Tuple[int, str]
+
+# rough per event overhead of the object and index entries on top of its serialized size
+EVENT_OVERHEAD = 400
+
+
+def event_key(event: CompactEvent) -> Key:
+    return event.created_at, event.id
+
+
+def event_size(event: CompactEvent) -> int:
+    return len(event.serialized()) + len(event.sig or "") + EVENT_OVERHEAD
+
+
+def remove_key(keys: List[Key], key: Key):
+    position = bisect_left(keys, key)
+    if position < len(keys) and keys[position] == key:
+        del keys[position]
+
+
+class RecentEvents:
+    """A bounded in-memory window over the newest stored events, indexed by kind and author.
+
+    Once loaded, the window holds every stored event ordered after `floor`, so a REQ whose results all lie after it
+    can be answered without touching storage. `floor` only moves forward as events are evicted, it is None while the
+    window holds every stored event.
+    """
+
+    def __init__(self, max_count: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_count = max_count or settings.recent_events_max_count
+        self.max_bytes = max_bytes or settings.recent_events_max_bytes
+        self.size = 0
+        self.floor: Optional[Key] = None
+        self.loaded = False
+
+        self._events: Dict[str, CompactEvent] = {}
+        self._keys: List[Key] = []
+        self._by_kind: Dict[int, List[Key]] = {}
+        self._by_author: Dict[str, List[Key]] = {}
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    async def load(self, storage: EventStore):
+        """Fill the window with the newest stored events"""
+        loaded = 0
+        async for events in storage.stream(Filters(), self.max_count, chunk_size=settings.request_chunk_size):
+            for event in events:
+                self.add(event)
+            loaded += len(events)
+
+        # older events may still be stored, only the ones after the oldest loaded event are known to be held
+        if loaded >= self.max_count and self.floor is None and self._keys:
+            self.floor = self._keys[0]
+        self.loaded = True
+
+    def add(self, event: CompactEvent):
+        """Add a stored event, events ordered before the window are left to storage"""
+        key = event_key(event)
+        if event.id in self._events or (self.floor is not None and key <= self.floor):
+            return
+
+        self._events[event.id] = event
+        self.size += event_size(event)
+        insort(self._keys, key)
+        insort(self._by_kind.setdefault(event.kind, []), key)
+        insort(self._by_author.setdefault(event.pubkey, []), key)
+
+        while self._keys and (len(self._events) > self.max_count or self.size > self.max_bytes):
+            oldest = self._keys[0]
+            self.discard(oldest[1])
+            self.floor = oldest if self.floor is None else max(self.floor, oldest)
+
+    def discard(self, event_id: str):
+        """Remove an event, e.g one that was deleted from storage"""
+        event = self._events.pop(event_id, None)
+        if event is None:
+            return
+
+        key = event_key(event)
+        self.size -= event_size(event)
+        remove_key(self._keys, key)
+        for index, value in ((self._by_kind, event.kind), (self._by_author, event.pubkey)):
+            keys = index[value]
+            remove_key(keys, key)
+            if not keys:
+                del index[value]
+
+    def discard_replaced(self, event: CompactEvent) -> bool:
+        """Remove the events a replaceable event replaces, unless the window holds a newer version
+
+        Args:
+            event (CompactEvent): The replaceable event
+
+        Returns:
+            bool: False if a version in the window supersedes the event, nothing is removed then
+        """
+        versions = [
+            self._events[key[1]]
+            for key in self._by_author.get(event.pubkey, ())
+            if key[1] != event.id and self._events[key[1]].kind == event.kind
+        ]
+        if any(supersedes(version, event) for version in versions):
+            return False
+        for version in versions:
+            self.discard(version.id)
+        return True
+
+    def _candidates(self, matcher: FilterMatcher) -> Optional[Iterator[Key]]:
+        """Keys of events that could match, newest first. None for filters the window has no index for, the few
+        matches of a tag or prefix filter are left to the storage indexes instead of scanning the window for them."""
+        lists: Iterable[List[Key]]
+        if matcher.ids.exact and not matcher.ids.prefixes:
+            keys = [event_key(self._events[event_id]) for event_id in matcher.ids.exact if event_id in self._events]
+            return iter(sorted(keys, reverse=True))
+        if matcher.authors.exact and not matcher.authors.prefixes:
+            lists = [self._by_author.get(author, []) for author in matcher.authors.exact]
+        elif matcher.ids or matcher.authors or matcher.event_ids or matcher.pubkeys:
+            return None
+        elif matcher.kinds:
+            lists = [self._by_kind.get(kind, []) for kind in matcher.kinds]
+        else:
+            lists = [self._keys]
+
+        return heapq.merge(*(reversed(keys) for keys in lists), reverse=True)
+
+    def query(self, matcher: FilterMatcher, limit: int) -> Optional[List[CompactEvent]]:
+        """Answer a REQ from the window if its results are guaranteed to lie inside it.
+
+        That is the case when the window holds every stored event, when `since` is not older than the window, when
+        the window alone holds `limit` matches or when it holds every requested id.
+
+        Args:
+            matcher (FilterMatcher): The compiled filters of the request
+            limit (int): The maximum number of events to return
+
+        Returns:
+            Optional[List[CompactEvent]]: The matching events newest first, or None if storage has to be queried
+        """
+        candidates = self._candidates(matcher) if self.loaded else None
+        if candidates is None:
+            metrics.recent_misses.inc()
+            return None
+
+        results = []
+        for key in candidates:
+            if matcher.since is not None and key[0] <= matcher.since:
+                break
+            event = self._events[key[1]]
+            if matcher.matches(event):
+                results.append(event)
+                if len(results) >= limit:
+                    break
+
+        if (
+            self.floor is None
+            or len(results) >= limit
+            or (matcher.since is not None and matcher.since >= self.floor[0])
+            or (matcher.ids.exact and not matcher.ids.prefixes and all(i in self._events for i in matcher.ids.exact))
+        ):
+            metrics.recent_hits.inc()
+            return results
+
+        metrics.recent_misses.inc()
+        return None
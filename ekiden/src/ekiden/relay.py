@@ -1,90 +1,202 @@
-import json
-from hashlib import sha256
-from uuid import uuid4
+import time
+from typing import List, Optional, Tuple
 
-from tortoise.exceptions import DoesNotExist
-from tortoise.transactions import atomic
+from ekiden import metrics
+from ekiden.bus import BroadcastBus, create_bus
+from ekiden.cache import LRUCache
+from ekiden.keys import VerificationError
+from ekiden.limits import KeyedBuckets
+from ekiden.nips import CompactEvent, dump_json, is_replaceable, supersedes
+from ekiden.recent import RecentEvents
+from ekiden.settings import settings
+from ekiden.storage import EventStore, create_storage
+from ekiden.subscriptions import FilterMatcher, SubscriptionPool
+from ekiden.validation import InvalidEvent, prevalidate
+from ekiden.verification import Verifier
+from ekiden.writer import EventWriter
 
-from ekiden import database
-from ekiden.nips import Event, Kind, dump_json
-from ekiden.subscriptions import SubscriptionPool
+# (author, kind) pairs looked up in the replaceable cache for one filter, larger filters are left to storage
+MAX_CACHED_LOOKUPS = 10_000
 
 
-class AsyncRelay:
-    def __init__(self, sub_pool: SubscriptionPool) -> None:
-        self.conn_pool = sub_pool
+def ok(event_id: str, accepted: bool, message: str = "") -> str:
+    # NIP-20 command result
+    return dump_json(["OK", event_id, accepted, message])
 
-    async def get_identity(self, pubkey: str) -> database.Identity:
-        """Retreive an identity record by pubkey from the database if it exists, else create a new one.
 
-        Args:
-            pubkey (str): the pubkey of the identity.
+def notice(message: str) -> str:
+    return dump_json(["NOTICE", message])
 
-        Returns:
-            database.Identity: the identity record.
-        """
-        if await database.Identity.exists(pubkey=pubkey):
-            return await database.Identity.get(pubkey=pubkey)
 
-        return await database.Identity.create(pubkey=pubkey)
+class AsyncRelay:
+    def __init__(
+        self,
+        sub_pool: SubscriptionPool,
+        verifier: Optional[Verifier] = None,
+        storage: Optional[EventStore] = None,
+        bus: Optional[BroadcastBus] = None,
+    ) -> None:
+        self.conn_pool = sub_pool
+        self.verifier = verifier if verifier is not None else Verifier()
+        # an empty store is falsy, see `LogStore.__len__`
+        self.storage = storage if storage is not None else create_storage()
+        self.writer = EventWriter(commit=self.storage.commit)
+        self.bus = bus if bus is not None else create_bus()
+        self.recent = RecentEvents()
+        # ids of recently accepted events, the unique index on `event.id` catches the ones that were evicted
+        self.seen_ids: LRUCache[str, None] = LRUCache(maxsize=settings.seen_ids_size)
+        # latest replaceable event per (pubkey, kind), e.g profiles and contact lists. Older versions are answered as
+        # duplicates without being written and REQs for the latest version of given authors skip storage, see `latest`
+        self.replaceable: LRUCache[Tuple[str, int], CompactEvent] = LRUCache(maxsize=settings.replaceable_cache_size)
+        self.pubkey_limits = KeyedBuckets(
+            settings.pubkey_event_rate, settings.pubkey_event_burst, maxsize=settings.pubkey_limits_size
+        )
+
+    async def start(self):
+        """Open the storage, fill the recent events window from it and start receiving events from the bus"""
+        await self.storage.start()
+        await self.recent.load(self.storage)
+        await self.bus.start(self.deliver)
+
+    async def close(self):
+        await self.bus.close()
+        await self.verifier.close()
+        await self.writer.close()
+        await self.storage.close()
 
-    @atomic()
     async def event(self, event_data: dict):
         """Handles the event action.
 
+        Events that were already accepted are answered as duplicates before any verification, broadcast or write.
+        Malformed events are refused by the pre-validation checks without reaching the verifier.
+        The signature is verified by the verifier's worker pool and the event is stored by the group committing
+        writer, the OK is only returned once the event is committed. Authors over their rate limit are refused after
+        verification, before anything is written.
+
         Args:
             event_data (dict): A dict object containing the event data.
-            db (Database): The database connection.
         """
+        metrics.events_received.inc()
+        event_id = event_data.get("id") if isinstance(event_data, dict) else None
+        if not isinstance(event_id, str):
+            event_id = ""
+        if event_id in self.seen_ids:
+            metrics.events_duplicate.inc()
+            return ok(event_id, True, "duplicate: already have this event")
+
         try:
-            event = Event.verify(event_data)
-        except:
-            return dump_json(
-                [
-                    "OK",
-                    dump_json(event_data).encode("utf-8") + uuid4().hex.encode("utf-8"),
-                    "false",
-                    "failed to verify key",
-                ]
-            )
-        if event.kind == Kind.set_metadata:
-            try:
-                if db_event := await database.Event.get(pubkey=event.pubkey, kind=event.kind):
-                    await db_event.delete()
-            except DoesNotExist:
-                pass
-
-            identity = await self.get_identity(pubkey=event.pubkey)
-            await self.save_metadata(identity, event)
+            prevalidate(event_data)
+        except InvalidEvent as e:
+            metrics.events_rejected.inc()
+            return ok(event_id, False, str(e))
 
-        await self.conn_pool.broadcast(event)
+        started = time.perf_counter()
+        try:
+            event = await self.verifier.verify(event_data)
+        except VerificationError as e:
+            metrics.events_rejected.inc()
+            return ok(event_id, False, f"invalid: {e}")
+        except Exception:
+            metrics.events_rejected.inc()
+            return ok(event_id, False, "invalid: failed to verify key")
+        finally:
+            metrics.verify_seconds.observe(time.perf_counter() - started)
+
+        # the pubkey is only known to be the author's once the signature checks out
+        if not self.pubkey_limits.take(event.pubkey):
+            metrics.rate_limited.inc()
+            return ok(event.id, False, "rate-limited: too many events from this pubkey")
+
+        if is_replaceable(event.kind):
+            latest = self.replaceable.get((event.pubkey, event.kind))
+            if latest is not None and not supersedes(event, latest):
+                self.seen_ids.put(event.id)
+                metrics.events_duplicate.inc()
+                return ok(event.id, True, "duplicate: have a newer event")
+
+        started = time.perf_counter()
+        try:
+            stored = await self.writer.write(event)
+        except Exception:
+            metrics.events_rejected.inc()
+            return ok(event.id, False, "error: could not store event")
+        finally:
+            metrics.write_seconds.observe(time.perf_counter() - started)
 
-        await database.Event.create(
-            id=event.id,
-            kind=event.kind,
-            content=event.content,
-            created_at=event.created_at,
-            tags=[tag.dict() for tag in event.tags],
-            pubkey=event.pubkey,
-            sig=event.sig,
-        )
+        if not stored:
+            self.seen_ids.put(event.id)
+            metrics.events_duplicate.inc()
+            return ok(event.id, True, "duplicate: already have this event")
 
-        return dump_json(
-            [
-                "OK",
-                sha256(event.json().encode("utf-8") + uuid4().hex.encode("utf-8")).hexdigest(),
-                "true",
-                "",
-            ]
-        )
+        metrics.events_accepted.inc()
+        await self.bus.publish(event)
+        return ok(event.id, True)
+
+    def latest(self, matcher: FilterMatcher, limit: int) -> Optional[List[CompactEvent]]:
+        """Answer a filter for the replaceable events of given authors, e.g their profiles, from the cache.
+
+        Only the latest version of a replaceable event is stored, so the cache answers the filter once it holds the
+        event of every requested (author, kind).
+
+        Args:
+            matcher (FilterMatcher): The compiled filters of the request
+            limit (int): The maximum number of events to return
+
+        Returns:
+            Optional[List[CompactEvent]]: The matching events newest first, or None if storage has to be queried
+        """
+        if matcher.ids or matcher.event_ids or matcher.pubkeys or matcher.authors.prefixes or not matcher.kinds:
+            return None
+        authors = matcher.authors.exact
+        if not authors or len(authors) * len(matcher.kinds) > MAX_CACHED_LOOKUPS:
+            return None
+        if not all(is_replaceable(kind) for kind in matcher.kinds):
+            return None
+
+        events = []
+        for author in authors:
+            for kind in matcher.kinds:
+                event = self.replaceable.get((author, kind))
+                if event is None:
+                    return None
+                if matcher.matches(event):
+                    events.append(event)
+
+        metrics.replaceable_hits.inc()
+        events.sort(key=lambda event: (event.created_at, event.id), reverse=True)
+        return events[:limit]
+
+    def query(self, matcher: FilterMatcher, limit: int) -> Optional[List[CompactEvent]]:
+        """Answer a filter from memory, the replaceable cache or the recent events window.
 
-    async def save_metadata(self, identity: database.Identity, event: Event):
-        content = json.loads(event.content)
-        if "name" in content:
-            identity.name = content["name"]
-        if "about" in content:
-            identity.about = content["about"]
-        if "picture" in content:
-            identity.picture = content["picture"]
+        Args:
+            matcher (FilterMatcher): The compiled filters of the request
+            limit (int): The maximum number of events to return
+
+        Returns:
+            Optional[List[CompactEvent]]: The matching events newest first, or None if storage has to be queried
+        """
+        events = self.latest(matcher, limit)
+        if events is None:
+            events = self.recent.query(matcher, limit)
+        return events
 
-        await identity.save()
+    async def deliver(self, event: CompactEvent):
+        """Makes a stored event visible in this worker: caches, the recent window and the subscribers.
+        Called by the bus for every event accepted by any worker.
+
+        Args:
+            event (CompactEvent): The stored event
+        """
+        self.seen_ids.put(event.id)
+        # events of other workers come in any order, an older version of a replaceable event must not replace the
+        # newer one in the cache or the window
+        newest = True
+        if is_replaceable(event.kind):
+            latest = self.replaceable.get((event.pubkey, event.kind))
+            newest = (latest is None or supersedes(event, latest)) and self.recent.discard_replaced(event)
+            if newest:
+                self.replaceable.put((event.pubkey, event.kind), event)
+        if newest:
+            self.recent.add(event)
+        await self.conn_pool.broadcast(event)
@@ -0,0 +1,126 @@
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseSettings
+
+
+class SlowConsumerPolicy(str, Enum):
+    # drop the oldest queued frame to make room for the new one
+    drop_oldest = "drop_oldest"
+    # drop new frames and disconnect the client once its queue has been full for `slow_consumer_timeout` seconds
+    disconnect = "disconnect"
+
+
+class BusKind(str, Enum):
+    # events only reach subscribers of the worker that accepted them
+    local = "local"
+    # events are fanned out to every worker on the host over unix sockets
+    unix = "unix"
+
+
+class StorageKind(str, Enum):
+    # SQLite through Tortoise ORM
+    sqlite = "sqlite"
+    # append-only segmented event log, see `ekiden.eventlog`
+    log = "log"
+
+
+class Settings(BaseSettings):
+    """Relay settings, every field can be overridden with an `EKIDEN_` prefixed environment variable."""
+
+    # maximum number of frames buffered for a single connection
+    outbound_queue_size: int = 1000
+    slow_consumer_policy: SlowConsumerPolicy = SlowConsumerPolicy.drop_oldest
+    slow_consumer_timeout: float = 10.0
+
+    # signature verification pool, defaults to one worker per core
+    verify_workers: Optional[int] = None
+    verify_use_processes: bool = False
+    # maximum number of events verified in one executor call
+    verify_batch_size: int = 64
+    # seconds to wait for more events before dispatching a partial batch
+    verify_batch_delay: float = 0.0
+    # maximum number of events queued for or undergoing verification
+    verify_max_in_flight: int = 1024
+
+    # where events are stored
+    storage: StorageKind = StorageKind.sqlite
+    # directory holding the segments of the event log and the size at which a new segment is started
+    log_directory: str = "ekiden-log"
+    log_segment_size: int = 64 * 1024 * 1024
+    # fsync the log after every group commit, without it a power loss can drop acknowledged events
+    log_sync: bool = True
+
+    # SQLite database file and the pragmas applied to its connection
+    database_path: str = "ekiden.sqlite3"
+    sqlite_journal_mode: str = "WAL"
+    # FULL syncs the WAL on every commit, so an event is durable before its OK is sent. NORMAL only syncs at
+    # checkpoints, committed events then survive a process crash but not a power loss
+    sqlite_synchronous: str = "FULL"
+    # milliseconds a write waits for another worker's transaction instead of failing
+    sqlite_busy_timeout: int = 5000
+    # read-only connections answering REQs next to the one connection events are written on
+    sqlite_readers: int = 4
+
+    # how accepted events reach the subscribers of other workers, use `unix` when running several workers
+    broadcast_bus: BusKind = BusKind.local
+    bus_directory: str = "/tmp/ekiden-bus"
+    # bytes buffered for a worker that stopped reading before it is dropped
+    bus_max_buffer: int = 16 * 1024 * 1024
+
+    # HTTP path of the Prometheus metrics, empty to disable the route
+    metrics_path: str = "/metrics"
+
+    # group commit, events are written in one transaction per `write_batch_size` events or `write_batch_delay` seconds
+    write_batch_size: int = 256
+    write_batch_delay: float = 0.002
+
+    # REQ replay, the limit used when the client sends none, the maximum limit and the events fetched per query
+    request_default_limit: int = 100
+    request_max_limit: int = 5000
+    request_chunk_size: int = 100
+
+    # in-memory window of the newest events serving recent REQs
+    recent_events_max_count: int = 10_000
+    recent_events_max_bytes: int = 32 * 1024 * 1024
+
+    # number of recently accepted event ids remembered to answer duplicates without verifying them
+    seen_ids_size: int = 100_000
+    # number of (pubkey, kind) pairs whose latest replaceable event is cached
+    replaceable_cache_size: int = 50_000
+
+    # token buckets, operations per second and burst size, a rate of 0 disables the limit
+    event_rate: float = 10.0
+    event_burst: int = 50
+    request_rate: float = 5.0
+    request_burst: int = 20
+    # events per author across every connection, checked once the signature is verified
+    pubkey_event_rate: float = 5.0
+    pubkey_event_burst: int = 50
+    pubkey_limits_size: int = 100_000
+    # open subscriptions per connection and filters per REQ
+    max_subscriptions: int = 20
+    max_filters: int = 10
+    # ids, authors, kinds or tag values in one list of a filter, keeps a REQ query under SQLite's bound parameter limit
+    max_filter_values: int = 2000
+    # frames of one connection handled at once, reading its next frame waits for one of them to finish
+    max_frames_in_flight: int = 32
+    # storage pages fetched at the same time for REQ replays across the relay
+    max_concurrent_queries: int = 16
+
+    # events are checked against these bounds before their signature, 0 disables a bound
+    # characters in a client frame, larger frames are dropped before decoding
+    max_message_size: int = 256 * 1024
+    max_content_length: int = 64 * 1024
+    max_tags: int = 2000
+    # seconds created_at may be ahead of or behind the relay's clock
+    created_at_max_future: int = 15 * 60
+    created_at_max_age: int = 0
+    # minimum leading zero bits of the event id (NIP-13)
+    min_pow_difficulty: int = 0
+
+    class Config:
+        env_prefix = "EKIDEN_"
+
+
+settings = Settings()
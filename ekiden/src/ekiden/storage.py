@@ -0,0 +1,175 @@
+import json
+from abc import abstractmethod
+from typing import AsyncIterator, Dict, List
+
+from tortoise import Tortoise
+from tortoise.exceptions import IntegrityError
+from tortoise.transactions import in_transaction
+
+from ekiden import database, queries
+from ekiden.nips import CompactEvent, Filters, Kind, is_replaceable
+from ekiden.readers import ReaderPool
+from ekiden.settings import StorageKind, settings
+
+# ids looked up per query when checking which events of a batch are stored
+STORED_IDS_CHUNK_SIZE = 500
+
+
+class EventStore:
+    """Where accepted events are kept and REQs are replayed from"""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def commit(self, events: List[CompactEvent]) -> List[bool]:
+        """Durably store a batch of verified events.
+
+        Replaceable events only replace an older event of the same author and kind.
+
+        Args:
+            events (List[CompactEvent]): The events to store
+
+        Returns:
+            List[bool]: For each event, True if it was stored, False if it is a duplicate or a newer replaceable
+                event is stored already.
+        """
+
+    @abstractmethod
+    def stream(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[CompactEvent]]:
+        """Stream the newest stored events matching the filters in chunks, newest first.
+
+        Args:
+            filters (Filters): The filters of the request
+            limit (int): The maximum number of events to return
+            chunk_size (int): The maximum number of events per chunk
+        """
+
+    async def stream_json(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[str]]:
+        """Stream the JSON of the newest stored events matching the filters, as sent in EVENT frames.
+
+        Args:
+            filters (Filters): The filters of the request
+            limit (int): The maximum number of events to return
+            chunk_size (int): The maximum number of events per chunk
+        """
+        async for events in self.stream(filters, limit, chunk_size):
+            yield [event.json() for event in events]
+
+
+def database_url() -> str:
+    return (
+        f"sqlite://{settings.database_path}"
+        f"?journal_mode={settings.sqlite_journal_mode}&synchronous={settings.sqlite_synchronous}"
+        f"&busy_timeout={settings.sqlite_busy_timeout}"
+    )
+
+
+class SQLiteStore(EventStore):
+    """Events in SQLite, with the tag index in `event_tag` and profiles in `identity`.
+
+    Writes go through the Tortoise connection, which only the `EventWriter` task commits on, REQs are answered from
+    a pool of read-only connections.
+    """
+
+    def __init__(self):
+        self.readers = ReaderPool()
+
+    async def start(self):
+        await Tortoise.init(db_url=database_url(), modules={"models": ["ekiden.database"]})
+        await Tortoise.generate_schemas()
+        await database.migrate()
+        await self.readers.start()
+
+    async def close(self):
+        await self.readers.close()
+        await Tortoise.close_connections()
+
+    def stream(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[CompactEvent]]:
+        return queries.stream(self.readers, filters, limit, chunk_size)
+
+    def stream_json(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[str]]:
+        return queries.stream_json(self.readers, filters, limit, chunk_size)
+
+    async def _stored_ids(self, ids: List[str]) -> set:
+        connection = Tortoise.get_connection("default")
+        stored = set()
+        # a batch can hold more ids than SQLite binds in one statement
+        for start in range(0, len(ids), STORED_IDS_CHUNK_SIZE):
+            chunk = ids[start : start + STORED_IDS_CHUNK_SIZE]
+            rows = await connection.execute_query_dict(
+                f'SELECT "id" FROM "event" WHERE "id" IN ({queries.placeholders(len(chunk))})', chunk
+            )
+            stored.update(row["id"] for row in rows)
+        return stored
+
+    async def commit(self, events: List[CompactEvent]) -> List[bool]:
+        """Stores the batch in one transaction, events already stored are skipped before it starts"""
+        stored = await self._stored_ids([event.id for event in events])
+
+        accepted: Dict[str, CompactEvent] = {}
+        for event in events:
+            if event.id not in stored:
+                accepted.setdefault(event.id, event)
+
+        results = {}
+        try:
+            async with in_transaction():
+                for event in accepted.values():
+                    results[event.id] = await self.store(event)
+        except IntegrityError:
+            # stored by another worker in the meantime
+            if len(events) == 1:
+                return [False]
+            raise
+
+        # only the first of several events with the same id can be stored
+        return [results.pop(event.id, False) for event in events]
+
+    async def store(self, event: CompactEvent) -> bool:
+        """Stores a verified event and its tag index.
+        Replaceable events are upserted on (pubkey, kind) and only replace an older event, metadata also updates
+        the author's identity. Called inside the batch transaction.
+
+        Args:
+            event (CompactEvent): The verified event
+
+        Returns:
+            bool: True if the event was stored, False if a newer replaceable event is stored already.
+        """
+        if is_replaceable(event.kind):
+            if not await database.replace_event(event):
+                return False
+            if event.kind == Kind.set_metadata:
+                await self.save_metadata(event)
+            return True
+
+        table_id = await database.insert_event(event)
+        await database.Event(table_id=table_id).save_tags(event.tags)
+        return True
+
+    async def save_metadata(self, event: CompactEvent):
+        # the content is up to the client, anything but a JSON object leaves the identity as it is. This runs inside
+        # the batch transaction, raising here would fail every event of the group commit
+        try:
+            content = json.loads(event.content)
+        except ValueError:
+            return
+        if not isinstance(content, dict):
+            return
+
+        fields = {field: content.get(field) for field in ("name", "about", "picture")}
+        await database.upsert_identity(
+            pubkey=event.pubkey, **{field: value for field, value in fields.items() if isinstance(value, str)}
+        )
+
+
+def create_storage() -> EventStore:
+    if settings.storage == StorageKind.log:
+        from ekiden.eventlog import LogStore
+
+        return LogStore()
+    return SQLiteStore()
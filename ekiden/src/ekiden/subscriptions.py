@@ -1,138 +1,440 @@
-import asyncio
 import logging
-from typing import MutableSet, Optional
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import (
+    Dict,
+    FrozenSet,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from weakref import WeakValueDictionary
+
+from ekiden import metrics
+from ekiden.connections import Connection
+from ekiden.nips import HEX_KEY_LENGTH, AnyEvent, CompactEvent, Filters, dump_json
 
-from starlette.websockets import WebSocket
+logger = logging.getLogger(__name__)
 
-from ekiden.nips import ETag, Event, Filters, PTag, dump_json
+NO_VALUES: FrozenSet = frozenset()
 
-logger = logging.getLogger(__name__)
 
+def shared_values(values: Optional[Iterable[str]]) -> FrozenSet[str]:
+    """The values as a frozenset of interned strings, a pubkey followed by many clients is stored once"""
+    return frozenset(map(sys.intern, values)) if values else NO_VALUES
 
-def validate_scalar(candidates, subject) -> bool:
-    """
-    For scalar event attributes such as kind, the attribute from the event must be contained in the filter list
+
+class PrefixSet:
+    """Exact values and prefixes of hex ids or pubkeys.
+
+    Prefixes covered by a shorter prefix are dropped, which leaves a sorted, prefix free tuple where the only prefix
+    that can match a value is the greatest one not greater than it. Exact values are kept in a sorted tuple as well,
+    a follow list of hundreds of pubkeys takes a fraction of the memory of a hash set and is searched just as well.
     """
-    if len(candidates) == 0:
-        return True
 
-    return True if subject in candidates else False
+    __slots__ = ("exact", "prefixes")
 
+    def __init__(self, values: Iterable[str]):
+        exact = []
+        prefixes = []
+        for value in sorted(set(values)):
+            if len(value) >= HEX_KEY_LENGTH:
+                exact.append(sys.intern(value))
+            elif value and not (prefixes and value.startswith(prefixes[-1])):
+                prefixes.append(sys.intern(value))
 
-def validate_multiple(candidates, subjects) -> bool:
-    """
-    For tag attributes such as #e, where an event may have multiple values, the event and filter condition values must have at least one item in common.
-    """
-    a = set(candidates)
-    b = set(subjects)
-    if len(a) == 0:
-        return True
+        self.exact: Tuple[str, ...] = tuple(exact)
+        self.prefixes: Tuple[str, ...] = tuple(prefixes)
 
-    return len(a.intersection(b)) > 0
+    def __bool__(self) -> bool:
+        return bool(self.exact or self.prefixes)
 
+    def __contains__(self, value: str) -> bool:
+        position = bisect_left(self.exact, value)
+        if position < len(self.exact) and self.exact[position] == value:
+            return True
+        if not self.prefixes:
+            return False
 
-def validate_since(candidate, subject) -> bool:
-    if candidate is None:
-        return True
+        position = bisect_right(self.prefixes, value)
+        return position > 0 and value.startswith(self.prefixes[position - 1])
 
-    return subject > candidate
 
+class FilterMatcher:
+    """Filters compiled once at REQ time into the structures needed to match an event with a few set lookups.
 
-def validate_until(candidate, subject) -> bool:
-    if candidate is None:
+    Every populated filter has to match. Ids and authors match exactly or by prefix, kinds and tags by membership and
+    since/until are exclusive bounds on `created_at`.
+
+    Matchers are immutable, subscriptions get theirs from `shared` so identical filters, e.g the global feed most
+    clients subscribe to, are compiled, stored and matched once.
+    """
+
+    __slots__ = ("ids", "authors", "kinds", "event_ids", "pubkeys", "since", "until", "__weakref__")
+
+    def __init__(self, filters: Filters):
+        self.ids = PrefixSet(filters.ids or ())
+        self.authors = PrefixSet(filters.authors or ())
+        self.kinds: FrozenSet[int] = frozenset(filters.kinds) if filters.kinds else NO_VALUES
+        self.event_ids: FrozenSet[str] = shared_values(filters.event_ids)
+        self.pubkeys: FrozenSet[str] = shared_values(filters.pubkeys)
+        self.since: Optional[int] = filters.since
+        self.until: Optional[int] = filters.until
+
+    @classmethod
+    def shared(cls, filters: Filters) -> "FilterMatcher":
+        """Compile the filters, reusing the matcher of identical filters that are still subscribed to.
+
+        Args:
+            filters (Filters): The filters of a REQ
+
+        Returns:
+            FilterMatcher: The compiled filters, shared with every subscription to the same filters
+        """
+        matcher = cls(filters)
+        return _shared_matchers.setdefault(matcher.key, matcher)
+
+    @property
+    def key(self) -> Hashable:
+        """Equal for matchers of filters matching the same events, `limit` plays no part in matching"""
+        return (
+            self.ids.exact,
+            self.ids.prefixes,
+            self.authors.exact,
+            self.authors.prefixes,
+            self.kinds,
+            self.event_ids,
+            self.pubkeys,
+            self.since,
+            self.until,
+        )
+
+    def matches(self, event: AnyEvent) -> bool:
+        if self.kinds and event.kind not in self.kinds:
+            return False
+        if self.since is not None and event.created_at <= self.since:
+            return False
+        if self.until is not None and event.created_at >= self.until:
+            return False
+        if self.authors and event.pubkey not in self.authors:
+            return False
+        if self.event_ids and self.event_ids.isdisjoint(event.tag_values("e")):
+            return False
+        if self.pubkeys and self.pubkeys.isdisjoint(event.tag_values("p")):
+            return False
+        if self.ids and event.id not in self.ids:
+            return False
         return True
 
-    return subject < candidate
+
+# the matchers in use by key, a matcher is dropped once its last subscription is closed
+_shared_matchers: "WeakValueDictionary[Hashable, FilterMatcher]" = WeakValueDictionary()
 
 
-def validate_filters(event: Event, filters: Filters) -> bool:
+def validate_filters(event: AnyEvent, filters: Filters) -> bool:
     """Given a event, validate the filters on it.
+    Compiles the filters for a single check, subscriptions keep their compiled `FilterMatcher` instead.
 
     Args:
-        event (Event): The event under question
+        event (AnyEvent): The event under question
         filters (Filters): The filter to validate
 
     Returns:
         bool: True if the event passes the filters, else False.
     """
-    if (
-        validate_scalar(filters.ids, event.id)
-        and validate_scalar(filters.authors, event.pubkey)
-        and validate_scalar(filters.kinds, event.kind)
-        and validate_multiple(filters.event_ids, [tag.id for tag in event.tags if isinstance(tag, ETag)])
-        and validate_multiple(filters.pubkeys, [tag.pubkey for tag in event.tags if isinstance(tag, PTag)])
-        and validate_since(filters.since, event.created_at)
-        and validate_until(filters.until, event.created_at)
-    ):
-        return True
-    return False
+    return FilterMatcher(filters).matches(event)
 
 
 class Subscription:
-    def __init__(self, filters: Filters, websocket: WebSocket, subscription_id: str):
-        self.filters = filters
-        self.websocket = websocket
+    """The filters of one REQ, an event matching any of them is sent to the connection.
+
+    Only the compiled filters are kept, in the order of the REQ. Most connections sit idle with their subscriptions
+    open, so a subscription holds no more than it needs to match and frame events.
+    """
+
+    __slots__ = ("matchers", "connection", "subscription_id", "_frame_prefix")
+
+    def __init__(self, filters: Sequence[Filters], connection: Connection, subscription_id: str):
+        self.matchers: Tuple[FilterMatcher, ...] = tuple(FilterMatcher.shared(f) for f in filters)
+        self.connection = connection
         self.subscription_id = subscription_id
+        self._frame_prefix = f'["EVENT",{dump_json(subscription_id)},'
+
+    def matches(self, event: AnyEvent) -> bool:
+        return any(matcher.matches(event) for matcher in self.matchers)
+
+    def frame(self, event_json: str) -> str:
+        """Build the EVENT frame for this subscription around an already serialized event.
+
+        Args:
+            event_json (str): The serialized event
+
+        Returns:
+            str: The `["EVENT", <subscription_id>, <event JSON>]` frame
+        """
+        return f"{self._frame_prefix}{event_json}]"
+
+    async def send(self, event: CompactEvent):
+        """Send the event, waiting for room in the connection's queue."""
+        await self.send_json(event.json())
+
+    async def send_json(self, event_json: str):
+        """Send an already serialized event, e.g the stored JSON of a replayed event, waiting for room in the
+        connection's queue."""
+        await self.connection.send(self.frame(event_json))
+
+    async def end_of_stored_events(self):
+        """Tell the client every stored event has been sent (NIP-15)"""
+        await self.connection.send(dump_json(["EOSE", self.subscription_id]))
+
 
-    async def send(self, event: Event):
-        if validate_filters(event, self.filters):
-            await self.websocket.send_text(dump_json(["EVENT", self.subscription_id, event.dict()]))
+IndexKey = Tuple[str, Tuple[Hashable, ...]]
+
+
+def index_key(matcher: FilterMatcher) -> IndexKey:
+    """Pick the filter dimension a filter is posted under in the index.
+
+    Every populated dimension of a filter must match for an event to pass, so indexing a single dimension is enough to
+    find every filter that could match. The most selective dimension is preferred, ids and authors are only
+    indexable when they hold no prefixes. Filters without any indexable dimension land in the match-anything bucket.
+
+    Args:
+        matcher (FilterMatcher): The compiled filters
+
+    Returns:
+        IndexKey: The name of the dimension and the values to post the filter under
+    """
+    if matcher.ids.exact and not matcher.ids.prefixes:
+        return "ids", tuple(matcher.ids.exact)
+    if matcher.event_ids:
+        return "e", tuple(matcher.event_ids)
+    if matcher.pubkeys:
+        return "p", tuple(matcher.pubkeys)
+    if matcher.authors.exact and not matcher.authors.prefixes:
+        return "authors", tuple(matcher.authors.exact)
+    if matcher.kinds:
+        return "kinds", tuple(matcher.kinds)
+
+    return "any", ()
+
+
+class SubscriptionIndex:
+    """Inverted index from event attributes to the filters that could match them.
+
+    Subscriptions to identical filters share a `FilterMatcher`, which is posted once and keeps the set of its
+    subscriptions. A filter subscribed to by every client costs one posting and one match per event.
+    """
+
+    def __init__(self) -> None:
+        self._postings: Dict[str, Dict[Hashable, Set[FilterMatcher]]] = {
+            "ids": defaultdict(set),
+            "e": defaultdict(set),
+            "p": defaultdict(set),
+            "authors": defaultdict(set),
+            "kinds": defaultdict(set),
+        }
+        self._match_any: Set[FilterMatcher] = set()
+        self._subscribers: Dict[FilterMatcher, Set[Subscription]] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def subscribers(self, matcher: FilterMatcher) -> Set[Subscription]:
+        """The subscriptions with the matcher among their filters"""
+        return self._subscribers.get(matcher, set())
+
+    def add(self, subscription: Subscription):
+        # an event can match any of the filters, so the subscription is added under each one
+        self._size += 1
+        for matcher in set(subscription.matchers):
+            subscribers = self._subscribers.get(matcher)
+            if subscribers is None:
+                subscribers = self._subscribers[matcher] = set()
+                self._post(matcher)
+            subscribers.add(subscription)
+
+    def discard(self, subscription: Subscription):
+        for matcher in set(subscription.matchers):
+            subscribers = self._subscribers.get(matcher)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[matcher]
+                self._unpost(matcher)
+        self._size -= 1
+
+    def _post(self, matcher: FilterMatcher):
+        dimension, values = index_key(matcher)
+        if dimension == "any":
+            self._match_any.add(matcher)
+            return
+
+        postings = self._postings[dimension]
+        for value in values:
+            postings[value].add(matcher)
+
+    def _unpost(self, matcher: FilterMatcher):
+        dimension, values = index_key(matcher)
+        if dimension == "any":
+            self._match_any.discard(matcher)
+            return
+
+        postings = self._postings[dimension]
+        for value in values:
+            bucket = postings.get(value)
+            if bucket is None:
+                continue
+            bucket.discard(matcher)
+            if not bucket:
+                del postings[value]
+
+    def _lookup(self, dimension: str, values: Iterable[Hashable]) -> Iterable[FilterMatcher]:
+        postings = self._postings[dimension]
+        for value in values:
+            bucket = postings.get(value)
+            if bucket:
+                yield from bucket
+
+    def candidates(self, event: AnyEvent) -> Set[FilterMatcher]:
+        """Collect the filters that could match the event.
+
+        The candidates still have to be matched, the index only rules out filters that can not match.
+
+        Args:
+            event (AnyEvent): The event to match
+
+        Returns:
+            Set[FilterMatcher]: The candidate filters, see `subscribers` for their subscriptions
+        """
+        candidates = set(self._match_any)
+        candidates.update(self._lookup("ids", (event.id,)))
+        candidates.update(self._lookup("kinds", (event.kind,)))
+        candidates.update(self._lookup("authors", (event.pubkey,)))
+        candidates.update(self._lookup("e", event.tag_values("e")))
+        candidates.update(self._lookup("p", event.tag_values("p")))
+        return candidates
 
 
 class SubscriptionPool:
+    """The open subscriptions of every connection.
+
+    Each connection keeps its subscriptions by id in `Connection.subscriptions`, so CLOSE and disconnect find them
+    without scanning the pool. The pool is only changed synchronously on the event loop and a broadcast collects its
+    candidates before queueing any frame, so no lock is needed.
+    """
+
     def __init__(self) -> None:
-        self._subscriptions: MutableSet[Subscription] = set()
-        self._access_lock = asyncio.Lock()
+        self._subscriptions = SubscriptionIndex()
 
-    async def get_subscription(self, websocket: WebSocket) -> Optional[Subscription]:
-        """Retrieve a subscription from the pool with the matching websocket.
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def count(self, connection: Connection) -> int:
+        """The number of subscriptions the connection has open"""
+        return len(connection.subscriptions)
+
+    def get_subscription(self, connection: Connection, subscription_id: str) -> Optional[Subscription]:
+        """Retrieve the subscription of a connection by its id.
 
         Args:
-            websocket (WebSocket): The websocket to match
+            connection (Connection): The connection of the subscription
+            subscription_id (str): The id given in the REQ
 
         Returns:
             Optional[Subscription]: The matching subscription if found, else None.
         """
-        async with self._access_lock:
-            for subscription in self._subscriptions:
-                if subscription.websocket == websocket:
-                    return subscription
+        return connection.subscriptions.get(subscription_id)
 
-            return None
-
-    async def add_subscription(self, subscription: Subscription):
-        """Add a new subscription to the pool
+    def add_subscription(self, subscription: Subscription, limit: Optional[int] = None) -> bool:
+        """Add a new subscription to the pool, replacing the connection's subscription with the same id
 
         Args:
             subscription (Subscription): The subscription to add
+            limit (Optional[int]): The most subscriptions a connection may have open
+
+        Returns:
+            bool: True if the subscription was added, False if its connection is at the limit.
         """
-        async with self._access_lock:
-            self._subscriptions.add(subscription)
+        subscriptions = subscription.connection.subscriptions
+        replaced = subscriptions.get(subscription.subscription_id)
+        if limit and replaced is None and len(subscriptions) >= limit:
+            return False
+
+        if replaced is not None:
+            self._subscriptions.discard(replaced)
+        subscriptions[subscription.subscription_id] = subscription
+        self._subscriptions.add(subscription)
+        return True
 
-    async def remove_subscription(self, subscription: Subscription):
-        """Remove the subscription from the pool
+    def remove_subscription(self, connection: Connection, subscription_id: str) -> Optional[Subscription]:
+        """Remove the subscription of a connection by its id
 
         Args:
-            subscription (Subscription): The subscription to remove
+            connection (Connection): The connection of the subscription
+            subscription_id (str): The id given in the REQ
+
+        Returns:
+            Optional[Subscription]: The removed subscription if found, else None.
         """
-        logger.info(f"Removing subscription: {subscription.subscription_id}")
-        async with self._access_lock:
+        subscription = connection.subscriptions.pop(subscription_id, None)
+        if subscription is not None:
+            logger.info(f"Removing subscription: {subscription_id}")
             self._subscriptions.discard(subscription)
+        return subscription
 
-    async def broadcast(self, event: Event):
-        """Broadcasts the event to all subscribers.
-        The subscriber will only receive the message if the event passes the filters.
+    def remove_connection(self, connection: Connection):
+        """Remove every subscription of a connection
 
         Args:
-            event (Event): The event to broadcast
+            connection (Connection): The closed connection
         """
-        _stale = []
+        for subscription in connection.subscriptions.values():
+            self._subscriptions.discard(subscription)
+        connection.subscriptions.clear()
 
-        async with self._access_lock:
-            for subscription in self._subscriptions:
-                try:
-                    await subscription.send(event)
-                except RuntimeError:
-                    _stale.append(subscription)
+    async def broadcast(self, event: CompactEvent):
+        """Broadcasts the event to all subscribers.
+        Only the filters the index selects as candidates are matched, each once for all of its subscriptions.
+        Frames are queued on each subscriber's connection, so a slow client never holds up the broadcast.
+        The event is serialized once and shared by the frames of every matching subscription.
 
-            [await self.remove_subscription(subscription) for subscription in _stale]
+        Args:
+            event (CompactEvent): The event to broadcast
+        """
+        event_json = None
+        fanout = 0
+        started = time.perf_counter()
+        # subscriptions with several matching filters get the event once
+        delivered: Set[Subscription] = set()
+        stale: List[Subscription] = []
+
+        for matcher in self._subscriptions.candidates(event):
+            if not matcher.matches(event):
+                continue
+            if event_json is None:
+                event_json = event.json()
+
+            for subscription in self._subscriptions.subscribers(matcher):
+                if subscription.connection.closed:
+                    stale.append(subscription)
+                    continue
+                if len(subscription.matchers) > 1:
+                    if subscription in delivered:
+                        continue
+                    delivered.add(subscription)
+                subscription.connection.push(subscription.frame(event_json))
+                fanout += 1
+
+        for subscription in stale:
+            self.remove_subscription(subscription.connection, subscription.subscription_id)
+
+        metrics.broadcast_seconds.observe(time.perf_counter() - started)
+        metrics.broadcast_fanout.observe(fanout)
@@ -0,0 +1,96 @@
+import re
+import time
+from typing import Any, Optional
+
+from ekiden.nips import HEX_KEY_LENGTH
+from ekiden.settings import settings
+
+HEX_KEY = re.compile(f"[0-9a-f]{{{HEX_KEY_LENGTH}}}")
+HEX_SIGNATURE = re.compile(f"[0-9a-f]{{{HEX_KEY_LENGTH * 2}}}")
+
+FIELD_TYPES = (
+    ("id", str),
+    ("pubkey", str),
+    ("created_at", int),
+    ("kind", int),
+    ("tags", list),
+    ("content", str),
+    ("sig", str),
+)
+MAX_KIND = 65535
+
+
+class InvalidEvent(Exception):
+    """Raised when an event fails pre-validation, the message is the reason sent back in the OK"""
+
+
+def difficulty(event_id: str) -> int:
+    """The number of leading zero bits of the event id (NIP-13)"""
+    return HEX_KEY_LENGTH * 4 - int(event_id, 16).bit_length()
+
+
+def check_structure(event: Any):
+    if not isinstance(event, dict):
+        raise InvalidEvent("invalid: event is not an object")
+
+    for field, field_type in FIELD_TYPES:
+        value = event.get(field)
+        # bool is a subclass of int
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            raise InvalidEvent(f"invalid: `{field}` is missing or not a {field_type.__name__}")
+
+    if not 0 <= event["kind"] <= MAX_KIND:
+        raise InvalidEvent("invalid: `kind` is out of range")
+    if len(event["content"]) > settings.max_content_length:
+        raise InvalidEvent("invalid: content is too long")
+
+    tags = event["tags"]
+    if len(tags) > settings.max_tags:
+        raise InvalidEvent("invalid: too many tags")
+    for tag in tags:
+        if not isinstance(tag, list) or not tag or not all(isinstance(element, str) for element in tag):
+            raise InvalidEvent("invalid: tags must be non empty arrays of strings")
+        if tag[0] in ("e", "p") and len(tag) < 2:
+            raise InvalidEvent(f"invalid: `{tag[0]}` tag without a value")
+
+
+def check_encoding(event: dict):
+    if not HEX_KEY.fullmatch(event["id"]):
+        raise InvalidEvent("invalid: `id` is not 32 bytes of lowercase hex")
+    if not HEX_KEY.fullmatch(event["pubkey"]):
+        raise InvalidEvent("invalid: `pubkey` is not 32 bytes of lowercase hex")
+    if not HEX_SIGNATURE.fullmatch(event["sig"]):
+        raise InvalidEvent("invalid: `sig` is not 64 bytes of lowercase hex")
+
+
+def check_created_at(event: dict, now: int):
+    if settings.created_at_max_future and event["created_at"] > now + settings.created_at_max_future:
+        raise InvalidEvent("invalid: created_at is too far in the future")
+    if settings.created_at_max_age and event["created_at"] < now - settings.created_at_max_age:
+        raise InvalidEvent("invalid: created_at is too far in the past")
+
+
+def check_pow(event: dict):
+    # checked on the claimed id, the signature check confirms it belongs to the event
+    if settings.min_pow_difficulty and difficulty(event["id"]) < settings.min_pow_difficulty:
+        raise InvalidEvent(f"pow: difficulty is below {settings.min_pow_difficulty}")
+
+
+def prevalidate(event: Any, now: Optional[int] = None):
+    """Reject malformed events before they are queued for verification.
+
+    The checks are ordered from cheapest to most expensive and none of them hashes or touches the signature: the
+    structure and sizes, the hex encoding of id, pubkey and sig, the created_at bounds and the proof of work. The
+    verifier then recomputes the id and compares it to the claimed one before spending a Schnorr verification.
+
+    Args:
+        event (Any): The decoded event of an EVENT message
+        now (Optional[int]): The current unix time, defaults to the clock
+
+    Raises:
+        InvalidEvent: If a check fails
+    """
+    check_structure(event)
+    check_encoding(event)
+    check_created_at(event, int(time.time()) if now is None else now)
+    check_pow(event)
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from ekiden.nips import CompactEvent
+from ekiden.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def verify_batch(events: List[Dict[str, Any]]) -> List[Union[CompactEvent, Exception]]:
+    """Verify a batch of events, returning the verified event or the raised exception for each one.
+
+    Runs inside the executor, so it has to stay a picklable module level function.
+    """
+    results = []
+    for event_data in events:
+        try:
+            results.append(CompactEvent.verify(event_data))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class Verifier:
+    """Verifies event signatures on a worker pool instead of the event loop.
+
+    Events waiting for verification are grouped into batches so a burst costs one executor round trip per batch,
+    and the number of events queued or being verified is bounded by `max_in_flight`.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        batch_delay: Optional[float] = None,
+        max_in_flight: Optional[int] = None,
+        use_processes: Optional[bool] = None,
+    ):
+        self.workers = workers or settings.verify_workers or os.cpu_count()
+        self.batch_size = batch_size or settings.verify_batch_size
+        self.batch_delay = batch_delay if batch_delay is not None else settings.verify_batch_delay
+        self.max_in_flight = max_in_flight or settings.verify_max_in_flight
+        self.use_processes = use_processes if use_processes is not None else settings.verify_use_processes
+
+        self._executor: Optional[Executor] = None
+        self._pending: Optional[asyncio.Queue] = None
+        self._in_flight: Optional[asyncio.Semaphore] = None
+        self._batcher: Optional[asyncio.Task] = None
+
+    def _start(self):
+        if self.use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="verify")
+        self._pending = asyncio.Queue()
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._batcher = asyncio.create_task(self._batch())
+
+    async def verify(self, event_data: Dict[str, Any]) -> CompactEvent:
+        """Verify the event, waiting for room if `max_in_flight` events are already pending.
+
+        Args:
+            event_data (dict): The event as received from the client
+
+        Raises:
+            VerificationError: If the event could not be verified
+
+        Returns:
+            CompactEvent: The verified event
+        """
+        if self._batcher is None:
+            self._start()
+
+        async with self._in_flight:
+            future = asyncio.get_running_loop().create_future()
+            self._pending.put_nowait((event_data, future))
+            result = await future
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _drain(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        while len(batch) < self.batch_size and not self._pending.empty():
+            batch.append(self._pending.get_nowait())
+
+    async def _batch(self):
+        while True:
+            batch = [await self._pending.get()]
+            self._drain(batch)
+            if len(batch) < self.batch_size and self.batch_delay > 0:
+                await asyncio.sleep(self.batch_delay)
+                self._drain(batch)
+
+            asyncio.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self._executor, verify_batch, [event_data for event_data, _ in batch])
+        except Exception as e:
+            logger.error(f"Failed to verify batch of {len(batch)} events: {e!r}")
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """Stop batching and shut down the worker pool"""
+        if self._batcher:
+            self._batcher.cancel()
+            self._batcher = None
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
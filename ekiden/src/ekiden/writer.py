@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from ekiden import metrics
+from ekiden.nips import CompactEvent
+from ekiden.settings import settings
+
+logger = logging.getLogger(__name__)
+
+Pending = Tuple[CompactEvent, asyncio.Future]
+
+
+class EventWriter:
+    """Writes events in group commits.
+
+    Events are collected for up to `batch_delay` seconds or `batch_size` events and handed to `commit` together,
+    so a burst of publishes pays for one commit instead of one per event. `write` only returns once the commit
+    holding the event is durable. `commit` writes a batch and returns whether each event was stored.
+    """
+
+    def __init__(
+        self,
+        commit: Callable[[List[CompactEvent]], Awaitable[List[bool]]],
+        batch_size: Optional[int] = None,
+        batch_delay: Optional[float] = None,
+    ):
+        self.commit = commit
+        self.batch_size = batch_size or settings.write_batch_size
+        self.batch_delay = batch_delay if batch_delay is not None else settings.write_batch_delay
+
+        self._pending: Optional[asyncio.Queue] = None
+        self._committer: Optional[asyncio.Task] = None
+
+    async def write(self, event: CompactEvent) -> bool:
+        """Queue the event and wait until it is committed.
+
+        Args:
+            event (CompactEvent): A verified event
+
+        Returns:
+            bool: True if the event was stored, False if it was already stored or the store declined it.
+        """
+        if self._committer is None:
+            self._pending = asyncio.Queue()
+            self._committer = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.put_nowait((event, future))
+        return await future
+
+    def _drain(self, batch: List[Pending]):
+        while len(batch) < self.batch_size and not self._pending.empty():
+            batch.append(self._pending.get_nowait())
+
+    async def _collect(self) -> List[Pending]:
+        batch = [await self._pending.get()]
+        self._drain(batch)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._pending.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+            self._drain(batch)
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._commit(batch)
+            except Exception as e:
+                logger.error(f"Group commit of {len(batch)} events failed, retrying individually: {e!r}")
+                for pending in batch:
+                    await self._commit_one(pending)
+
+    async def _commit(self, batch: List[Pending]):
+        started = time.perf_counter()
+        results = await self.commit([event for event, _ in batch])
+        metrics.commit_seconds.observe(time.perf_counter() - started)
+        metrics.commit_events.observe(len(batch))
+
+        for (_, future), stored in zip(batch, results):
+            if not future.done():
+                future.set_result(stored)
+
+    async def _commit_one(self, pending: Pending):
+        event, future = pending
+        if future.done():
+            return
+        try:
+            [stored] = await self.commit([event])
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(stored)
+
+    async def close(self):
+        if self._committer:
+            self._committer.cancel()
+            self._committer = None
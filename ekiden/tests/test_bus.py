@@ -0,0 +1,102 @@
+import asyncio
+import os
+import socket
+from typing import Tuple
+
+from ekiden.bus import LocalBus, UnixSocketBus, create_bus
+from ekiden.nips import CompactEvent
+from ekiden.settings import BusKind, settings
+
+
+def event(content: str) -> CompactEvent:
+    return CompactEvent(pubkey="ab" * 32, created_at=100, kind=1, tags=(), content=content)
+
+
+class Inbox:
+    """The events delivered to one worker"""
+
+    def __init__(self):
+        self.events: asyncio.Queue = asyncio.Queue()
+
+    async def deliver(self, event: CompactEvent):
+        self.events.put_nowait(event)
+
+    async def receive(self) -> str:
+        return (await asyncio.wait_for(self.events.get(), 5)).content
+
+
+async def start_unix_bus(directory, name: str) -> Tuple[UnixSocketBus, Inbox]:
+    bus = UnixSocketBus(directory=str(directory))
+    # every bus of the test runs in the same process, so they can not be told apart by pid
+    bus.path = os.path.join(bus.directory, f"{name}.sock")
+    inbox = Inbox()
+    await bus.start(inbox.deliver)
+    return bus, inbox
+
+
+def test_local_bus_delivers_to_its_worker():
+    async def main():
+        bus, inbox = LocalBus(), Inbox()
+        await bus.start(inbox.deliver)
+        await bus.publish(event("a"))
+        await bus.close()
+        return await inbox.receive()
+
+    assert asyncio.run(main()) == "a"
+
+
+def test_unix_bus_delivers_to_every_worker(tmp_path):
+    async def main():
+        first, first_inbox = await start_unix_bus(tmp_path, "first")
+        second, second_inbox = await start_unix_bus(tmp_path, "second")
+        try:
+            await first.publish(event("a"))
+            await second.publish(event("b"))
+            return [await inbox.receive() for inbox in (first_inbox, first_inbox, second_inbox, second_inbox)]
+        finally:
+            await first.close()
+            await second.close()
+
+    received = asyncio.run(main())
+
+    assert sorted(received[:2]) == sorted(received[2:]) == ["a", "b"]
+
+
+def test_unix_bus_finds_workers_started_later(tmp_path):
+    async def main():
+        first, first_inbox = await start_unix_bus(tmp_path, "first")
+        await first.publish(event("alone"))
+        second, second_inbox = await start_unix_bus(tmp_path, "second")
+        try:
+            await first.publish(event("together"))
+            return await first_inbox.receive(), await first_inbox.receive(), await second_inbox.receive()
+        finally:
+            await first.close()
+            await second.close()
+
+    assert asyncio.run(main()) == ("alone", "together", "together")
+
+
+def test_unix_bus_removes_stale_sockets(tmp_path):
+    stale = str(tmp_path / "gone.sock")
+    # bound but nobody listens, as left behind by a worker that was killed
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(stale)
+
+    async def main():
+        bus, inbox = await start_unix_bus(tmp_path, "first")
+        try:
+            await bus.publish(event("a"))
+            return await inbox.receive()
+        finally:
+            await bus.close()
+
+    assert asyncio.run(main()) == "a"
+    assert os.listdir(tmp_path) == []
+
+
+def test_create_bus_follows_the_settings(monkeypatch):
+    monkeypatch.setattr(settings, "broadcast_bus", BusKind.unix)
+    assert isinstance(create_bus(), UnixSocketBus)
+    monkeypatch.setattr(settings, "broadcast_bus", BusKind.local)
+    assert isinstance(create_bus(), LocalBus)
@@ -0,0 +1,122 @@
+import asyncio
+
+from ekiden.connections import Connection
+from ekiden.settings import SlowConsumerPolicy
+
+
+class StubWebSocket:
+    """Records the frames written to it, writes wait while `reading` is cleared"""
+
+    def __init__(self, reading: bool = True):
+        self.frames = []
+        self.closed = False
+        self.reading = asyncio.Event()
+        if reading:
+            self.reading.set()
+
+    async def send_text(self, frame: str):
+        await self.reading.wait()
+        self.frames.append(frame)
+
+    async def close(self):
+        self.closed = True
+
+
+async def drained(connection: Connection):
+    while connection.queue_depth:
+        await asyncio.sleep(0)
+
+
+def test_frames_are_written_in_order_and_the_queue_is_released():
+    async def main():
+        websocket = StubWebSocket()
+        connection = Connection(websocket, queue_size=10)
+        for number in range(5):
+            assert connection.push(str(number))
+        await connection.send("5")
+        await drained(connection)
+        await asyncio.sleep(0)
+        return websocket.frames, connection._frames, connection._writer
+
+    frames, queue, writer = asyncio.run(main())
+
+    assert frames == [str(number) for number in range(6)]
+    assert queue is None
+    assert writer is None
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    async def main():
+        websocket = StubWebSocket(reading=False)
+        connection = Connection(websocket, queue_size=3, policy=SlowConsumerPolicy.drop_oldest)
+        # the writer takes the first frame and waits on the socket with it
+        connection.push("0")
+        await asyncio.sleep(0)
+        accepted = [connection.push(str(number)) for number in range(1, 8)]
+
+        websocket.reading.set()
+        await drained(connection)
+        return websocket.frames, accepted, connection.dropped
+
+    frames, accepted, dropped = asyncio.run(main())
+
+    assert all(accepted)
+    assert frames == ["0", "5", "6", "7"]
+    assert dropped == 4
+
+
+def test_disconnect_policy_closes_a_slow_consumer():
+    async def main():
+        websocket = StubWebSocket(reading=False)
+        connection = Connection(websocket, queue_size=1, policy=SlowConsumerPolicy.disconnect, timeout=0.01)
+        connection.push("0")
+        await asyncio.sleep(0)
+        connection.push("1")
+
+        refused = connection.push("2")
+        await asyncio.sleep(0.02)
+        connection.push("3")
+        await asyncio.wait_for(connection._closing, 1)
+        return refused, connection.closed, websocket.closed, connection.push("4")
+
+    refused, closed, websocket_closed, after_close = asyncio.run(main())
+
+    assert not refused
+    assert closed and websocket_closed
+    assert not after_close
+
+
+def test_send_waits_for_room():
+    async def main():
+        websocket = StubWebSocket(reading=False)
+        connection = Connection(websocket, queue_size=1, timeout=1)
+        connection.push("0")
+        await asyncio.sleep(0)
+        connection.push("1")
+
+        waiting = asyncio.create_task(connection.send("2"))
+        await asyncio.sleep(0)
+        blocked = not waiting.done()
+        websocket.reading.set()
+        await asyncio.wait_for(waiting, 1)
+        await drained(connection)
+        return blocked, websocket.frames
+
+    blocked, frames = asyncio.run(main())
+
+    assert blocked
+    assert frames == ["0", "1", "2"]
+
+
+def test_send_disconnects_a_client_that_stops_reading():
+    async def main():
+        websocket = StubWebSocket(reading=False)
+        connection = Connection(websocket, queue_size=1, timeout=0.01)
+        connection.push("0")
+        await asyncio.sleep(0)
+        connection.push("1")
+
+        await asyncio.wait_for(connection.send("2"), 1)
+        return connection.closed, websocket.closed
+
+    assert asyncio.run(main()) == (True, True)
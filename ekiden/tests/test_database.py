@@ -0,0 +1,230 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+from tortoise import Tortoise
+
+from ekiden import database
+from ekiden.nips import CompactEvent, Filters, supersedes
+from ekiden.settings import settings
+from ekiden.storage import STORED_IDS_CHUNK_SIZE, SQLiteStore
+
+PUBKEY = "ab" * 32
+
+
+def event(created_at: int, kind: int = 0, content: str = "", pubkey: str = PUBKEY) -> CompactEvent:
+    return CompactEvent(pubkey=pubkey, created_at=created_at, kind=kind, tags=(), content=content, sig="00" * 64)
+
+
+def lowest_id_first(*events: CompactEvent):
+    return sorted(events, key=lambda e: e.id)
+
+
+@pytest.fixture
+def database_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "ekiden.sqlite3")
+    monkeypatch.setattr(settings, "database_path", path)
+    return path
+
+
+def run_with_store(scenario):
+    async def main():
+        store = SQLiteStore()
+        await store.start()
+        try:
+            return await scenario(store)
+        finally:
+            await store.close()
+
+    return asyncio.run(main())
+
+
+async def stored(store: SQLiteStore, **filters) -> list:
+    events = []
+    async for chunk in store.stream(Filters(**filters), 100, chunk_size=10):
+        events.extend(chunk)
+    return events
+
+
+def test_commit_skips_events_stored_already(database_path):
+    note, other = event(100, kind=1), event(101, kind=1)
+
+    async def scenario(store):
+        return [await store.commit([note, note, other]), await store.commit([other, note])], await stored(store)
+
+    results, events = run_with_store(scenario)
+
+    assert results == [[True, False, True], [False, False]]
+    assert [e.id for e in events] == [other.id, note.id]
+
+
+def legacy_database(path: str, rows):
+    # the `event` table of databases created before MIGRATIONS existed
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE "event" ("table_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, "id" TEXT NOT NULL, '
+        '"kind" INT NOT NULL, "content" TEXT NOT NULL, "created_at" INT NOT NULL, "tags" JSON NOT NULL, '
+        '"pubkey" TEXT NOT NULL, "sig" TEXT NOT NULL)'
+    )
+    connection.executemany(
+        'INSERT INTO "event" ("id", "kind", "content", "created_at", "tags", "pubkey", "sig") '
+        "VALUES (?, ?, ?, ?, '[]', ?, ?)",
+        [(e.id, e.kind, e.content, e.created_at, e.pubkey, e.sig) for e in rows],
+    )
+    connection.commit()
+    connection.close()
+
+
+def test_migrations_upgrade_a_legacy_database(database_path):
+    note = event(50, kind=1, content="note")
+    low, high = lowest_id_first(event(100, content="a"), event(100, content="b"))
+    contacts = event(90, kind=3)
+    legacy_database(database_path, [note, note, event(99), high, low, contacts, event(80, kind=3)])
+
+    events = run_with_store(stored)
+
+    # one copy of every id and the latest version of every replaceable event are kept
+    assert sorted(e.id for e in events) == sorted([note.id, low.id, contacts.id])
+
+    connection = sqlite3.connect(database_path)
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"uid_event_id", "uid_event_replaceable", "idx_event_created_at_id"} <= indexes
+    columns = {row[1] for row in connection.execute('PRAGMA table_info("event")')}
+    assert "raw" in columns
+    connection.close()
+
+
+def test_migrations_run_once(database_path):
+    async def scenario(store):
+        await store.commit([event(100, kind=1)])
+        await database.migrate()
+        return await stored(store)
+
+    assert len(run_with_store(scenario)) == 1
+    assert run_with_store(stored)[0].created_at == 100
+
+
+def test_commit_looks_up_large_batches_in_chunks(database_path):
+    events = [event(number, kind=1) for number in range(STORED_IDS_CHUNK_SIZE * 3)]
+
+    async def scenario(store):
+        first = await store.commit(events[::2])
+        return first, await store.commit(events)
+
+    first, second = run_with_store(scenario)
+
+    assert all(first)
+    assert second == [number % 2 == 1 for number in range(len(events))]
+
+
+def test_commits_are_synced_by_default(database_path):
+    async def scenario(store):
+        _, rows = await Tortoise.get_connection("default").execute_query("PRAGMA synchronous")
+        return rows[0][0]
+
+    # 2 is FULL, the WAL is synced before the OK of an event is sent
+    assert run_with_store(scenario) == 2
+
+
+def test_supersedes_prefers_newer_then_lowest_id():
+    low, high = lowest_id_first(event(100, content="a"), event(100, content="b"))
+
+    assert supersedes(event(101), event(100))
+    assert not supersedes(event(100), event(101))
+    assert supersedes(low, high)
+    assert not supersedes(high, low)
+    assert not supersedes(low, low)
+
+
+def test_replaceable_upsert_keeps_the_winner(database_path):
+    low, high = lowest_id_first(event(100, content="a"), event(100, content="b"))
+    older, newer = event(99, content="old"), event(101, content="new")
+
+    async def scenario(store):
+        results = [await store.commit([e]) for e in (high, older, low, high)]
+        kept = await stored(store, kinds=[0])
+        results.append(await store.commit([newer]))
+        return results, kept, await stored(store, kinds=[0])
+
+    results, kept, latest = run_with_store(scenario)
+
+    assert results == [[True], [False], [True], [False], [True]]
+    assert [e.id for e in kept] == [low.id]
+    assert [e.id for e in latest] == [newer.id]
+
+
+def test_replaceable_upsert_replaces_the_tag_index(database_path):
+    follows = CompactEvent(pubkey=PUBKEY, created_at=100, kind=3, tags=(("p", "cd" * 32),), content="", sig="00" * 64)
+    unfollowed = CompactEvent(
+        pubkey=PUBKEY, created_at=101, kind=3, tags=(("p", "ef" * 32),), content="", sig="00" * 64
+    )
+
+    async def scenario(store):
+        await store.commit([follows])
+        await store.commit([unfollowed])
+        return await stored(store, **{"#p": ["cd" * 32]}), await stored(store, **{"#p": ["ef" * 32]})
+
+    old_follow, new_follow = run_with_store(scenario)
+
+    assert old_follow == []
+    assert [e.id for e in new_follow] == [unfollowed.id]
+
+
+def test_metadata_that_is_not_an_object_is_stored(database_path):
+    async def scenario(store):
+        results = [await store.commit([e]) for e in (event(100, content="[1]"), event(101, content="not json"))]
+        await store.commit([event(102, content=json.dumps({"name": "hoshi", "about": 7}))])
+        identity = await database.Identity.get(pubkey=PUBKEY)
+        return results, identity
+
+    results, identity = run_with_store(scenario)
+
+    assert results == [[True], [True]]
+    assert (identity.name, identity.about) == ("hoshi", None)
+
+
+async def stored_json(store: SQLiteStore, **filters) -> list:
+    return [text async for chunk in store.stream_json(Filters(**filters), 100, chunk_size=10) for text in chunk]
+
+
+def test_replay_sends_the_stored_json(database_path):
+    note = CompactEvent(
+        pubkey=PUBKEY, created_at=100, kind=1, tags=(("e", "cd" * 32), ("t", "nostr")), content="hi", sig="00" * 64
+    )
+    # any JSON of the event is sent as it was stored
+    spaced = json.dumps(json.loads(note.json()), indent=1)
+
+    async def scenario(store):
+        await store.commit([note])
+        before = await stored_json(store)
+        await Tortoise.get_connection("default").execute_query('UPDATE "event" SET "raw" = ?', [spaced])
+        return before, await stored_json(store), await stored(store)
+
+    before, after, events = run_with_store(scenario)
+
+    assert before == [note.json()]
+    assert after == [spaced]
+    assert events[0].tags == note.tags
+    assert events[0].id == note.id
+
+
+def test_events_stored_without_json_are_converted_and_backfilled(database_path):
+    rows = [event(100 + number, kind=1, content=str(number)) for number in range(5)]
+    legacy_database(database_path, rows)
+    expected = [e.json() for e in reversed(rows)]
+
+    async def scenario(store):
+        converted = await stored_json(store)
+        backfilled = await database.backfill_raw(batch_size=2)
+        return converted, backfilled, await database.backfill_raw(), await stored_json(store)
+
+    converted, backfilled, again, replayed = run_with_store(scenario)
+
+    assert converted == expected
+    assert (backfilled, again) == (5, 0)
+    assert replayed == expected
+    connection = sqlite3.connect(database_path)
+    assert connection.execute('SELECT count(*) FROM "event" WHERE "raw" IS NULL').fetchone()[0] == 0
+    connection.close()
@@ -0,0 +1,187 @@
+import asyncio
+import os
+from typing import List
+
+import pytest
+
+from ekiden.bus import LocalBus
+from ekiden.eventlog import LogStore
+from ekiden.nips import CompactEvent, Filters
+from ekiden.relay import AsyncRelay
+from ekiden.settings import StorageKind, settings
+from ekiden.subscriptions import SubscriptionPool
+
+ALICE, BOB = "aa" * 32, "bb" * 32
+
+
+def event(created_at: int, kind: int = 1, pubkey: str = ALICE, tags=(), content: str = "") -> CompactEvent:
+    return CompactEvent(
+        pubkey=pubkey, created_at=created_at, kind=kind, tags=tuple(tuple(tag) for tag in tags), content=content
+    )
+
+
+def run_with_log(scenario, directory, **options):
+    async def main():
+        store = LogStore(directory=str(directory), sync=False, **options)
+        await store.start()
+        try:
+            return await scenario(store)
+        finally:
+            await store.close()
+
+    return asyncio.run(main())
+
+
+async def stored(store: LogStore, limit: int = 100, chunk_size: int = 100, **filters) -> List[str]:
+    """The ids of the events matching the filters, in the order they are streamed"""
+    return [e.id async for chunk in store.stream(Filters(**filters), limit, chunk_size) for e in chunk]
+
+
+def commit(directory, events, **options) -> List[bool]:
+    async def scenario(store):
+        return await store.commit(events)
+
+    return run_with_log(scenario, directory, **options)
+
+
+def test_events_are_recovered_from_the_log(tmp_path):
+    events = [event(100 + number, content=str(number)) for number in range(10)]
+
+    results = commit(tmp_path, events, segment_size=1024)
+    recovered = run_with_log(stored, tmp_path)
+
+    assert results == [True] * 10
+    # the small segments rolled over
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".log")]) > 1
+    assert recovered == [e.id for e in reversed(events)]
+
+
+def test_a_torn_record_at_the_end_is_truncated(tmp_path):
+    first, second = event(100, content="first"), event(200, content="second")
+    commit(tmp_path, [first])
+    [segment] = [tmp_path / name for name in os.listdir(tmp_path) if name.endswith(".log")]
+    size = segment.stat().st_size
+    with open(segment, "ab") as f:
+        f.write(b"\x40\x00\x00\x00torn")
+
+    recovered = run_with_log(stored, tmp_path)
+    commit(tmp_path, [second])
+
+    assert recovered == [first.id]
+    assert run_with_log(stored, tmp_path) == [second.id, first.id]
+    assert segment.stat().st_size > size
+
+
+def test_duplicates_are_not_appended(tmp_path):
+    first, second = event(100, content="first"), event(200, content="second")
+
+    assert commit(tmp_path, [first, first, second]) == [True, False, True]
+    assert commit(tmp_path, [second]) == [False]
+    assert run_with_log(stored, tmp_path) == [second.id, first.id]
+
+
+def test_only_the_latest_replaceable_event_is_kept(tmp_path):
+    older, newer, newest = event(100, kind=0, content="a"), event(200, kind=0, content="b"), event(300, kind=0)
+    other = event(50, kind=0, pubkey=BOB)
+
+    assert commit(tmp_path, [newer, older, other]) == [True, False, True]
+    # within a batch the newest one wins
+    assert commit(tmp_path, [newest, older]) == [True, False]
+
+    async def scenario(store):
+        return len(store), await stored(store, kinds=[0]), await stored(store, ids=[newer.id])
+
+    assert run_with_log(scenario, tmp_path) == (2, [newest.id, other.id], [])
+
+
+def test_filters_are_answered_from_the_indexes(tmp_path):
+    note = event(100, tags=[["p", BOB]], content="note")
+    reply = event(200, pubkey=BOB, tags=[["e", note.id], ["p", ALICE]], content="reply")
+    reaction = event(300, kind=7, tags=[["e", reply.id], ["p", BOB]], content="+")
+    profile = event(50, kind=0, pubkey=BOB)
+    commit(tmp_path, [note, reply, reaction, profile])
+
+    async def scenario(store):
+        return [
+            await stored(store, authors=[ALICE]),
+            await stored(store, authors=[BOB[:7]]),
+            await stored(store, kinds=[1, 7]),
+            await stored(store, authors=[BOB], kinds=[0]),
+            await stored(store, **{"#e": [note.id, reply.id]}),
+            await stored(store, **{"#p": [BOB]}, kinds=[1]),
+            await stored(store, since=100, until=300),
+            await stored(store, ids=[reply.id, note.id[:5], "not hex"]),
+            await stored(store, limit=2),
+        ]
+
+    assert run_with_log(scenario, tmp_path) == [
+        [reaction.id, note.id],
+        [reply.id, profile.id],
+        [reaction.id, reply.id, note.id],
+        [profile.id],
+        [reaction.id, reply.id],
+        [note.id],
+        [reply.id],
+        [reply.id, note.id],
+        [reaction.id, reply.id],
+    ]
+
+
+def test_pages_continue_below_the_last_event(tmp_path):
+    # events sharing a created_at are ordered by id
+    events = [event(100 + number // 3, content=str(number)) for number in range(20)]
+    commit(tmp_path, events)
+
+    async def scenario(store):
+        pages = [len(chunk) async for chunk in store.stream(Filters(authors=[ALICE]), 15, 4)]
+        return pages, await stored(store, chunk_size=3, limit=15), await stored(store, limit=15)
+
+    pages, paged, unpaged = run_with_log(scenario, tmp_path)
+
+    assert pages == [4, 4, 4, 3]
+    assert paged == unpaged
+    assert unpaged == [e.id for e in sorted(events, key=lambda e: (e.created_at, e.id), reverse=True)][:15]
+
+
+def test_id_prefixes_find_events_before_and_after_sorting(tmp_path):
+    events = [event(100, content=str(number)) for number in range(1500)]
+    commit(tmp_path, events[:1200])
+
+    async def scenario(store):
+        await store.commit(events[1200:])
+        return [await stored(store, ids=[e.id[:12]]) for e in (events[0], events[-1])]
+
+    assert run_with_log(scenario, tmp_path) == [[events[0].id], [events[-1].id]]
+
+
+def test_a_log_is_opened_by_one_store_at_a_time(tmp_path):
+    async def scenario(store):
+        other = LogStore(directory=str(tmp_path))
+        with pytest.raises(RuntimeError):
+            await other.start()
+
+    run_with_log(scenario, tmp_path)
+
+
+def test_the_relay_uses_the_configured_log_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "storage", StorageKind.log)
+    monkeypatch.setattr(settings, "log_directory", str(tmp_path / "configured"))
+    given = LogStore(directory=str(tmp_path / "given"))
+
+    configured = AsyncRelay(sub_pool=SubscriptionPool(), bus=LocalBus())
+    # an empty store is falsy
+    passed = AsyncRelay(sub_pool=SubscriptionPool(), bus=LocalBus(), storage=given)
+
+    assert isinstance(configured.storage, LogStore)
+    assert configured.storage.directory == str(tmp_path / "configured")
+    assert passed.storage is given
+
+
+def test_replay_sends_the_logged_json(tmp_path):
+    note = event(100, tags=[["t", "nostr"]], content="hi")
+    commit(tmp_path, [note])
+
+    async def scenario(store):
+        return [text async for chunk in store.stream_json(Filters(), 10, 10) for text in chunk]
+
+    assert run_with_log(scenario, tmp_path) == [note.json()]
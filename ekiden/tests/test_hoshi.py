@@ -0,0 +1,306 @@
+import asyncio
+import json
+import time
+from typing import List
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from ekiden import metrics
+from ekiden.bus import LocalBus
+from ekiden.hoshi import Hoshi, json_event_id
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent
+from ekiden.relay import AsyncRelay
+from ekiden.settings import settings
+from ekiden.storage import EventStore, SQLiteStore
+from ekiden.subscriptions import SubscriptionPool
+from ekiden.verification import Verifier
+
+KEY = PrivateKey()
+
+
+def signed(content: str = "hello", kind: int = 1, tags=(), created_at: int = 0, key: PrivateKey = KEY) -> dict:
+    event = CompactEvent(
+        pubkey=key.public_key_hex(),
+        created_at=created_at or int(time.time()),
+        kind=kind,
+        tags=tuple(tuple(tag) for tag in tags),
+        content=content,
+    )
+    event.sig = key.sign(bytes.fromhex(event.id))
+    return event.dict()
+
+
+class StubWebSocket:
+    """Frames put in `incoming` are received by the relay, None disconnects. Sent frames land in `outgoing`."""
+
+    def __init__(self):
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+
+    async def accept(self):
+        pass
+
+    async def receive_text(self) -> str:
+        text = await self.incoming.get()
+        if text is None:
+            raise WebSocketDisconnect()
+        return text
+
+    async def send_text(self, text: str):
+        self.outgoing.put_nowait(text)
+
+    async def close(self):
+        pass
+
+
+class Client:
+    def __init__(self, hoshi: Hoshi):
+        self.websocket = StubWebSocket()
+        self.task = asyncio.create_task(hoshi.endpoint(self.websocket))
+
+    def send(self, *message):
+        self.websocket.incoming.put_nowait(json.dumps(message))
+
+    async def receive(self) -> list:
+        return json.loads(await asyncio.wait_for(self.websocket.outgoing.get(), 5))
+
+    async def replay(self, subscription_id: str, *filters: dict) -> List[dict]:
+        """REQ the filters and collect the events sent before EOSE"""
+        self.send("REQ", subscription_id, *filters)
+        events = []
+        while True:
+            message = await self.receive()
+            if message == ["EOSE", subscription_id]:
+                return events
+            assert message[:2] == ["EVENT", subscription_id], message
+            events.append(message[2])
+
+    async def close(self):
+        self.websocket.incoming.put_nowait(None)
+        await asyncio.wait_for(self.task, 5)
+
+
+async def publish(client: Client, *events: dict) -> List[list]:
+    """Send the events and collect their OKs"""
+    for event in events:
+        client.send("EVENT", event)
+    return [await client.receive() for _ in events]
+
+
+@pytest.fixture
+def database_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "ekiden.sqlite3")
+    monkeypatch.setattr(settings, "database_path", path)
+    return path
+
+
+def run_hoshi(scenario, storage: EventStore = None):
+    async def main():
+        hoshi = Hoshi()
+        hoshi.sub_pool = SubscriptionPool()
+        hoshi.relay = AsyncRelay(
+            sub_pool=hoshi.sub_pool,
+            verifier=Verifier(workers=1),
+            storage=storage if storage is not None else SQLiteStore(),
+            bus=LocalBus(),
+        )
+        hoshi.connections = set()
+        hoshi.query_slots = asyncio.Semaphore(settings.max_concurrent_queries)
+        await hoshi.relay.start()
+        try:
+            return await scenario(hoshi)
+        finally:
+            await hoshi.relay.close()
+
+    return asyncio.run(main())
+
+
+class FailingStore(SQLiteStore):
+    def stream_json(self, filters, limit, chunk_size):
+        async def fail():
+            raise RuntimeError("too many SQL variables")
+            yield
+
+        return fail()
+
+
+def test_filters_with_too_many_values_are_refused(database_path):
+    async def scenario(hoshi):
+        client = Client(hoshi)
+        client.send("REQ", "sub", {"kinds": list(range(settings.max_filter_values + 1))})
+        notice = await client.receive()
+        events = await client.replay("other", {"kinds": list(range(settings.max_filter_values))})
+        await client.close()
+        return notice, events, len(hoshi.sub_pool)
+
+    notice, events, subscriptions = run_hoshi(scenario)
+
+    assert notice == ["NOTICE", f"invalid: REQ sub has more than {settings.max_filter_values} values in a filter"]
+    assert events == []
+    assert subscriptions == 0
+
+
+def test_failed_replay_is_answered_with_a_notice(database_path):
+    async def scenario(hoshi):
+        client = Client(hoshi)
+        # a tag filter is left to storage
+        client.send("REQ", "sub", {"#p": ["ab" * 32]})
+        notice = await client.receive()
+        subscriptions = len(hoshi.sub_pool)
+        await client.close()
+        return notice, subscriptions
+
+    notice, subscriptions = run_hoshi(scenario, storage=FailingStore())
+
+    assert notice == ["NOTICE", "error: could not replay REQ sub, it was closed"]
+    assert subscriptions == 0
+
+
+def test_limits_are_clamped_before_the_replay(database_path):
+    events = [signed(str(number), created_at=int(time.time()) - number) for number in range(3)]
+
+    async def scenario(hoshi):
+        client = Client(hoshi)
+        await publish(client, *events)
+        replays = [await client.replay(str(limit), {"kinds": [1], "limit": limit}) for limit in (0, -1, 2, None)]
+        live = signed("live")
+        client.send("EVENT", live)
+        # the subscription with a limit of 0 gets new events like any other
+        frames = [await client.receive() for _ in range(5)]
+        await client.close()
+        return replays, live, frames
+
+    replays, live, frames = run_hoshi(scenario)
+
+    assert [[event["id"] for event in replay] for replay in replays] == [
+        [],
+        [],
+        [events[0]["id"], events[1]["id"]],
+        [event["id"] for event in events],
+    ]
+    assert sorted(frame[1] for frame in frames if frame[0] == "EVENT") == ["-1", "0", "2", "None"]
+    assert all(frame[2] == live for frame in frames if frame[0] == "EVENT")
+
+
+def test_frames_that_are_not_json_get_a_notice(database_path):
+    async def scenario(hoshi):
+        client = Client(hoshi)
+        errors = metrics.decode_errors.value
+        client.websocket.incoming.put_nowait("not json")
+        notice = await client.receive()
+        # the connection keeps reading
+        events = await client.replay("sub", {"kinds": [1]})
+        await client.close()
+        return notice, events, metrics.decode_errors.value - errors
+
+    notice, events, errors = run_hoshi(scenario)
+
+    assert notice == ["NOTICE", "invalid: message is not valid JSON"]
+    assert events == []
+    assert errors == 1
+
+
+def test_connections_over_their_rates_are_refused(database_path, monkeypatch):
+    monkeypatch.setattr(settings, "event_rate", 0.001)
+    monkeypatch.setattr(settings, "event_burst", 1)
+    monkeypatch.setattr(settings, "request_rate", 0.001)
+    monkeypatch.setattr(settings, "request_burst", 1)
+    first, second = signed("first"), signed("second")
+
+    async def scenario(hoshi):
+        client = Client(hoshi)
+        oks = await publish(client, first, second)
+        events = await client.replay("sub", {"kinds": [1]})
+        client.send("REQ", "again", {"kinds": [1]})
+        notice = await client.receive()
+        await client.close()
+        return oks, events, notice
+
+    oks, events, notice = run_hoshi(scenario)
+
+    assert oks == [["OK", first["id"], True, ""], ["OK", second["id"], False, "rate-limited: slow down"]]
+    assert events == [first]
+    assert notice == ["NOTICE", "rate-limited: slow down, REQ again was ignored"]
+
+
+def test_events_sent_just_before_a_disconnect_are_delivered(database_path):
+    other = PrivateKey()
+    events = [signed(str(number), key=other) for number in range(3)]
+
+    async def scenario(hoshi):
+        subscriber = Client(hoshi)
+        await subscriber.replay("feed", {"authors": [other.public_key_hex()]})
+        publisher = Client(hoshi)
+        for event in events:
+            publisher.send("EVENT", event)
+        # the disconnect is read while the events are still being verified
+        await publisher.close()
+        delivered = [await subscriber.receive() for _ in events]
+        replayed = await subscriber.replay("again", {"authors": [other.public_key_hex()]})
+        await subscriber.close()
+        return delivered, replayed
+
+    delivered, replayed = run_hoshi(scenario)
+
+    assert sorted(message[2]["id"] for message in delivered) == sorted(event["id"] for event in events)
+    assert all(message[:2] == ["EVENT", "feed"] for message in delivered)
+    assert sorted(event["id"] for event in replayed) == sorted(event["id"] for event in events)
+
+
+async def receive_until(client: Client, last: list) -> List[list]:
+    """The messages received up to and without `last`"""
+    messages = []
+    while (message := await client.receive()) != last:
+        messages.append(message)
+    return messages
+
+
+def test_events_matching_several_filters_are_replayed_once(database_path):
+    tagged = signed("tagged", tags=[["e", "cd" * 32], ["p", "ab" * 32]])
+    plain = signed("plain")
+
+    async def scenario(hoshi):
+        client = Client(hoshi)
+        await publish(client, tagged, plain)
+        # from the recent window and storage, then from storage only
+        mixed = await client.replay("mixed", {"kinds": [1]}, {"#e": ["cd" * 32]})
+        stored = await client.replay("stored", {"#e": ["cd" * 32]}, {"#p": ["ab" * 32]})
+        single = await client.replay("single", {"#e": ["cd" * 32]})
+        await client.close()
+        return mixed, stored, single
+
+    mixed, stored, single = run_hoshi(scenario)
+
+    assert sorted(event["id"] for event in mixed) == sorted([tagged["id"], plain["id"]])
+    assert stored == single == [tagged]
+
+
+def test_event_ids_are_read_from_the_event_json():
+    event = CompactEvent.from_dict(signed())
+    spaced = json.dumps(json.loads(event.json()), indent=1)
+
+    assert json_event_id(event.json()) == json_event_id(spaced) == event.id
+
+
+def test_a_req_with_the_same_id_replaces_the_subscription(database_path):
+    profile, note = signed("profile", kind=0), signed("note")
+
+    async def scenario(hoshi):
+        subscriber, publisher = Client(hoshi), Client(hoshi)
+        await subscriber.replay("sub", {"kinds": [0]})
+        await subscriber.replay("sub", {"kinds": [1]})
+        subscriptions = len(hoshi.sub_pool)
+        await publish(publisher, profile, note)
+        # the broadcasts are queued before the OKs are sent
+        subscriber.send("REQ", "probe", {"kinds": [7]})
+        received = await receive_until(subscriber, ["EOSE", "probe"])
+        await subscriber.close()
+        await publisher.close()
+        return subscriptions, received
+
+    subscriptions, received = run_hoshi(scenario)
+
+    assert subscriptions == 1
+    assert received == [["EVENT", "sub", note]]
@@ -0,0 +1,68 @@
+import pytest
+
+from ekiden import limits
+from ekiden.limits import ConnectionLimits, KeyedBuckets, TokenBucket
+from ekiden.settings import settings
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(limits.time, "monotonic", clock)
+    return clock
+
+
+def takes(bucket, count: int) -> list:
+    return [bucket.take() for _ in range(count)]
+
+
+def test_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+
+    assert takes(bucket, 4) == [True, True, True, False]
+    clock.now += 0.5
+    assert takes(bucket, 2) == [True, False]
+    # tokens do not pile up beyond the burst
+    clock.now += 60
+    assert takes(bucket, 4) == [True, True, True, False]
+
+
+def test_bucket_without_a_rate_never_limits(clock):
+    assert all(takes(TokenBucket(rate=0, burst=1), 100))
+
+
+def test_keyed_buckets_limit_each_key(clock):
+    buckets = KeyedBuckets(rate=1, burst=2, maxsize=2)
+
+    assert [buckets.take("a") for _ in range(3)] == [True, True, False]
+    assert buckets.take("b")
+    # the least recently limited key is forgotten and starts over
+    buckets.take("c")
+    assert buckets.take("a")
+
+
+def test_keyed_buckets_without_a_rate_keep_no_buckets(clock):
+    buckets = KeyedBuckets(rate=0, burst=1, maxsize=10)
+
+    assert all(buckets.take(str(number)) for number in range(100))
+    assert len(buckets._buckets) == 0
+
+
+def test_connection_limits_default_to_the_settings(clock, monkeypatch):
+    monkeypatch.setattr(settings, "event_rate", 5)
+    monkeypatch.setattr(settings, "event_burst", 7)
+
+    defaults, given = ConnectionLimits(), ConnectionLimits(event_rate=0, request_rate=1, request_burst=2)
+
+    assert (defaults.events.rate, defaults.events.burst) == (5, 7)
+    assert (defaults.requests.rate, defaults.requests.burst) == (settings.request_rate, settings.request_burst)
+    assert given.events.rate == 0
+    assert (given.requests.rate, given.requests.burst) == (1, 2)
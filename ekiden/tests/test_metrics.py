@@ -0,0 +1,59 @@
+from ekiden import metrics
+from ekiden.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter_renders_its_total():
+    counter = Counter("ekiden_things_total", "Things")
+    counter.inc()
+    counter.inc(2)
+
+    assert counter.render() == "\n".join(
+        ["# HELP ekiden_things_total Things", "# TYPE ekiden_things_total counter", "ekiden_things_total 3"]
+    )
+
+
+def test_gauge_reads_its_function_at_scrape_time():
+    size = [1]
+    gauge = Gauge("ekiden_size", "Size", function=lambda: size[0])
+    size[0] = 5
+    plain = Gauge("ekiden_value", "Value")
+    plain.set(2)
+    plain.dec(0.5)
+
+    assert gauge.samples() == ["ekiden_size 5"]
+    assert plain.samples() == ["ekiden_value 1.5"]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("ekiden_seconds", "Seconds", buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 2, 3):
+        histogram.observe(value)
+
+    assert histogram.samples() == [
+        'ekiden_seconds_bucket{le="0.1"} 2',
+        'ekiden_seconds_bucket{le="1"} 3',
+        'ekiden_seconds_bucket{le="+Inf"} 5',
+        "ekiden_seconds_sum 5.65",
+        "ekiden_seconds_count 5",
+    ]
+
+
+def test_registry_renders_every_metric():
+    registry = Registry()
+    registry.counter("ekiden_a_total", "A").inc()
+    registry.histogram("ekiden_b", "B", buckets=(1,))
+
+    rendered = registry.render()
+
+    assert rendered.endswith("\n")
+    assert "ekiden_a_total 1\n# HELP ekiden_b B\n" in rendered
+    assert 'ekiden_b_bucket{le="1"} 0' in rendered
+
+
+def test_relay_metrics_are_registered_once():
+    rendered = metrics.registry.render()
+    names = [metric.name for metric in metrics.registry._metrics]
+
+    assert "# TYPE ekiden_events_received_total counter" in rendered
+    assert "# TYPE ekiden_verify_seconds histogram" in rendered
+    assert len(names) == len(set(names))
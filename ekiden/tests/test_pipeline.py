@@ -0,0 +1,163 @@
+import asyncio
+from typing import List
+
+from ekiden.pipeline import FramePipeline
+
+
+async def settle():
+    """Let every task that is not waiting on something run as far as it can"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class Sent:
+    """Records the frames sent"""
+
+    def __init__(self):
+        self.frames: List[str] = []
+
+    async def __call__(self, frame: str):
+        self.frames.append(frame)
+
+
+def test_ordered_responses_keep_the_frame_order():
+    async def main():
+        pipeline = FramePipeline(max_in_flight=8)
+        sent = Sent()
+        responses = [asyncio.get_running_loop().create_future() for _ in range(5)]
+
+        for response in responses:
+            await pipeline.ordered(response, sent)
+        for number in (1, 4, 3, 2):
+            responses[number].set_result(f"OK {number}")
+        await settle()
+        # the first response holds up the ones after it
+        held = list(sent.frames)
+        responses[0].set_result("OK 0")
+        await pipeline.close()
+        return held, sent.frames
+
+    held, frames = asyncio.run(main())
+
+    assert held == []
+    assert frames == [f"OK {number}" for number in range(5)]
+
+
+def test_failed_handler_does_not_hold_up_later_responses():
+    async def main():
+        pipeline = FramePipeline(max_in_flight=8)
+        sent = Sent()
+        responses = [asyncio.get_running_loop().create_future() for _ in range(3)]
+
+        for response in responses:
+            await pipeline.ordered(response, sent)
+        responses[2].set_result("OK 2")
+        responses[1].set_exception(RuntimeError("handler failed"))
+        responses[0].set_result("OK 0")
+        await pipeline.close()
+        return sent.frames
+
+    assert asyncio.run(main()) == ["OK 0", "OK 2"]
+
+
+def test_cancel_stops_the_replay():
+    async def main():
+        pipeline = FramePipeline(max_in_flight=8)
+        sent = Sent()
+        events: asyncio.Queue = asyncio.Queue()
+
+        async def replay():
+            while True:
+                event = await events.get()
+                await sent(event)
+                if event == "EOSE":
+                    return
+
+        await pipeline.replay("sub", replay())
+        events.put_nowait("event")
+        await settle()
+        await pipeline.cancel("sub")
+        events.put_nowait("EOSE")
+        await settle()
+        return sent.frames, len(pipeline)
+
+    frames, running = asyncio.run(main())
+
+    assert frames == ["event"]
+    assert running == 0
+
+
+def test_new_req_replaces_the_replay_with_the_same_id():
+    async def main():
+        pipeline = FramePipeline(max_in_flight=8)
+        finished = []
+
+        async def replay(name, wait=False):
+            try:
+                if wait:
+                    await asyncio.get_running_loop().create_future()
+                finished.append(name)
+            except asyncio.CancelledError:
+                finished.append(f"{name} cancelled")
+                raise
+
+        await pipeline.replay("sub", replay("first", wait=True))
+        await pipeline.replay("other", replay("other", wait=True))
+        await settle()
+        await pipeline.replay("sub", replay("second"))
+        await settle()
+        replaced = list(finished)
+        await pipeline.close()
+        return replaced, finished
+
+    replaced, finished = asyncio.run(main())
+
+    assert replaced == ["first cancelled", "second"]
+    assert finished == ["first cancelled", "second", "other cancelled"]
+
+
+def test_spawn_waits_for_a_free_slot():
+    async def main():
+        pipeline = FramePipeline(max_in_flight=2)
+        release = asyncio.Event()
+
+        for _ in range(2):
+            await pipeline.spawn(release.wait())
+        third = asyncio.create_task(pipeline.spawn(asyncio.sleep(0)))
+        await settle()
+        blocked = not third.done()
+
+        release.set()
+        await asyncio.wait_for(third, 1)
+        await pipeline.close()
+        return blocked
+
+    assert asyncio.run(main())
+
+
+def test_close_cancels_the_replays_and_lets_the_other_handlers_finish():
+    async def main():
+        pipeline = FramePipeline(max_in_flight=8)
+        sent = Sent()
+        stored = asyncio.get_running_loop().create_future()
+        replay_cancelled = asyncio.Event()
+
+        async def replay():
+            try:
+                await asyncio.get_running_loop().create_future()
+            except asyncio.CancelledError:
+                replay_cancelled.set()
+                raise
+
+        await pipeline.ordered(stored, sent)
+        await pipeline.replay("sub", replay())
+        closing = asyncio.create_task(pipeline.close())
+        await asyncio.wait_for(replay_cancelled.wait(), 1)
+        await settle()
+        # the event is still being written
+        waiting = not closing.done()
+        stored.set_result("OK")
+        await asyncio.wait_for(closing, 1)
+        return waiting, sent.frames, len(pipeline)
+
+    assert asyncio.run(main()) == (True, ["OK"], 0)
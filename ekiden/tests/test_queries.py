@@ -0,0 +1,90 @@
+import sqlite3
+
+from ekiden.nips import Filters
+from ekiden.queries import plan, prefix_clause, prefix_upper_bound
+from ekiden.settings import settings
+
+FULL_ID = "ab" * 32
+
+
+def test_prefix_upper_bound():
+    assert prefix_upper_bound("ab") == "ac"
+    assert prefix_upper_bound("a9") == "a:"
+    assert prefix_upper_bound("0f") == "0g"
+
+
+def test_prefix_clause_splits_exact_values_and_prefixes():
+    params = []
+    clause = prefix_clause("id", [FULL_ID, "cd", "f"], params)
+
+    assert clause == '("id" IN (?) OR ("id" >= ? AND "id" < ?) OR ("id" >= ? AND "id" < ?))'
+    assert params == [FULL_ID, "cd", "ce", "f", "g"]
+
+
+def test_prefix_clause_without_values_matches_everything():
+    params = []
+
+    assert prefix_clause("pubkey", [""], params) == "1"
+    assert params == []
+
+
+def test_plan_without_filters():
+    query = plan(Filters(), 10)
+
+    assert query.sql.endswith('FROM "event" WHERE 1 ORDER BY "created_at" DESC, "id" DESC LIMIT ?')
+    assert query.params == [10]
+
+
+def test_plan_params_follow_clauses():
+    query = plan(Filters(ids=["ab"], kinds=[1, 7], since=5, until=9, **{"#p": [FULL_ID]}), 20, after=(8, FULL_ID))
+
+    assert query.sql.count("?") == len(query.params)
+    assert query.params == ["ab", "ac", 1, 7, 5, 9, "p", FULL_ID, 8, 8, FULL_ID, 20]
+
+
+def test_plan_runs_against_the_schema():
+    # every shape of filter has to be valid SQL and page on (created_at, id)
+    connection = sqlite3.connect(":memory:")
+    connection.executescript(
+        'CREATE TABLE "event" ("table_id" INTEGER PRIMARY KEY, "id" TEXT, "pubkey" TEXT, "created_at" INT, '
+        '"kind" INT, "tags" TEXT, "content" TEXT, "sig" TEXT, "raw" TEXT);'
+        'CREATE TABLE "event_tag" ("id" INTEGER PRIMARY KEY, "event_id" INT, "name" TEXT, "value" TEXT);'
+    )
+    rows = [(f"{number:064x}", FULL_ID, number // 2, number % 3) for number in range(10)]
+    connection.executemany('INSERT INTO "event" ("id", "pubkey", "created_at", "kind") VALUES (?, ?, ?, ?)', rows)
+    connection.execute('INSERT INTO "event_tag" ("event_id", "name", "value") VALUES (3, \'p\', ?)', [FULL_ID])
+
+    def ids(filters, limit=100, after=None):
+        query = plan(filters, limit, after)
+        return [row[0] for row in connection.execute(query.sql, query.params)]
+
+    newest_first = [row[0] for row in sorted(rows, key=lambda row: (row[2], row[0]), reverse=True)]
+    assert ids(Filters()) == newest_first
+    assert ids(Filters(), limit=3) + ids(Filters(), after=(3, newest_first[2])) == newest_first
+    assert ids(Filters(since=1, until=4)) == [rows[number][0] for number in (7, 6, 5, 4)]
+    assert ids(Filters(ids=[rows[9][0], "0" * 63 + "1"], kinds=[0])) == [rows[9][0]]
+    assert ids(Filters(authors=["ab"], kinds=[2])) == [rows[number][0] for number in (8, 5, 2)]
+    assert ids(Filters(**{"#p": [FULL_ID]})) == [rows[2][0]]
+
+
+def test_plan_of_the_largest_filters_stays_under_the_parameter_limit():
+    connection = sqlite3.connect(":memory:")
+    connection.executescript(
+        'CREATE TABLE "event" ("table_id" INTEGER PRIMARY KEY, "id" TEXT, "pubkey" TEXT, "created_at" INT, '
+        '"kind" INT, "tags" TEXT, "content" TEXT, "sig" TEXT, "raw" TEXT);'
+        'CREATE TABLE "event_tag" ("id" INTEGER PRIMARY KEY, "event_id" INT, "name" TEXT, "value" TEXT);'
+    )
+    values = [f"{number:04x}" for number in range(settings.max_filter_values)]
+    full = [value * 16 for value in values]
+    filters = Filters(
+        ids=values,
+        authors=values,
+        kinds=list(range(settings.max_filter_values)),
+        since=1,
+        until=2,
+        **{"#e": full, "#p": full},
+    )
+
+    query = plan(filters, 10, after=(1, full[0]))
+
+    assert connection.execute(query.sql, query.params).fetchall() == []
@@ -0,0 +1,100 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from ekiden.readers import ReaderPool
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    path = str(tmp_path / "ekiden.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("CREATE TABLE event (id TEXT PRIMARY KEY, kind INT)")
+    connection.executemany("INSERT INTO event VALUES (?, ?)", [("a", 1), ("b", 7)])
+    connection.commit()
+    connection.close()
+    return path
+
+
+def run_with_readers(scenario, path: str, size: int = 2):
+    async def main():
+        readers = ReaderPool(path=path, size=size)
+        await readers.start()
+        try:
+            return await scenario(readers)
+        finally:
+            await readers.close()
+
+    return asyncio.run(main())
+
+
+def test_rows_are_fetched_by_column_name(database_path):
+    async def scenario(readers):
+        return await readers.fetch("SELECT id, kind FROM event WHERE kind > ? ORDER BY id", [0])
+
+    rows = run_with_readers(scenario, database_path)
+
+    assert [(row["id"], row["kind"]) for row in rows] == [("a", 1), ("b", 7)]
+
+
+def test_connections_are_read_only(database_path):
+    async def scenario(readers):
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            await readers.fetch("INSERT INTO event VALUES (?, ?)", ["c", 1])
+
+    run_with_readers(scenario, database_path)
+
+
+def test_reads_do_not_wait_for_a_write_transaction(database_path):
+    writer = sqlite3.connect(database_path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("INSERT INTO event VALUES ('c', 1)")
+
+    async def scenario(readers):
+        return await asyncio.wait_for(readers.fetch("SELECT count(*) AS events FROM event", []), 1)
+
+    try:
+        [row] = run_with_readers(scenario, database_path)
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+
+    # the last committed snapshot
+    assert row["events"] == 2
+
+
+def test_queries_beyond_the_pool_size_wait_for_a_connection(database_path):
+    async def scenario(readers):
+        release = asyncio.Event()
+        running = []
+        full = asyncio.Event()
+
+        def gated(execute_fetchall):
+            async def run(sql, params):
+                running.append(sql)
+                if len(running) == readers.size:
+                    full.set()
+                await release.wait()
+                return await execute_fetchall(sql, params)
+
+            return run
+
+        for connection in readers._connections:
+            connection.execute_fetchall = gated(connection.execute_fetchall)
+
+        fetches = [asyncio.create_task(readers.fetch(f"SELECT {number}", [])) for number in range(3)]
+        await asyncio.wait_for(full.wait(), 1)
+        # let the third fetch run as far as it can
+        for _ in range(10):
+            await asyncio.sleep(0)
+        started = list(running)
+        release.set()
+        rows = await asyncio.wait_for(asyncio.gather(*fetches), 1)
+        return started, [row[0][0] for row in rows]
+
+    started, results = run_with_readers(scenario, database_path)
+
+    assert started == ["SELECT 0", "SELECT 1"]
+    assert results == [0, 1, 2]
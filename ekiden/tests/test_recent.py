@@ -0,0 +1,124 @@
+import asyncio
+from typing import AsyncIterator, List
+
+from ekiden import metrics
+from ekiden.nips import CompactEvent, Filters
+from ekiden.recent import RecentEvents, event_size
+from ekiden.storage import EventStore
+from ekiden.subscriptions import FilterMatcher
+
+PUBKEY = "ab" * 32
+OTHER = "cd" * 32
+
+
+def event(created_at: int, kind: int = 1, pubkey: str = PUBKEY, tags=(), content: str = "") -> CompactEvent:
+    return CompactEvent(pubkey=pubkey, created_at=created_at, kind=kind, tags=tags, content=content)
+
+
+def window(*events: CompactEvent, max_count: int = 100, max_bytes: int = 10**9) -> RecentEvents:
+    recent = RecentEvents(max_count=max_count, max_bytes=max_bytes)
+    recent.loaded = True
+    for e in events:
+        recent.add(e)
+    return recent
+
+
+def query(recent: RecentEvents, limit: int = 100, **filters):
+    results = recent.query(FilterMatcher(Filters(**filters)), limit)
+    return None if results is None else [e.created_at for e in results]
+
+
+def test_queries_are_answered_newest_first():
+    recent = window(*(event(t, kind=t % 2, pubkey=PUBKEY if t < 5 else OTHER) for t in range(10)))
+
+    assert query(recent) == list(range(9, -1, -1))
+    assert query(recent, limit=3) == [9, 8, 7]
+    assert query(recent, kinds=[1]) == [9, 7, 5, 3, 1]
+    assert query(recent, authors=[PUBKEY], kinds=[0]) == [4, 2, 0]
+    assert query(recent, since=3, until=6) == [5, 4]
+
+
+def test_evicting_sets_the_floor():
+    recent = window(*(event(t) for t in range(10)), max_count=5)
+
+    assert len(recent) == 5
+    assert recent.floor[0] == 4
+    assert query(recent, limit=5) == [9, 8, 7, 6, 5]
+    # older events may be stored, only storage can answer
+    assert query(recent, limit=10) is None
+    assert query(recent, since=3, limit=10) is None
+    assert query(recent, since=4, limit=10) == [9, 8, 7, 6, 5]
+    # events older than the window are left to storage
+    recent.add(event(2))
+    assert len(recent) == 5
+
+
+def test_the_window_is_bounded_by_size():
+    events = [event(t, content="x" * 1000) for t in range(10)]
+    recent = window(*events, max_bytes=event_size(events[0]) * 3)
+
+    assert len(recent) == 3
+    assert recent.size <= recent.max_bytes
+
+
+def test_ids_are_looked_up_directly():
+    events = [event(t) for t in range(10)]
+    recent = window(*events, max_count=5)
+
+    assert query(recent, ids=[events[9].id, events[7].id]) == [9, 7]
+    # an evicted id could be stored
+    assert query(recent, ids=[events[9].id, events[1].id]) is None
+    assert query(recent, ids=[events[9].id[:8]]) is None
+
+
+def test_tag_filters_are_left_to_storage():
+    recent = window(event(1, tags=(("p", OTHER),)))
+    misses = metrics.recent_misses.value
+
+    assert query(recent, **{"#p": [OTHER]}) is None
+    assert query(recent, authors=["ab"]) is None
+    assert metrics.recent_misses.value == misses + 2
+
+
+def test_nothing_is_answered_before_loading():
+    recent = RecentEvents(max_count=10, max_bytes=10**9)
+    recent.add(event(1))
+
+    assert query(recent) is None
+
+
+def test_replaced_versions_are_discarded():
+    old, new = event(1, kind=0, content="old"), event(2, kind=0, content="new")
+    recent = window(old)
+
+    assert recent.discard_replaced(new)
+    recent.add(new)
+    assert query(recent, kinds=[0]) == [2]
+    # an older version arriving late is not added
+    assert not recent.discard_replaced(old)
+    assert query(recent, kinds=[0]) == [2]
+
+
+class ListStore(EventStore):
+    def __init__(self, events: List[CompactEvent]):
+        self.events = sorted(events, key=lambda e: (e.created_at, e.id), reverse=True)
+
+    async def commit(self, events):
+        raise NotImplementedError
+
+    async def stream(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[CompactEvent]]:
+        events = self.events[:limit]
+        for start in range(0, len(events), chunk_size):
+            yield events[start : start + chunk_size]
+
+
+def test_loading_a_full_window_sets_the_floor():
+    roomy, full = RecentEvents(max_count=20), RecentEvents(max_count=5)
+    store = ListStore([event(t) for t in range(10)])
+    asyncio.run(roomy.load(store))
+    asyncio.run(full.load(store))
+
+    assert roomy.floor is None
+    assert query(roomy, limit=50) == list(range(9, -1, -1))
+    assert full.floor[0] == 5
+    assert query(full, limit=50) is None
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List
+
+import pytest
+
+from ekiden.bus import LocalBus
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, Filters
+from ekiden.relay import AsyncRelay
+from ekiden.settings import settings
+from ekiden.storage import EventStore
+from ekiden.subscriptions import FilterMatcher, SubscriptionPool
+
+KEY = PrivateKey()
+
+
+def signed(content: str = "hello", kind: int = 1, created_at: int = 0, key: PrivateKey = KEY) -> dict:
+    event = CompactEvent(
+        pubkey=key.public_key_hex(), created_at=created_at or int(time.time()), kind=kind, tags=(), content=content
+    )
+    event.sig = key.sign(bytes.fromhex(event.id))
+    return event.dict()
+
+
+class MemoryStore(EventStore):
+    """Keeps the committed events in a dict"""
+
+    def __init__(self):
+        self.events: Dict[str, CompactEvent] = {}
+
+    async def commit(self, events: List[CompactEvent]) -> List[bool]:
+        results = []
+        for event in events:
+            results.append(event.id not in self.events)
+            self.events.setdefault(event.id, event)
+        return results
+
+    async def stream(self, filters: Filters, limit: int, chunk_size: int) -> AsyncIterator[List[CompactEvent]]:
+        matcher = FilterMatcher(filters)
+        events = sorted(self.events.values(), key=lambda event: (event.created_at, event.id), reverse=True)
+        matching = [event for event in events if matcher.matches(event)][:limit]
+        for start in range(0, len(matching), chunk_size):
+            yield matching[start : start + chunk_size]
+
+
+class StubVerifier:
+    """Counts the events it is asked to verify, `verify` raises `error` when one is set"""
+
+    def __init__(self, error: BaseException = None):
+        self.error = error
+        self.calls = 0
+
+    async def verify(self, event_data: dict) -> CompactEvent:
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return CompactEvent.from_dict(event_data)
+
+    async def close(self):
+        pass
+
+
+def run_relay(scenario, verifier=None, storage=None):
+    async def main():
+        relay = AsyncRelay(
+            sub_pool=SubscriptionPool(),
+            verifier=verifier or StubVerifier(),
+            storage=storage if storage is not None else MemoryStore(),
+            bus=LocalBus(),
+        )
+        await relay.start()
+        try:
+            return await scenario(relay)
+        finally:
+            await relay.close()
+
+    return asyncio.run(main())
+
+
+def test_cancelled_verification_is_not_answered_as_invalid():
+    async def scenario(relay):
+        return await relay.event(signed())
+
+    with pytest.raises(asyncio.CancelledError):
+        run_relay(scenario, verifier=StubVerifier(asyncio.CancelledError()))
+
+
+def test_failed_verification_is_refused():
+    async def scenario(relay):
+        return json.loads(await relay.event(signed()))
+
+    response = run_relay(scenario, verifier=StubVerifier(RuntimeError("worker died")))
+
+    assert response[2:] == [False, "invalid: failed to verify key"]
+
+
+def test_duplicates_are_answered_before_verification():
+    verifier = StubVerifier()
+    event = signed()
+
+    async def scenario(relay):
+        return [json.loads(await relay.event(event)) for _ in range(3)]
+
+    responses = run_relay(scenario, verifier=verifier)
+
+    assert responses[0][2:] == [True, ""]
+    assert responses[1][2:] == responses[2][2:] == [True, "duplicate: already have this event"]
+    assert verifier.calls == 1
+
+
+def test_events_stored_before_are_answered_as_duplicates():
+    verifier = StubVerifier()
+    storage = MemoryStore()
+    event = signed()
+    storage.events[event["id"]] = CompactEvent.from_dict(event)
+
+    async def scenario(relay):
+        return [json.loads(await relay.event(event)) for _ in range(2)]
+
+    first, second = run_relay(scenario, verifier=verifier, storage=storage)
+
+    # storage catches what the seen ids miss, after that the seen ids answer
+    assert first[2:] == second[2:] == [True, "duplicate: already have this event"]
+    assert verifier.calls == 1
+
+
+def test_older_replaceable_versions_are_not_written():
+    storage = MemoryStore()
+    newer, older = signed("new", kind=0, created_at=200), signed("old", kind=0, created_at=100)
+
+    async def scenario(relay):
+        return [json.loads(await relay.event(event)) for event in (newer, older)]
+
+    first, second = run_relay(scenario, storage=storage)
+
+    assert first[2:] == [True, ""]
+    assert second[2:] == [True, "duplicate: have a newer event"]
+    assert list(storage.events) == [newer["id"]]
+
+
+def test_latest_replaceable_events_are_answered_from_the_cache():
+    other = PrivateKey()
+    profile, contacts = signed("me", kind=0, created_at=100), signed("", kind=3, created_at=200)
+    other_profile = signed("them", kind=0, created_at=150, key=other)
+    authors = [KEY.public_key_hex(), other.public_key_hex()]
+
+    def latest(relay, limit=10, **filters):
+        events = relay.latest(FilterMatcher(Filters(**filters)), limit)
+        return None if events is None else [event.id for event in events]
+
+    async def scenario(relay):
+        for event in (profile, contacts, other_profile):
+            await relay.event(event)
+        return [
+            latest(relay, authors=authors, kinds=[0]),
+            latest(relay, authors=authors[:1], kinds=[0, 3]),
+            latest(relay, authors=authors[:1], kinds=[0, 3], limit=1),
+            latest(relay, authors=authors, kinds=[0], since=120),
+            # not every requested event is cached, or the filter is not only a lookup by author
+            latest(relay, authors=authors, kinds=[3]),
+            latest(relay, authors=authors, kinds=[0, 1]),
+            latest(relay, authors=[authors[0][:8]], kinds=[0]),
+            latest(relay, kinds=[0]),
+            latest(relay, authors=authors, kinds=[0], **{"#p": [authors[1]]}),
+        ]
+
+    results = run_relay(scenario)
+
+    assert results == [
+        [other_profile["id"], profile["id"]],
+        [contacts["id"], profile["id"]],
+        [contacts["id"]],
+        [other_profile["id"]],
+        None,
+        None,
+        None,
+        None,
+        None,
+    ]
+
+
+def test_replaceable_lookups_skip_storage_once_the_window_is_full():
+    profile = signed("me", kind=0, created_at=100)
+    matcher = FilterMatcher(Filters(authors=[KEY.public_key_hex()], kinds=[0]))
+
+    async def scenario(relay):
+        relay.recent.max_count = 1
+        await relay.event(profile)
+        await relay.event(signed("note", created_at=200))
+        return relay.recent.query(matcher, 10), relay.query(matcher, 10)
+
+    from_window, from_memory = run_relay(scenario)
+
+    assert from_window is None
+    assert [event.id for event in from_memory] == [profile["id"]]
+
+
+def test_authors_over_their_rate_are_refused(monkeypatch):
+    monkeypatch.setattr(settings, "pubkey_event_rate", 0.001)
+    monkeypatch.setattr(settings, "pubkey_event_burst", 2)
+    storage = MemoryStore()
+    other = PrivateKey()
+
+    async def scenario(relay):
+        events = [signed(str(number)) for number in range(3)] + [signed("other", key=other)]
+        return [json.loads(await relay.event(event))[2:] for event in events]
+
+    responses = run_relay(scenario, storage=storage)
+
+    assert responses == [[True, ""], [True, ""], [False, "rate-limited: too many events from this pubkey"], [True, ""]]
+    assert len(storage.events) == 3
+
+
+def test_malformed_events_do_not_reach_the_verifier():
+    verifier = StubVerifier()
+
+    async def scenario(relay):
+        return json.loads(await relay.event({**signed(), "sig": "not hex"}))
+
+    response = run_relay(scenario, verifier=verifier)
+
+    assert response[2:] == [False, "invalid: `sig` is not 64 bytes of lowercase hex"]
+    assert verifier.calls == 0
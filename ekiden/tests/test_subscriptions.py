@@ -0,0 +1,177 @@
+import asyncio
+
+from ekiden.nips import CompactEvent, Filters
+from ekiden.subscriptions import (
+    FilterMatcher,
+    PrefixSet,
+    Subscription,
+    SubscriptionPool,
+    index_key,
+)
+
+PUBKEY = "ab" * 32
+OTHER = "cd" * 32
+
+
+def event(created_at: int = 100, kind: int = 1, pubkey: str = PUBKEY, tags=()) -> CompactEvent:
+    return CompactEvent(pubkey=pubkey, created_at=created_at, kind=kind, tags=tags, content="")
+
+
+class StubConnection:
+    """Records the frames the pool queues for it"""
+
+    def __init__(self):
+        self.closed = False
+        self.subscriptions = {}
+        self.frames = []
+
+    def push(self, frame: str) -> bool:
+        self.frames.append(frame)
+        return True
+
+
+def subscribe(pool: SubscriptionPool, *filters: dict, subscription_id: str = "sub") -> StubConnection:
+    connection = StubConnection()
+    filters = [Filters.parse_obj(f) for f in filters]
+    pool.add_subscription(Subscription(filters=filters, connection=connection, subscription_id=subscription_id))
+    return connection
+
+
+def test_prefix_set_drops_covered_prefixes():
+    prefixes = PrefixSet(["abc", "ab", "abcd", "b", "ba", "c1", "", "ab"])
+
+    assert prefixes.prefixes == ("ab", "b", "c1")
+    assert prefixes.exact == ()
+
+
+def test_prefix_set_keeps_full_values_exact():
+    full = "cd" * 32
+    prefixes = PrefixSet([full, "cd", "ef" * 32])
+
+    assert prefixes.exact == (full, "ef" * 32)
+    assert prefixes.prefixes == ("cd",)
+
+
+def test_prefix_set_contains():
+    prefixes = PrefixSet(["ab", "b", "c1", "ee" * 32])
+
+    assert "ab" + "0" * 62 in prefixes
+    assert "abff" in prefixes
+    assert "b" + "f" * 63 in prefixes
+    assert "c1" in prefixes
+    assert "ee" * 32 in prefixes
+
+    # before the first prefix, between prefixes and after the last one
+    assert "aa" + "f" * 62 not in prefixes
+    assert "a" not in prefixes
+    assert "c0" + "f" * 62 not in prefixes
+    assert "c2" not in prefixes
+    assert "ff" * 32 not in prefixes
+    assert "ee" * 31 + "ef" not in prefixes
+
+
+def test_prefix_set_empty():
+    prefixes = PrefixSet([])
+
+    assert not prefixes
+    assert "ab" * 32 not in prefixes
+
+
+def test_matcher_since_and_until_are_exclusive():
+    matcher = FilterMatcher(Filters(since=100, until=200))
+
+    assert not matcher.matches(event(100))
+    assert matcher.matches(event(101))
+    assert matcher.matches(event(199))
+    assert not matcher.matches(event(200))
+
+
+def test_matcher_since_zero_and_equal_bounds():
+    assert not FilterMatcher(Filters(since=0)).matches(event(0))
+    assert FilterMatcher(Filters(since=0)).matches(event(1))
+    assert FilterMatcher(Filters(until=0)).matches(event(-1))
+
+    # no timestamp lies strictly between equal or adjacent bounds
+    assert not FilterMatcher(Filters(since=100, until=100)).matches(event(100))
+    assert not FilterMatcher(Filters(since=100, until=101)).matches(event(100))
+    assert not FilterMatcher(Filters(since=100, until=101)).matches(event(101))
+
+
+def test_matcher_combines_filters():
+    matcher = FilterMatcher(Filters(kinds=[1], authors=["ab"], since=50))
+
+    assert matcher.matches(event(60))
+    assert not matcher.matches(event(60, kind=2))
+    assert not matcher.matches(event(60, pubkey="cd" * 32))
+    assert not matcher.matches(event(50))
+
+
+def test_shared_matchers_ignore_limit():
+    first = FilterMatcher.shared(Filters(kinds=[1], authors=["ab"], limit=10))
+    second = FilterMatcher.shared(Filters(kinds=[1], authors=["ab", "abc"], limit=20))
+
+    assert first is second
+
+
+def test_index_key_prefers_the_most_selective_dimension():
+    assert index_key(FilterMatcher(Filters(ids=["ee" * 32], kinds=[1]))) == ("ids", ("ee" * 32,))
+    assert index_key(FilterMatcher(Filters(authors=[PUBKEY], **{"#p": [OTHER]}))) == ("p", (OTHER,))
+    assert index_key(FilterMatcher(Filters(authors=[PUBKEY], kinds=[1]))) == ("authors", (PUBKEY,))
+    # prefixes can not be looked up
+    assert index_key(FilterMatcher(Filters(authors=["ab"], kinds=[1]))) == ("kinds", (1,))
+    assert index_key(FilterMatcher(Filters(ids=["ee"]))) == ("any", ())
+
+
+def test_broadcast_reaches_the_matching_subscriptions():
+    pool = SubscriptionPool()
+    by_kind = subscribe(pool, {"kinds": [1]})
+    by_author = subscribe(pool, {"authors": [PUBKEY]})
+    by_prefix = subscribe(pool, {"authors": ["ab"]})
+    by_mention = subscribe(pool, {"#p": [OTHER]})
+    other_kind = subscribe(pool, {"kinds": [7]})
+    other_author = subscribe(pool, {"authors": [OTHER], "kinds": [1]})
+
+    mention = event(tags=(("p", OTHER),))
+    asyncio.run(pool.broadcast(mention))
+
+    frame = f'["EVENT","sub",{mention.json()}]'
+    for connection in (by_kind, by_author, by_prefix, by_mention):
+        assert connection.frames == [frame]
+    for connection in (other_kind, other_author):
+        assert connection.frames == []
+
+
+def test_broadcast_sends_once_per_subscription():
+    pool = SubscriptionPool()
+    connection = subscribe(pool, {"kinds": [1]}, {"authors": [PUBKEY]}, {"kinds": [1]})
+
+    asyncio.run(pool.broadcast(event()))
+
+    assert len(connection.frames) == 1
+
+
+def test_removed_subscriptions_are_unposted():
+    pool = SubscriptionPool()
+    connection = subscribe(pool, {"kinds": [1]}, subscription_id="a")
+    subscribe(pool, {"kinds": [1]}, subscription_id="b")
+    pool.add_subscription(Subscription(filters=[Filters(authors=[PUBKEY])], connection=connection, subscription_id="c"))
+
+    pool.remove_subscription(connection, "a")
+    assert len(pool) == 2
+    pool.remove_connection(connection)
+    assert len(pool) == 1
+    assert connection.subscriptions == {}
+
+    asyncio.run(pool.broadcast(event()))
+    assert connection.frames == []
+
+
+def test_broadcast_drops_subscriptions_of_closed_connections():
+    pool = SubscriptionPool()
+    connection = subscribe(pool, {"kinds": [1]})
+    connection.closed = True
+
+    asyncio.run(pool.broadcast(event()))
+
+    assert connection.frames == []
+    assert len(pool) == 0
@@ -0,0 +1,89 @@
+import pytest
+
+from ekiden.settings import settings
+from ekiden.validation import InvalidEvent, difficulty, prevalidate
+
+NOW = 1_700_000_000
+
+
+def event(**fields) -> dict:
+    return {
+        "id": "0f" + "ab" * 31,
+        "pubkey": "cd" * 32,
+        "created_at": NOW,
+        "kind": 1,
+        "tags": [["e", "ef" * 32], ["t", "nostr"]],
+        "content": "hello",
+        "sig": "12" * 64,
+        **fields,
+    }
+
+
+def reason(data) -> str:
+    with pytest.raises(InvalidEvent) as error:
+        prevalidate(data, now=NOW)
+    return str(error.value)
+
+
+def test_well_formed_events_pass():
+    prevalidate(event(), now=NOW)
+    prevalidate(event(tags=[], content=""), now=NOW)
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        ([], "invalid: event is not an object"),
+        ({key: value for key, value in event().items() if key != "sig"}, "invalid: `sig` is missing or not a str"),
+        (event(created_at="now"), "invalid: `created_at` is missing or not a int"),
+        (event(kind=True), "invalid: `kind` is missing or not a int"),
+        (event(kind=70000), "invalid: `kind` is out of range"),
+        (event(tags=[[]]), "invalid: tags must be non empty arrays of strings"),
+        (event(tags=[["t", 1]]), "invalid: tags must be non empty arrays of strings"),
+        (event(tags=[["p"]]), "invalid: `p` tag without a value"),
+        (event(id="AB" * 32), "invalid: `id` is not 32 bytes of lowercase hex"),
+        (event(pubkey="cd" * 31), "invalid: `pubkey` is not 32 bytes of lowercase hex"),
+        (event(sig="12" * 32), "invalid: `sig` is not 64 bytes of lowercase hex"),
+    ],
+)
+def test_malformed_events_are_refused(data, expected):
+    assert reason(data) == expected
+
+
+def test_sizes_are_bounded(monkeypatch):
+    monkeypatch.setattr(settings, "max_content_length", 5)
+    monkeypatch.setattr(settings, "max_tags", 2)
+
+    assert reason(event(content="hello!")) == "invalid: content is too long"
+    assert reason(event(tags=[["t", "a"]] * 3)) == "invalid: too many tags"
+
+
+def test_created_at_is_bounded(monkeypatch):
+    monkeypatch.setattr(settings, "created_at_max_future", 60)
+    monkeypatch.setattr(settings, "created_at_max_age", 3600)
+
+    prevalidate(event(created_at=NOW + 60), now=NOW)
+    prevalidate(event(created_at=NOW - 3600), now=NOW)
+    assert reason(event(created_at=NOW + 61)) == "invalid: created_at is too far in the future"
+    assert reason(event(created_at=NOW - 3601)) == "invalid: created_at is too far in the past"
+
+
+def test_created_at_bounds_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(settings, "created_at_max_future", 0)
+    monkeypatch.setattr(settings, "created_at_max_age", 0)
+
+    prevalidate(event(created_at=NOW * 2), now=NOW)
+    prevalidate(event(created_at=0), now=NOW)
+
+
+def test_difficulty_counts_leading_zero_bits():
+    assert difficulty("ff" * 32) == 0
+    assert difficulty("0f" + "ff" * 31) == 4
+    assert difficulty("0000" + "1f" * 30) == 19
+
+
+def test_proof_of_work_is_required_when_set(monkeypatch):
+    monkeypatch.setattr(settings, "min_pow_difficulty", 5)
+
+    assert reason(event()) == "pow: difficulty is below 5"
+    prevalidate(event(id="07" + "ab" * 31), now=NOW)
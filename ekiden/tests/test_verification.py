@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pytest
+
+from ekiden import verification
+from ekiden.keys import PrivateKey, VerificationError
+from ekiden.nips import CompactEvent
+from ekiden.verification import Verifier
+
+KEY = PrivateKey()
+
+
+def signed(content: str = "hello") -> dict:
+    event = CompactEvent(pubkey=KEY.public_key_hex(), created_at=int(time.time()), kind=1, tags=(), content=content)
+    event.sig = KEY.sign(bytes.fromhex(event.id))
+    return event.dict()
+
+
+def verify_all(verifier: Verifier, events) -> list:
+    async def main():
+        try:
+            return await asyncio.gather(*(verifier.verify(event) for event in events), return_exceptions=True)
+        finally:
+            await verifier.close()
+
+    return asyncio.run(main())
+
+
+def test_verifies_signed_events():
+    event = signed()
+
+    [verified] = verify_all(Verifier(workers=2), [event])
+
+    assert isinstance(verified, CompactEvent)
+    assert verified.id == event["id"]
+    assert verified.json() == CompactEvent.from_dict(event).json()
+
+
+def test_rejects_tampered_events():
+    changed_content = {**signed(), "content": "changed"}
+    other = signed("other")
+    wrong_signature = {**signed(), "sig": other["sig"]}
+
+    results = verify_all(Verifier(workers=2), [changed_content, wrong_signature])
+
+    assert all(isinstance(result, VerificationError) for result in results)
+    assert "id does not match" in str(results[0])
+
+
+def test_events_are_verified_in_batches(monkeypatch):
+    batches = []
+
+    def recording_verify_batch(events):
+        batches.append(len(events))
+        return [CompactEvent.verify(event) for event in events]
+
+    monkeypatch.setattr(verification, "verify_batch", recording_verify_batch)
+    events = [signed(str(number)) for number in range(20)]
+
+    results = verify_all(Verifier(workers=1, batch_size=8, batch_delay=0.01), events)
+
+    assert [result.id for result in results] == [event["id"] for event in events]
+    assert sum(batches) == 20
+    assert max(batches) <= 8
+    assert len(batches) < 20
+
+
+def test_verifies_in_worker_processes():
+    event = signed()
+
+    results = verify_all(Verifier(workers=1, use_processes=True), [event, {**event, "content": "changed"}])
+
+    assert results[0].id == event["id"]
+    assert isinstance(results[1], VerificationError)
+
+
+def test_verify_raises_the_error_of_its_event():
+    async def main():
+        verifier = Verifier(workers=1)
+        try:
+            with pytest.raises(VerificationError):
+                await verifier.verify({**signed(), "content": "changed"})
+            return await verifier.verify(signed())
+        finally:
+            await verifier.close()
+
+    assert isinstance(asyncio.run(main()), CompactEvent)
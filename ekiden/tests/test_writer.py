@@ -0,0 +1,104 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from ekiden.nips import CompactEvent
+from ekiden.writer import EventWriter
+
+
+def event(content: str) -> CompactEvent:
+    return CompactEvent(pubkey="ab" * 32, created_at=100, kind=1, tags=(), content=content)
+
+
+class RecordingCommit:
+    """Records the batches it commits, refuses events whose content is `duplicate` and fails batches holding `bad`"""
+
+    def __init__(self):
+        self.batches: List[List[str]] = []
+
+    async def __call__(self, events: List[CompactEvent]) -> List[bool]:
+        self.batches.append([event.content for event in events])
+        if any(event.content == "bad" for event in events):
+            raise RuntimeError("constraint failed")
+        return [event.content != "duplicate" for event in events]
+
+
+def write_all(writer: EventWriter, contents: List[str]) -> list:
+    async def main():
+        try:
+            return await asyncio.gather(*(writer.write(event(content)) for content in contents), return_exceptions=True)
+        finally:
+            await writer.close()
+
+    return asyncio.run(main())
+
+
+def test_concurrent_writes_share_a_commit():
+    commit = RecordingCommit()
+
+    results = write_all(EventWriter(commit, batch_size=100, batch_delay=0.01), [str(n) for n in range(10)])
+
+    assert results == [True] * 10
+    assert commit.batches == [[str(n) for n in range(10)]]
+
+
+def test_batches_are_bounded():
+    commit = RecordingCommit()
+
+    write_all(EventWriter(commit, batch_size=4, batch_delay=0.01), [str(n) for n in range(10)])
+
+    assert [len(batch) for batch in commit.batches] == [4, 4, 2]
+    assert sum(commit.batches, []) == [str(n) for n in range(10)]
+
+
+def test_each_write_gets_its_own_result():
+    commit = RecordingCommit()
+
+    results = write_all(EventWriter(commit, batch_size=100, batch_delay=0.01), ["a", "duplicate", "b"])
+
+    assert results == [True, False, True]
+
+
+def test_a_failed_batch_is_retried_event_by_event():
+    commit = RecordingCommit()
+
+    results = write_all(EventWriter(commit, batch_size=100, batch_delay=0.01), ["a", "bad", "b"])
+
+    assert results[0] is True and results[2] is True
+    assert isinstance(results[1], RuntimeError)
+    assert commit.batches == [["a", "bad", "b"], ["a"], ["bad"], ["b"]]
+
+
+def test_write_waits_for_the_commit():
+    async def main():
+        release = asyncio.Event()
+
+        async def commit(events):
+            await release.wait()
+            return [True] * len(events)
+
+        writer = EventWriter(commit, batch_size=10, batch_delay=0)
+        write = asyncio.create_task(writer.write(event("a")))
+        await asyncio.sleep(0.01)
+        waiting = not write.done()
+        release.set()
+        try:
+            return waiting, await asyncio.wait_for(write, 1)
+        finally:
+            await writer.close()
+
+    assert asyncio.run(main()) == (True, True)
+
+
+def test_the_writer_keeps_going_after_a_failed_event():
+    async def main():
+        writer = EventWriter(RecordingCommit(), batch_size=10, batch_delay=0)
+        try:
+            with pytest.raises(RuntimeError):
+                await writer.write(event("bad"))
+            return await writer.write(event("a"))
+        finally:
+            await writer.close()
+
+    assert asyncio.run(main()) is True